@@ -0,0 +1,290 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# リポジトリのルートから`python -m benchmarks.run_benchmark`で実行する
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def start_stub_server(args: argparse.Namespace) -> tuple:
+    """
+    代替サーバーを別プロセスで起動します。
+
+    計測対象のプロセスのCPU時間やメモリ使用量に含まれないよう、別プロセスで実行します。
+
+    Returns:
+        tuple: (サーバーのプロセス, サーバーのURL)
+    """
+    cmd = [
+        sys.executable, "-m", "benchmarks.stub_servers",
+        "--chat-latency", str(args.chat_latency),
+        "--image-latency", str(args.image_latency),
+        "--tts-latency", str(args.tts_latency),
+        "--upload-latency", str(args.upload_latency),
+        "--jitter", str(args.jitter),
+        "--error-rate", str(args.error_rate),
+        "--image-format", args.image_format,
+    ]
+    if args.seed is not None:
+        cmd += ["--seed", str(args.seed)]
+    process = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.PIPE, text=True)
+    base_url = process.stdout.readline().strip()
+    if not base_url:
+        process.kill()
+        raise RuntimeError("代替サーバーの起動に失敗しました。")
+    return process, base_url
+
+
+def configure_environment(base_url: str, work_dir: Path, image_format: str = "url"):
+    """
+    パイプラインの接続先と保存先を代替サーバーと作業ディレクトリに向けます。
+
+    OpenAIやTTSのクライアントは最初に使われた時点で環境変数から作成されるため、
+    パイプラインを実行する前に呼び出す必要があります。
+
+    Args:
+        base_url (str): 代替サーバーのURL。
+        work_dir (Path): 作業ディレクトリ。
+        image_format (str): パイプラインが画像を受け取る形式（IMAGE_RESPONSE_FORMAT）。
+    """
+    os.environ.update({
+        "OPENAI_BASE_URL": f"{base_url}/v1",
+        "OPENAI_API_KEY": "benchmark",
+        "TTS_API_URL": f"{base_url}/voice",
+        "TRACE_DIR": str(work_dir / "traces"),
+        "WORKSPACE_ROOT": str(work_dir / "temp"),
+        "LLM_CACHE_PATH": str(work_dir / "cache" / "llm.sqlite3"),
+        "TTS_CACHE_DIR": str(work_dir / "cache" / "tts"),
+        "IMAGE_CACHE_DIR": str(work_dir / "cache" / "images"),
+        "UPLOAD_STATE_DIR": str(work_dir / "cache" / "uploads"),
+        "RATE_LIMIT_PATH": str(work_dir / "cache" / "ratelimit.sqlite3"),
+        "IDEA_INDEX_PATH": str(work_dir / "cache" / "ideas.sqlite3"),
+        "IMAGE_RESPONSE_FORMAT": image_format,
+    })
+    # 代替サーバーにはアカウントの上限がないため、明示的に指定されない限り
+    # 1分あたりの上限を外し、同時実行数の調整だけを有効にする
+    for name in ("RATE_LIMIT_CHAT_RPM", "RATE_LIMIT_CHAT_TPM", "RATE_LIMIT_IMAGE_RPM"):
+        os.environ.setdefault(name, "0")
+
+
+def percentile(values: list, q: float) -> float:
+    """
+    線形補間でパーセンタイルを計算します。
+
+    Args:
+        values (list): 値のリスト。
+        q (float): パーセンタイル（0〜100）。
+
+    Returns:
+        float: パーセンタイルの値。
+    """
+    values = sorted(values)
+    if not values:
+        return 0.0
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize_traces(trace_dir: Path) -> dict:
+    """
+    トレースのJSON Linesを読み込み、スパン名ごとの所要時間のパーセンタイルを計算します。
+
+    Args:
+        trace_dir (Path): トレースの出力先。
+
+    Returns:
+        dict: スパン名ごとの件数・エラー数・所要時間（秒）のp50/p90/p99/最大値・
+            子プロセスのCPU時間と最大メモリ使用量（KiB）。
+    """
+    spans = {}
+    for path in sorted(trace_dir.glob("*.jsonl")):
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                record = json.loads(line)
+                spans.setdefault(record["name"], []).append(record)
+
+    summary = {}
+    for name, records in sorted(spans.items()):
+        wall = [record["wall_seconds"] for record in records]
+        summary[name] = {
+            "count": len(records),
+            "errors": sum(record["error"] is not None for record in records),
+            "p50": percentile(wall, 50),
+            "p90": percentile(wall, 90),
+            "p99": percentile(wall, 99),
+            "max": max(wall),
+            "child_cpu_seconds": sum(record["child_cpu_seconds"] for record in records),
+            "child_max_rss_kb": max(
+                (record.get("child_max_rss_kb") or 0 for record in records), default=0),
+        }
+    return summary
+
+
+def run(args: argparse.Namespace, work_dir: Path) -> dict:
+    """
+    パイプラインを実行し、計測結果を返します。
+    """
+    # 環境変数を設定してから読み込む
+    from src.batch import BatchScheduler
+
+    from generate_video import topic2video
+
+    subjects = [f"ベンチマーク{i + 1}" for i in range(args.videos)]
+    output_dir = work_dir / "output"
+
+    upload = None
+    upload_queue = None
+    if args.upload:
+        import requests
+
+        from src.uploader import ResumableUploader, UploadQueue
+
+        uploader = ResumableUploader(requests.Session(), upload_url=f"{args.base_url}/upload")
+        upload_queue = UploadQueue(uploader)
+
+        def upload(video_path, clips):
+            upload_queue.submit(video_path, {"snippet": {"title": clips["title"]}})
+
+    started = time.perf_counter()
+    failed = 0
+    if args.mode == "batch":
+        scheduler = BatchScheduler(
+            render_engine=args.render_engine, render_profile=args.render_profile, upload=upload)
+        jobs = scheduler.run(subjects, args.clips, output_dir=str(output_dir))
+        failed = sum(job.status != "done" for job in jobs)
+    else:
+        for subject in subjects:
+            try:
+                video_path, clips = topic2video(
+                    subject, args.clips, str(output_dir / f"{subject}.mp4"),
+                    args.render_engine, args.render_profile)
+                if upload is not None:
+                    upload(video_path, clips)
+            except Exception as e:
+                print(f"[-] {subject}: {e}", file=sys.stderr)
+                failed += 1
+    if upload_queue is not None:
+        failed += sum(isinstance(result, Exception) for _, result in upload_queue.close())
+    elapsed = time.perf_counter() - started
+
+    done = args.videos - failed
+    spans = summarize_traces(work_dir / "traces")
+    return {
+        "config": {
+            "mode": args.mode,
+            "videos": args.videos,
+            "clips": args.clips,
+            "render_engine": args.render_engine or os.getenv("RENDER_ENGINE", "per_clip"),
+            "render_profile": args.render_profile or os.getenv("RENDER_PROFILE", "balanced"),
+            "upload": args.upload,
+            "image_format": args.image_format,
+            "chat_latency": args.chat_latency,
+            "image_latency": args.image_latency,
+            "tts_latency": args.tts_latency,
+            "upload_latency": args.upload_latency,
+            "jitter": args.jitter,
+            "error_rate": args.error_rate,
+        },
+        "elapsed_seconds": elapsed,
+        "videos_done": done,
+        "videos_failed": failed,
+        "videos_per_hour": done / elapsed * 3600 if elapsed > 0 else 0.0,
+        # Linuxのru_maxrssはKiB単位
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        # RUSAGE_CHILDRENのru_maxrssにはfork時点の親プロセスのメモリが含まれるため、
+        # 子プロセス（ffmpeg）はスパンごとに実行中に計測した値の最大値を使う
+        "peak_child_rss_kb": max(
+            (stats["child_max_rss_kb"] for stats in spans.values()), default=0),
+        "spans": spans,
+    }
+
+
+def print_report(report: dict, baseline: dict = None):
+    """
+    計測結果を表示します。ベースラインがあれば変化率も表示します。
+    """
+    def delta(value, base, higher_is_better=False):
+        if not base:
+            return ""
+        change = (value - base) / base * 100
+        better = change > 0 if higher_is_better else change < 0
+        return f" ({change:+.1f}% {'better' if better else 'worse'})"
+
+    base = baseline or {}
+    print(f"videos: {report['videos_done']}/{report['config']['videos']} "
+          f"in {report['elapsed_seconds']:.1f}s")
+    print(f"videos/hour: {report['videos_per_hour']:.1f}"
+          + delta(report["videos_per_hour"], base.get("videos_per_hour"), True))
+    print(f"peak RSS: {report['peak_rss_kb'] / 1024:.1f} MiB"
+          + delta(report["peak_rss_kb"], base.get("peak_rss_kb")))
+    print(f"peak ffmpeg RSS: {report['peak_child_rss_kb'] / 1024:.1f} MiB"
+          + delta(report["peak_child_rss_kb"], base.get("peak_child_rss_kb")))
+
+    print(f"{'span':<24}{'count':>7}{'errors':>7}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    base_spans = base.get("spans", {})
+    for name, stats in report["spans"].items():
+        line = (f"{name:<24}{stats['count']:>7}{stats['errors']:>7}"
+                f"{stats['p50']:>9.3f}{stats['p90']:>9.3f}{stats['p99']:>9.3f}{stats['max']:>9.3f}")
+        if name in base_spans:
+            line += " p50" + delta(stats["p50"], base_spans[name]["p50"])
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="OpenAIとTTSの代替サーバーを使ってパイプラインのスループットを計測します。")
+    parser.add_argument("--mode", choices=("single", "batch"), default="batch",
+                        help="single: topic2videoを1本ずつ実行、batch: BatchSchedulerで実行")
+    parser.add_argument("--videos", type=int, default=3)
+    parser.add_argument("--clips", type=int, default=5)
+    parser.add_argument("--render-engine", choices=("per_clip", "single_pass"), default=None)
+    parser.add_argument("--render-profile", choices=("quality", "balanced", "fast", "square"),
+                        default=None)
+    parser.add_argument("--upload", action="store_true",
+                        help="完成した動画を代替サーバーに再開可能アップロードで送信する")
+    parser.add_argument("--chat-latency", type=float, default=2.0)
+    parser.add_argument("--image-latency", type=float, default=5.0)
+    parser.add_argument("--tts-latency", type=float, default=0.5)
+    parser.add_argument("--upload-latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--image-format", choices=("url", "b64_json"), default="url",
+                        help="パイプラインが画像を受け取る形式（IMAGE_RESPONSE_FORMAT）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", default=None,
+                        help="キャッシュやトレースの保存先。同じディレクトリで再実行するとキャッシュが効いた状態を計測できる")
+    parser.add_argument("--output", default=None, help="計測結果を保存するJSONファイル")
+    parser.add_argument("--baseline", default=None, help="比較する過去の計測結果のJSONファイル")
+    args = parser.parse_args()
+
+    work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix="benchmark_")).resolve()
+    work_dir.mkdir(parents=True, exist_ok=True)
+    # 前回の実行のトレースを集計に含めない
+    shutil.rmtree(work_dir / "traces", ignore_errors=True)
+
+    server, args.base_url = start_stub_server(args)
+    try:
+        configure_environment(args.base_url, work_dir, args.image_format)
+        report = run(args, work_dir)
+    finally:
+        server.terminate()
+        server.wait()
+
+    baseline = None
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+    print_report(report, baseline)
+    if args.output:
+        Path(args.output).write_text(
+            json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    if args.work_dir is None:
+        shutil.rmtree(work_dir, ignore_errors=True)
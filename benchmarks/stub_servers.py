@@ -0,0 +1,414 @@
+import argparse
+import array
+import base64
+import hashlib
+import io
+import json
+import math
+import random
+import re
+import struct
+import threading
+import time
+import uuid
+import wave
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# 生成する画像の解像度（DALL-E 3の1024x1024と同じ）
+IMAGE_WIDTH = 1024
+IMAGE_HEIGHT = 1024
+
+# 合成音声のサンプリングレートと、1文字あたりの長さ（秒）
+TTS_SAMPLE_RATE = 44100
+TTS_SECONDS_PER_CHAR = 0.12
+
+
+class StubConfig:
+    """
+    代替サーバーの応答の設定。
+
+    Args:
+        chat_latency (float): チャット補完の応答までの時間（秒）。
+        image_latency (float): 画像生成の応答までの時間（秒）。
+        tts_latency (float): 音声合成の応答までの時間（秒）。
+        upload_latency (float): アップロードの各リクエストの応答までの時間（秒）。
+        jitter (float): 応答時間のばらつき（応答時間に対する割合、0.2なら±20%）。
+        error_rate (float): 500エラーを返す確率（0〜1）。
+        image_format (str): 画像生成の応答形式（"url"または"b64_json"）。
+        seed (int): 乱数のシード。
+    """
+
+    def __init__(
+        self,
+        chat_latency: float = 0.0,
+        image_latency: float = 0.0,
+        tts_latency: float = 0.0,
+        upload_latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        image_format: str = "url",
+        seed: int = None,
+    ):
+        self.latency = {
+            "chat": chat_latency,
+            "image": image_latency,
+            "tts": tts_latency,
+            "upload": upload_latency,
+        }
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.image_format = image_format
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self, endpoint: str) -> float:
+        latency = self.latency[endpoint]
+        with self._lock:
+            return max(0.0, latency * (1 + self._random.uniform(-self.jitter, self.jitter)))
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+
+def fake_ideas(meta_topic: str, num_ideas: int) -> dict:
+    """
+    generate_ideasの形式のアイデアを生成します。
+    """
+    return {"ideas": [f"{meta_topic}のアイデア{i + 1}" for i in range(num_ideas)]}
+
+
+def fake_script(video_subject: str, num_clips: int) -> dict:
+    """
+    generate_scriptの形式のスクリプトを生成します。
+
+    クリップの文章の長さを主題から決めることで、クリップごとの音声の長さにばらつきを持たせます。
+    """
+    digest = hashlib.sha256(video_subject.encode("utf-8")).digest()
+    clips = []
+    for i in range(num_clips):
+        sentence = "これはベンチマーク用の文章です。" * (1 + digest[i % len(digest)] % 3)
+        clips.append({
+            "num": i,
+            "title": f"{video_subject} {i + 1}",
+            "text": f"{video_subject}について、{sentence}",
+            "video_prompt": f"{video_subject}の場面{i + 1}を描写してください。",
+            "subtitles": f"{video_subject}について、{sentence}",
+        })
+    return {
+        "title": video_subject,
+        "description": f"{video_subject}についてのビデオです。",
+        "topic": video_subject,
+        "category": "22",
+        "clips": clips,
+    }
+
+
+def fake_png(prompt: str) -> bytes:
+    """
+    プロンプトごとに色の異なる単色のPNG画像を生成します。
+    """
+    color = hashlib.sha256(prompt.encode("utf-8")).digest()[:3]
+    row = b"\x00" + color * IMAGE_WIDTH
+    raw = zlib.compress(row * IMAGE_HEIGHT, 6)
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    header = struct.pack(">IIBBBBB", IMAGE_WIDTH, IMAGE_HEIGHT, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", raw)
+        + chunk(b"IEND", b"")
+    )
+
+
+def fake_wav(text: str) -> bytes:
+    """
+    文章の長さに比例した長さの正弦波のWAVを生成します（モノラル、16ビット）。
+    """
+    duration = max(0.5, len(text) * TTS_SECONDS_PER_CHAR)
+    # 220Hzの1周期分を繰り返す
+    period = TTS_SAMPLE_RATE // 220
+    cycle = array.array(
+        "h", (int(0.3 * 32767 * math.sin(2 * math.pi * i / period)) for i in range(period)))
+    samples = cycle * (int(duration * TTS_SAMPLE_RATE) // period)
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(TTS_SAMPLE_RATE)
+        wav.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+def _parse_int(pattern: str, text: str, default: int) -> int:
+    match = re.search(pattern, text)
+    return int(match.group(1)) if match else default
+
+
+def _parse_str(pattern: str, text: str, default: str) -> str:
+    match = re.search(pattern, text)
+    return match.group(1).strip() if match else default
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    OpenAI API（チャット補完・画像生成）、Style-Bert-VITS2 API、
+    YouTubeの再開可能アップロードの代わりに応答するハンドラー。
+    """
+
+    protocol_version = "HTTP/1.1"
+    config: StubConfig = None
+    images = {}
+    uploads = {}
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass  # リクエストごとのログは出力しない
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/health":
+            self._send(200, b"ok", "text/plain")
+        elif url.path.startswith("/images/"):
+            with self.lock:
+                image = self.images.get(url.path.rsplit("/", 1)[1])
+            if image is None:
+                self._send_json(404, {"error": {"message": "not found"}})
+            else:
+                self._send(200, image, "image/png")
+        elif url.path == "/voice":
+            if self._simulate("tts"):
+                return
+            text = parse_qs(url.query).get("text", [""])[0]
+            self._send(200, fake_wav(text), "audio/wav")
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self._read_body()
+        if url.path.endswith("/chat/completions"):
+            request = json.loads(body)
+            if request.get("stream"):
+                self._chat_completion_stream(request)
+                return
+            if self._simulate("chat"):
+                return
+            self._chat_completion(request)
+        elif url.path.endswith("/images/generations"):
+            if self._simulate("image"):
+                return
+            self._image_generation(json.loads(body))
+        elif url.path == "/upload":
+            if self._simulate("upload"):
+                return
+            session_id = uuid.uuid4().hex
+            with self.lock:
+                self.uploads[session_id] = {
+                    "size": int(self.headers.get("X-Upload-Content-Length", "0")),
+                    "received": 0,
+                }
+            location = f"http://{self.headers['Host']}/upload/{session_id}"
+            self._send(200, b"", "text/plain", {"Location": location})
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_PUT(self):
+        url = urlparse(self.path)
+        body = self._read_body()
+        session_id = url.path.rsplit("/", 1)[1]
+        with self.lock:
+            upload = self.uploads.get(session_id)
+        if not url.path.startswith("/upload/") or upload is None:
+            self._send_json(404, {"error": {"message": "upload session not found"}})
+            return
+        if self._simulate("upload"):
+            return
+
+        content_range = self.headers.get("Content-Range", "")
+        match = re.match(r"bytes (\d+)-(\d+)/(\d+)", content_range)
+        with self.lock:
+            if match and int(match.group(1)) == upload["received"]:
+                upload["received"] += len(body)
+            received = upload["received"]
+        if received >= upload["size"]:
+            self._send_json(200, {"id": session_id[:11], "status": {"uploadStatus": "uploaded"}})
+        elif received == 0:
+            self._send(308, b"", "text/plain")
+        else:
+            self._send(308, b"", "text/plain", {"Range": f"bytes=0-{received - 1}"})
+
+    def _chat_content(self, request: dict) -> str:
+        prompt = request["messages"][-1]["content"]
+        if "主題の一覧:" in prompt:
+            num_clips = _parse_int(r"クリップ数:\s*(\d+)", prompt, 5)
+            subjects = re.findall(r"^\s*(\d+): (.+)$", prompt.split("主題の一覧:", 1)[1], re.M)
+            data = {"scripts": [
+                {"index": int(index), "script": fake_script(subject.strip(), num_clips)}
+                for index, subject in subjects
+            ]}
+        elif "出力するアイデアの個数" in prompt:
+            data = fake_ideas(
+                _parse_str(r"主題:\s*(.+)", prompt, "ベンチマーク"),
+                _parse_int(r"出力するアイデアの個数:\s*(\d+)", prompt, 3),
+            )
+        else:
+            data = fake_script(
+                _parse_str(r"主題:\s*(.+)", prompt, "ベンチマーク"),
+                _parse_int(r"クリップ数:\s*(\d+)", prompt, 5),
+            )
+        return json.dumps(data, ensure_ascii=False)
+
+    def _chat_completion_stream(self, request: dict):
+        # 応答時間の2割を最初のトークンまでの待ち時間とし、残りを各チャンクに分ける
+        delay = self.config.delay("chat")
+        time.sleep(delay * 0.2)
+        if self.config.should_fail():
+            self._send_json(500, {"error": {"message": "stub server error", "type": "server_error"}})
+            return
+        content = self._chat_content(request)
+        pieces = [content[i:i + 16] for i in range(0, len(content), 16)]
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        def event(delta: dict, finish_reason: str = None) -> bytes:
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model", "stub"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self._write_chunk(event({"role": "assistant", "content": ""}))
+        for piece in pieces:
+            time.sleep(delay * 0.8 / len(pieces))
+            self._write_chunk(event({"content": piece}))
+        self._write_chunk(event({}, "stop"))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _chat_completion(self, request: dict):
+        prompt = request["messages"][-1]["content"]
+        content = self._chat_content(request)
+        self._send_json(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": len(prompt), "completion_tokens": len(content),
+                      "total_tokens": len(prompt) + len(content)},
+        })
+
+    def _image_generation(self, request: dict):
+        image = fake_png(request.get("prompt", ""))
+        if request.get("response_format", self.config.image_format) == "b64_json":
+            item = {"b64_json": base64.b64encode(image).decode("ascii")}
+        else:
+            image_id = f"{uuid.uuid4().hex}.png"
+            with self.lock:
+                self.images[image_id] = image
+            item = {"url": f"http://{self.headers['Host']}/images/{image_id}"}
+        self._send_json(200, {"created": int(time.time()), "data": [item]})
+
+    def _simulate(self, endpoint: str) -> bool:
+        # 設定された応答時間だけ待ち、一定の確率で500エラーを返す
+        time.sleep(self.config.delay(endpoint))
+        if self.config.should_fail():
+            self._send_json(500, {"error": {"message": "stub server error", "type": "server_error"}})
+            return True
+        return False
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length", "0"))
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, status: int, data: dict):
+        self._send(status, json.dumps(data, ensure_ascii=False).encode("utf-8"), "application/json")
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: dict = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def create_server(config: StubConfig, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """
+    代替サーバーを作成します。
+
+    Args:
+        config (StubConfig): 応答の設定。
+        host (str): 待ち受けるアドレス。
+        port (int): 待ち受けるポート。0の場合は空いているポート。
+
+    Returns:
+        ThreadingHTTPServer: 作成したサーバー。serve_foreverで起動します。
+    """
+    handler = type("ConfiguredStubHandler", (StubHandler,), {
+        "config": config, "images": {}, "uploads": {}, "lock": threading.Lock(),
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="OpenAI・TTS・YouTubeアップロードの代わりに応答するローカルサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--chat-latency", type=float, default=0.0)
+    parser.add_argument("--image-latency", type=float, default=0.0)
+    parser.add_argument("--tts-latency", type=float, default=0.0)
+    parser.add_argument("--upload-latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--image-format", choices=("url", "b64_json"), default="url")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = create_server(
+        StubConfig(
+            chat_latency=args.chat_latency,
+            image_latency=args.image_latency,
+            tts_latency=args.tts_latency,
+            upload_latency=args.upload_latency,
+            jitter=args.jitter,
+            error_rate=args.error_rate,
+            image_format=args.image_format,
+            seed=args.seed,
+        ),
+        host=args.host,
+        port=args.port,
+    )
+    # 起動したことを知らせるため、最初の行に待ち受けているURLを出力する
+    print(f"http://{args.host}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
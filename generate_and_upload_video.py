@@ -1,13 +1,9 @@
 import os
 import pickle
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from google.auth.transport.requests import Request
 from termcolor import colored
 from dotenv import load_dotenv
-from src.generate_video import topic2video
-from src.generate_ideas import generate_ideas
+from src.generate_ideas import generate_unique_ideas
+from src.uploader import ResumableUploader, UploadQueue
 
 # Load environment variables from .env file
 load_dotenv()
@@ -15,11 +11,13 @@ load_dotenv()
 # 認証情報の設定
 CLIENT_SECRETS_FILE = os.getenv("CLIENT_SECRETS_FILE")
 SCOPES = [os.getenv("SCOPES")]
-API_SERVICE_NAME = os.getenv("API_SERVICE_NAME")
-API_VERSION = os.getenv("API_VERSION")
 
 
-def get_authenticated_service():
+def get_credentials():
+    # Googleのライブラリは読み込みに時間がかかるため、認証する時点で読み込む
+    from google.auth.transport.requests import Request
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
     credentials = None
     # Check if user's access token and refresh token are saved in token.pickle file
     if os.path.exists("token.pickle"):
@@ -38,11 +36,18 @@ def get_authenticated_service():
         with open("token.pickle", "wb") as token:
             pickle.dump(credentials, token)
 
-    return build(API_SERVICE_NAME, API_VERSION, credentials=credentials)
+    return credentials
 
 
-def upload_video(youtube, file, title, description, category, keywords, privacyStatus):
-    body = {
+def get_uploader():
+    from google.auth.transport.requests import AuthorizedSession
+
+    # トークンの更新を自動で行うセッションで、再開可能アップロードを行う
+    return ResumableUploader(AuthorizedSession(get_credentials()))
+
+
+def build_video_body(title, description, category, keywords, privacyStatus):
+    return {
         "snippet": {
             "title": title,
             "description": description,
@@ -52,41 +57,50 @@ def upload_video(youtube, file, title, description, category, keywords, privacyS
         "status": {"privacyStatus": privacyStatus},
     }
 
-    # Upload the video file
-    media = MediaFileUpload(file, chunksize=-1, resumable=True)
-    request = youtube.videos().insert(
-        part=",".join(body.keys()), body=body, media_body=media
+
+def build_clips_body(clips, privacyStatus=None):
+    # スクリプトのタイトル・説明・トピック・カテゴリーから動画のメタデータを作成する
+    return build_video_body(
+        clips["title"],
+        clips["description"],
+        clips["category"],
+        clips["topic"],
+        privacyStatus or os.getenv("PRIVACY_STATUS"),
     )
 
-    response = None
-    while response is None:
-        status, response = request.next_chunk()
-        if status:
-            print("Uploaded %d%%." % int(status.progress() * 100))
-    print("Upload Complete.")
+
+def upload_video(youtube, file, title, description, category, keywords, privacyStatus):
+    # 以前の呼び出し方との互換性のため、第1引数にはResumableUploaderのほか、
+    # 以前のYouTube APIのサービスも渡せる（その場合はget_uploader()で送信する）
+    uploader = youtube if isinstance(youtube, ResumableUploader) else get_uploader()
+    body = build_video_body(title, description, category, keywords, privacyStatus)
+
+    # Upload the video file in chunks, retrying and resuming on transient errors
+    return uploader.upload(file, body)
 
 
 if __name__ == "__main__":
+    # video_queue.pyがget_uploaderやbuild_clips_bodyを読み込むときに、パイプライン全体
+    # （numpyやpydubなど）を読み込まないよう、実行する時点で読み込む
+    from src.batch import BatchScheduler
+
     meta_topic = "1000年後の世界について"
     num_ideas = 5
 
-    youtube = get_authenticated_service()
-    category = os.getenv("CATEGORY")
+    # アップロードはバックグラウンドで行い、その間も次の動画のレンダリングを続ける
+    upload_queue = UploadQueue(get_uploader())
     privacyStatus = os.getenv("PRIVACY_STATUS")
 
-    ideas = generate_ideas(meta_topic, num_ideas)
+    # 制作済みの動画と似たアイデアは、スクリプトを生成する前に取り除いて生成し直す
+    ideas = generate_unique_ideas(meta_topic, num_ideas)
     print(colored("[+] Generating ideas...", "yellow"))  # Progress message
     print(ideas)
 
-    num_clips = 5
-    for idea in ideas["ideas"]:
-        video_subject = idea
-        output_file_path = f"./output/{video_subject}.mp4"
-        video_path, updated_clips = topic2video(video_subject, num_clips, output_file_path)
-
-        description = updated_clips["description"]
-        keywords = updated_clips["topic"]
-        category = updated_clips["category"]
+    def upload(video_path, updated_clips):
+        upload_queue.submit(video_path, build_clips_body(updated_clips, privacyStatus))
 
-        title = updated_clips["title"]
-        upload_video(youtube, video_path, title, description, category, keywords, privacyStatus)
+    # 動画Nのアップロード・エンコード中に、次の動画のスクリプトや音声・画像の生成を進める
+    num_clips = 5
+    scheduler = BatchScheduler(upload=upload)
+    scheduler.run(ideas["ideas"], num_clips, output_dir="./output")
+    upload_queue.close()
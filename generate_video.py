@@ -1,39 +1,46 @@
-from pathlib import Path
+from dotenv import load_dotenv
 from termcolor import colored
 
-from src.generate_ideas import generate_ideas
-from src.topic2text import generate_script
-from src.text2voice import generate_audio_for_clips
-from src.voice2video import process_json_data, create_combined_video_from_clips
-
-
-def topic2video(video_subject, num_clips, output_file_path):
-    # Create or clear the temp folder
-    temp_folder = Path("./temp")
-    temp_folder.mkdir(exist_ok=True)
-    for file in temp_folder.glob("*"):
-        file.unlink()
-
-    clips = generate_script(video_subject, num_clips)
-    print(colored("[+] Generating script...", "yellow"))
-    print(clips)
-
-    updated_clips = generate_audio_for_clips(clips)
-    print(colored("[+] Generating audio for clips...", "yellow"))
-    print(updated_clips)
-
-    updated_clips = process_json_data(updated_clips)
-    print(colored("[+] Processing JSON data...", "yellow"))
-    print(updated_clips)
-
-    video_path = create_combined_video_from_clips(
-        updated_clips, output_file_path)
-    print(colored("[+] Creating combined video...", "yellow"))
-
-    # Delete temporary files
-    for file in temp_folder.glob("*"):
-        file.unlink()
-
+from src.batch import BatchScheduler
+from src.dedup import record_produced
+from src.generate_ideas import generate_unique_ideas
+from src.manifest import Manifest, job_id_for
+from src.pipeline import prepare_script, prepare_assets, render_video
+from src.tracing import trace_job
+from src.workspace import Workspace
+
+# Load environment variables from .env file
+load_dotenv()
+
+
+def topic2video(
+    video_subject, num_clips, output_file_path, render_engine=None, render_profile=None
+):
+    # ジョブ専用のワークスペースを作成する。途中で失敗した場合はワークスペースを残し、
+    # 次回の実行ではマニフェストに記録された生成物を再利用して続きから再開する
+    job_id = job_id_for(video_subject, num_clips)
+    workspace = Workspace.create(job_id=job_id)
+
+    # 同じ主題のジョブが実行中の場合は、そのワークスペースを壊さないよう失敗する
+    with workspace.lock():
+        manifest = Manifest(workspace)
+
+        # ステージごとの所要時間などを./traces/<job_id>.jsonlに記録する
+        with trace_job(job_id):
+            clips = prepare_script(video_subject, num_clips, manifest, workspace)
+            if clips is None:
+                raise ValueError(f"スクリプトの生成に失敗しました: {video_subject}")
+            updated_clips = prepare_assets(clips, workspace, manifest, render_profile)
+            # "per_clip"はクリップごとにMP4を作って結合、"single_pass"は1回のffmpegで直接出力
+            # render_profileは画質と速度のプリセット（"quality"、"balanced"、"fast"、"square"）
+            video_path = render_video(
+                updated_clips, output_file_path, workspace, render_engine, manifest,
+                render_profile)
+
+        # 次回以降のバッチで似たアイデアを制作しないよう記録する
+        record_produced(video_subject, updated_clips)
+        # 成功したら、このジョブの中間ファイルだけを削除する
+        workspace.cleanup()
     return video_path, updated_clips
 
 
@@ -42,15 +49,13 @@ if __name__ == "__main__":
     meta_topic = "自転車で走るの気持ちい場所"
     # 何本の動画アイデアを生成するか指定
     num_ideas = 3
-    ideas = generate_ideas(meta_topic, num_ideas)
+    # 制作済みの動画と似たアイデアは、スクリプトを生成する前に取り除いて生成し直す
+    ideas = generate_unique_ideas(meta_topic, num_ideas)
     print(colored("[+] Generating ideas...", "yellow"))
     print(ideas)
 
     # アイデアの数だけ動画を生成、具体的なトピックはgpt APIで生成
-    for idea in ideas["ideas"]:
-        video_subject = idea
-        # １動画あたりのクリップ数
-        num_clips = 5
-        output_file_path = f"./output/{video_subject}.mp4"
-        video_path, updated_clips = topic2video(
-            video_subject, num_clips, output_file_path)
+    # 動画Nのエンコード中に次の動画のスクリプトや音声・画像の生成を進める
+    # １動画あたりのクリップ数
+    num_clips = 5
+    jobs = BatchScheduler().run(ideas["ideas"], num_clips, output_dir="./output")
@@ -0,0 +1,274 @@
+import io
+import math
+import wave
+from typing import List, Tuple
+
+import numpy as np
+from pydub import AudioSegment
+
+# 音声を結合・エンコードする際のPCM形式
+SAMPLE_RATE = 44100
+CHANNELS = 2
+SAMPLE_WIDTH = 2  # 16bit
+
+
+def normalize_format(segment: AudioSegment) -> AudioSegment:
+    """
+    音声をエンコーダに渡すPCM形式（44.1kHz、ステレオ、16bit）に揃えます。
+
+    Args:
+        segment (AudioSegment): 変換する音声。
+
+    Returns:
+        AudioSegment: 変換された音声。
+    """
+    return (
+        segment.set_frame_rate(SAMPLE_RATE)
+        .set_channels(CHANNELS)
+        .set_sample_width(SAMPLE_WIDTH)
+    )
+
+
+def to_wav_bytes(segment: AudioSegment) -> bytes:
+    """
+    音声をWAV形式のバイト列に変換します。ffmpegの標準入力にそのまま渡せます。
+
+    Args:
+        segment (AudioSegment): 変換する音声。
+
+    Returns:
+        bytes: WAV形式の音声データ。
+    """
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(segment.channels)
+        wav_file.setsampwidth(segment.sample_width)
+        wav_file.setframerate(segment.frame_rate)
+        wav_file.writeframes(segment.raw_data)
+    return buffer.getvalue()
+
+
+def to_samples(segment: AudioSegment) -> np.ndarray:
+    """
+    音声をエンコーダに渡すPCM形式のサンプル配列に変換します。
+
+    Args:
+        segment (AudioSegment): 変換する音声。
+
+    Returns:
+        np.ndarray: 形状が(フレーム数, CHANNELS)のint16配列。
+    """
+    segment = normalize_format(segment)
+    return np.frombuffer(segment.raw_data, dtype=np.int16).reshape(-1, CHANNELS)
+
+
+def to_segment(samples: np.ndarray) -> AudioSegment:
+    """
+    サンプル配列をAudioSegmentに変換します。
+
+    Args:
+        samples (np.ndarray): 形状が(フレーム数, CHANNELS)のint16配列。
+
+    Returns:
+        AudioSegment: 変換された音声。
+    """
+    return AudioSegment(
+        data=np.ascontiguousarray(samples, dtype=np.int16).tobytes(),
+        sample_width=SAMPLE_WIDTH,
+        frame_rate=SAMPLE_RATE,
+        channels=CHANNELS,
+    )
+
+
+def decode_wav(data: bytes) -> np.ndarray:
+    """
+    WAV形式のバイト列を、エンコーダに渡すPCM形式のサンプル配列に変換します。
+
+    TTSサーバーの応答によってサンプルレートやチャンネル数が異なっても、
+    SAMPLE_RATEとCHANNELSに揃えます。
+
+    Args:
+        data (bytes): WAV形式の音声データ。
+
+    Returns:
+        np.ndarray: 形状が(フレーム数, CHANNELS)のint16配列。
+    """
+    try:
+        with wave.open(io.BytesIO(data), "rb") as wav_file:
+            channels = wav_file.getnchannels()
+            sample_width = wav_file.getsampwidth()
+            frame_rate = wav_file.getframerate()
+            frames = wav_file.readframes(wav_file.getnframes())
+    except (wave.Error, EOFError):
+        # 浮動小数点形式など、waveモジュールで読めない形式はpydubで変換する
+        return to_samples(AudioSegment.from_file(io.BytesIO(data), format="wav"))
+
+    if sample_width == 1:
+        samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) * 256
+    elif sample_width == 2:
+        samples = np.frombuffer(frames, dtype="<i2").astype(np.float32)
+    elif sample_width == 4:
+        samples = np.frombuffer(frames, dtype="<i4").astype(np.float32) / 65536
+    else:
+        return to_samples(AudioSegment.from_file(io.BytesIO(data), format="wav"))
+    samples = samples.reshape(-1, channels)
+
+    # チャンネル数を揃える
+    if channels == 1:
+        samples = np.repeat(samples, CHANNELS, axis=1)
+    elif channels > CHANNELS:
+        samples = samples[:, :CHANNELS]
+
+    # サンプルレートを揃える（線形補間）
+    if frame_rate != SAMPLE_RATE and len(samples) > 0:
+        num_frames = int(round(len(samples) * SAMPLE_RATE / frame_rate))
+        positions = np.arange(num_frames) * (frame_rate / SAMPLE_RATE)
+        source = np.arange(len(samples))
+        samples = np.stack(
+            [np.interp(positions, source, samples[:, ch]) for ch in range(CHANNELS)],
+            axis=1,
+        )
+
+    return np.clip(np.round(samples), -32768, 32767).astype(np.int16)
+
+
+def concatenate(segments: List[np.ndarray], gap_ms: int = 0) -> np.ndarray:
+    """
+    サンプル配列を、間に無音を挟んで1回のコピーで結合します。
+
+    出力は最初に必要な長さだけ無音で確保し、各配列をその位置に書き込みます。
+
+    Args:
+        segments (List[np.ndarray]): 結合するサンプル配列。
+        gap_ms (int): 配列の間に挟む無音の長さ（ミリ秒）。
+
+    Returns:
+        np.ndarray: 結合されたサンプル配列。
+    """
+    gap_frames = SAMPLE_RATE * gap_ms // 1000
+    total = sum(len(s) for s in segments) + gap_frames * max(0, len(segments) - 1)
+    output = np.zeros((total, CHANNELS), dtype=np.int16)
+
+    offset = 0
+    for segment in segments:
+        output[offset:offset + len(segment)] = segment
+        offset += len(segment) + gap_frames
+    return output
+
+
+def _biquad_response(b: Tuple[float, float, float], a: Tuple[float, float, float], z1: np.ndarray):
+    # z1はz^-1の値（e^-jω）
+    return (b[0] + b[1] * z1 + b[2] * z1 ** 2) / (a[0] + a[1] * z1 + a[2] * z1 ** 2)
+
+
+def k_weighting_response(num_fft: int, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """
+    ITU-R BS.1770のK特性フィルタ（高域シェルフとハイパスの2段）の周波数応答を計算します。
+
+    係数はlibebur128と同じ式で任意のサンプルレートについて求めます。
+
+    Args:
+        num_fft (int): FFTの長さ。
+        sample_rate (int): サンプルレート。
+
+    Returns:
+        np.ndarray: np.fft.rfftの各周波数での複素応答。
+    """
+    z1 = np.exp(-2j * np.pi * np.arange(num_fft // 2 + 1) / num_fft)
+
+    # 1段目: 頭部による音響効果を模した高域シェルフ
+    f0, gain_db, q = 1681.974450955533, 3.999843853973347, 0.7071752369554196
+    k = math.tan(math.pi * f0 / sample_rate)
+    vh = 10 ** (gain_db / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = _biquad_response(
+        ((vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0),
+        (1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0),
+        z1,
+    )
+
+    # 2段目: RLB特性のハイパス
+    f0, q = 38.13547087602444, 0.5003270373238773
+    k = math.tan(math.pi * f0 / sample_rate)
+    a0 = 1 + k / q + k * k
+    highpass = _biquad_response(
+        (1.0, -2.0, 1.0), (1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0), z1)
+    return shelf * highpass
+
+
+def measure_loudness(samples: np.ndarray, sample_rate: int = SAMPLE_RATE) -> Tuple[float, float]:
+    """
+    ITU-R BS.1770に従って、サンプル配列のインテグレーテッドラウドネスとサンプルピークを計測します。
+
+    K特性フィルタはFFTで周波数領域に変換して一度に適用し（IIRフィルタの応答が減衰するまで
+    ゼロで埋めるため、時間領域で順に計算した結果とほぼ一致します）、400msのブロックの
+    平均二乗値は累積和から全てのブロックを同時に求めます。ffmpegのloudnormのように
+    音声をデコードし直す必要はありません。
+
+    Args:
+        samples (np.ndarray): 形状が(フレーム数, チャンネル数)のint16配列。
+        sample_rate (int): サンプルレート。
+
+    Returns:
+        Tuple[float, float]: (インテグレーテッドラウドネス（LUFS）, サンプルピーク（dBFS）)。
+            ゲートを通るブロックがない（ほぼ無音の）場合、ラウドネスは-inf。
+    """
+    x = samples.astype(np.float64) / 32768
+    if len(x) == 0:
+        return -math.inf, -math.inf
+    peak = float(np.max(np.abs(x)))
+    peak_db = 20 * math.log10(peak) if peak > 0 else -math.inf
+
+    # K特性フィルタ（0.5秒分をゼロで埋めて、循環畳み込みの影響をなくす）
+    num_fft = 1 << int(len(x) + sample_rate // 2 - 1).bit_length()
+    spectrum = np.fft.rfft(x, num_fft, axis=0) * k_weighting_response(num_fft, sample_rate)[:, None]
+    y = np.fft.irfft(spectrum, num_fft, axis=0)[:len(x)]
+
+    # 400msのブロック（75%ずつ重ねる）ごとのチャンネル別の平均二乗値
+    block = int(0.4 * sample_rate)
+    step = int(0.1 * sample_rate)
+    energy = np.concatenate([np.zeros((1, y.shape[1])), np.cumsum(y * y, axis=0)])
+    if len(y) < block:
+        starts = np.array([0])
+        block = len(y)
+    else:
+        starts = np.arange(0, len(y) - block + 1, step)
+    power = ((energy[starts + block] - energy[starts]) / block).sum(axis=1)
+
+    # 絶対ゲート（-70 LUFS）と相対ゲート（平均より10 LU低い）
+    with np.errstate(divide="ignore"):
+        loudness = -0.691 + 10 * np.log10(power)
+    gated = loudness > -70
+    if not gated.any():
+        return -math.inf, peak_db
+    relative = -0.691 + 10 * math.log10(power[gated].mean()) - 10
+    gated &= loudness > relative
+    return -0.691 + 10 * math.log10(power[gated].mean()), peak_db
+
+
+def normalization_gain(
+    samples: np.ndarray,
+    target_lufs: float,
+    peak_ceiling_db: float = -1.0,
+    max_gain_db: float = 20.0,
+) -> float:
+    """
+    音声を目標のラウドネスにするためのゲインを計算します。
+
+    ゲインを加えてもサンプルピークがpeak_ceiling_dbを超えないよう、また無音に近い音声を
+    極端に増幅しないよう制限します。
+
+    Args:
+        samples (np.ndarray): 形状が(フレーム数, チャンネル数)のint16配列。
+        target_lufs (float): 目標のインテグレーテッドラウドネス（LUFS）。
+        peak_ceiling_db (float): ゲインを加えた後のサンプルピークの上限（dBFS）。
+        max_gain_db (float): ゲインの上限（dB）。
+
+    Returns:
+        float: 加えるゲイン（dB）。計測できない場合は0。
+    """
+    loudness, peak_db = measure_loudness(samples)
+    if math.isinf(loudness):
+        return 0.0
+    return min(target_lufs - loudness, peak_ceiling_db - peak_db, max_gain_db)
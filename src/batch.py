@@ -0,0 +1,235 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, List
+
+from termcolor import colored
+
+from src.dedup import record_produced
+from src.manifest import Manifest, job_id_for
+from src.pipeline import prepare_script, prepare_assets, render_video
+from src.topic2text import generate_scripts
+from src.tracing import propagate, trace_job
+from src.workspace import Workspace, WorkspaceInUseError
+
+
+@dataclass
+class VideoJob:
+    """
+    バッチ内の1本の動画の進捗。
+
+    Attributes:
+        index (int): バッチ内の番号（0から始まる）。
+        video_subject (str): ビデオの主題。
+        output_file_path (str): 完成した動画を保存するパス。
+        status (str): 現在のステージ（pending, script, assets, render, upload, done, failed）。
+        timings (dict): ステージごとの所要時間（秒）。
+        video_path (str): 完成した動画のパス。
+        clips (dict): 生成されたスクリプトとクリップ情報。
+        error (str): 失敗した場合のエラー内容。
+    """
+
+    index: int
+    video_subject: str
+    output_file_path: str
+    status: str = "pending"
+    timings: dict = field(default_factory=dict)
+    video_path: str = None
+    clips: dict = None
+    error: str = None
+
+
+class BatchScheduler:
+    """
+    複数の動画のステージを重ねて実行するスケジューラ。
+
+    スクリプト生成・音声/画像生成・アップロードはネットワーク用のプールで、
+    エンコードはCPU用のプールで実行します。動画Nのエンコード中に、
+    動画N+1のスクリプト生成や動画N+2の音声/画像生成を進めます。
+    同時に進行する動画の数はmax_in_flightで制限します。
+    スクリプトは最初にgenerate_scriptsで数件ずつまとめて生成し、
+    失敗した主題だけを動画ごとに生成し直します。
+
+    Args:
+        network_workers (int): ネットワーク用のプールのスレッド数。
+            省略時は環境変数BATCH_NETWORK_WORKERS（既定値4）。
+        cpu_workers (int): エンコード用のプールのスレッド数。
+            省略時は環境変数BATCH_CPU_WORKERS（既定値1）。
+        max_in_flight (int): 同時に進行する動画の上限。省略時はcpu_workers + 2。
+        render_engine (str): render_videoに渡すレンダリング方式。
+        render_profile (str): render_videoに渡すエンコード設定の名前。
+        script_batch_size (int): 1リクエストでまとめて生成するスクリプトの数。
+            1以下の場合は動画ごとに生成します。省略時は環境変数LLM_SCRIPT_BATCH_SIZE（既定値5）。
+        upload (Callable[[str, dict], None]): 完成した動画のパスとクリップ情報を受け取り
+            アップロードする関数。Noneの場合はアップロードしません。
+    """
+
+    def __init__(
+        self,
+        network_workers: int = None,
+        cpu_workers: int = None,
+        max_in_flight: int = None,
+        render_engine: str = None,
+        render_profile: str = None,
+        upload: Callable[[str, dict], None] = None,
+        script_batch_size: int = None,
+    ):
+        if network_workers is None:
+            network_workers = int(os.getenv("BATCH_NETWORK_WORKERS", "4"))
+        if cpu_workers is None:
+            cpu_workers = int(os.getenv("BATCH_CPU_WORKERS", "1"))
+        self.network_workers = max(1, network_workers)
+        self.cpu_workers = max(1, cpu_workers)
+        self.max_in_flight = max(1, max_in_flight or self.cpu_workers + 2)
+        self.render_engine = render_engine
+        self.render_profile = render_profile
+        self.upload = upload
+        if script_batch_size is None:
+            script_batch_size = int(os.getenv("LLM_SCRIPT_BATCH_SIZE", "5"))
+        self.script_batch_size = script_batch_size
+        self._lock = threading.Lock()
+
+    def run(
+        self, video_subjects: List[str], num_clips: int, output_dir: str = "./output"
+    ) -> List[VideoJob]:
+        """
+        全ての主題の動画を生成します。
+
+        Args:
+            video_subjects (List[str]): ビデオの主題のリスト。
+            num_clips (int): 1動画あたりのクリップ数。
+            output_dir (str): 完成した動画を保存するディレクトリ。
+
+        Returns:
+            List[VideoJob]: 主題の順番通りの各動画の結果。
+        """
+        jobs = [
+            VideoJob(i, subject, str(Path(output_dir) / f"{subject}.mp4"))
+            for i, subject in enumerate(video_subjects)
+        ]
+        started = time.perf_counter()
+
+        with ThreadPoolExecutor(
+            self.network_workers, thread_name_prefix="network"
+        ) as self._network_pool, ThreadPoolExecutor(
+            self.cpu_workers, thread_name_prefix="cpu"
+        ) as self._cpu_pool, ThreadPoolExecutor(
+            self.max_in_flight, thread_name_prefix="video"
+        ) as coordinators:
+            self._scripts = None
+            if self.script_batch_size > 1:
+                self._scripts = self._network_pool.submit(
+                    self._generate_scripts, jobs, num_clips)
+            # 主題の順番に開始し、同時に進行する動画の数はコーディネータの数で制限する
+            futures = [
+                coordinators.submit(self._run_job, job, num_clips, len(jobs)) for job in jobs
+            ]
+            for future in futures:
+                future.result()
+
+        elapsed = time.perf_counter() - started
+        self._report_summary(jobs, elapsed)
+        return jobs
+
+    def _run_job(self, job: VideoJob, num_clips: int, total: int):
+        # 失敗したジョブのワークスペースは残し、次回の実行で続きから再開する
+        job_id = job_id_for(job.video_subject, num_clips)
+        workspace = Workspace.create(job_id=job_id)
+        try:
+            # 同じ主題の動画（バッチ内の重複や別のプロセスのジョブ）と同時には実行しない
+            with workspace.lock():
+                manifest = Manifest(workspace)
+                with trace_job(job_id):
+                    self._run_stages(job, num_clips, total, workspace, manifest)
+        except WorkspaceInUseError as e:
+            job.error = str(e)
+            self._set_status(job, total, "failed")
+
+    def _run_stages(self, job, num_clips, total, workspace, manifest):
+        try:
+            script = None
+            if self._scripts is not None:
+                script = self._scripts.result().get(job.index)
+            clips = self._run_stage(
+                job, total, "script", self._network_pool, prepare_script,
+                job.video_subject, num_clips, manifest, workspace, script,
+            )
+            if clips is None:
+                raise ValueError("スクリプトの生成に失敗しました。")
+            job.clips = clips
+            self._run_stage(
+                job, total, "assets", self._network_pool, prepare_assets,
+                clips, workspace, manifest, self.render_profile,
+            )
+            job.video_path = self._run_stage(
+                job, total, "render", self._cpu_pool, render_video,
+                clips, job.output_file_path, workspace, self.render_engine, manifest,
+                self.render_profile,
+            )
+            if self.upload is not None:
+                self._run_stage(
+                    job, total, "upload", self._network_pool, self.upload, job.video_path, clips
+                )
+            # 次回以降のバッチで似たアイデアを制作しないよう記録する
+            record_produced(job.video_subject, clips)
+            # 全てのステージが成功したら、このジョブの中間ファイルだけを削除する
+            workspace.cleanup()
+            self._set_status(job, total, "done")
+        except Exception as e:
+            job.error = str(e)
+            self._set_status(job, total, "failed")
+
+    def _generate_scripts(self, jobs: List[VideoJob], num_clips: int) -> dict:
+        # チェックポイントにスクリプトがある動画は除き、残りをまとめて生成する
+        # （ロックを取らずに読むだけで、マニフェストは書き換えない）
+        pending = [
+            job for job in jobs
+            if Manifest(Workspace.create(
+                job_id=job_id_for(job.video_subject, num_clips))).load_script() is None
+        ]
+        if not pending:
+            return {}
+        try:
+            scripts = generate_scripts(
+                [job.video_subject for job in pending], num_clips,
+                batch_size=self.script_batch_size,
+            )
+        except Exception as e:
+            # 動画ごとの生成に切り替える
+            print(colored(f"[-] Batched script generation failed: {e}", "red"))
+            return {}
+        return {job.index: script for job, script in zip(pending, scripts)}
+
+    def _run_stage(self, job, total, stage, pool, fn, *args):
+        self._set_status(job, total, stage)
+        started = time.perf_counter()
+        try:
+            # ワーカースレッドで開始したスパンもこのジョブのトレースに記録する
+            return pool.submit(propagate(fn), *args).result()
+        finally:
+            job.timings[stage] = time.perf_counter() - started
+
+    def _set_status(self, job: VideoJob, total: int, status: str):
+        job.status = status
+        timings = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in job.timings.items())
+        color = {"done": "green", "failed": "red"}.get(status, "cyan")
+        message = f"[video {job.index + 1}/{total}] {status}: {job.video_subject}"
+        if timings:
+            message += f" ({timings})"
+        if job.error:
+            message += f" - {job.error}"
+        with self._lock:
+            print(colored(message, color))
+
+    def _report_summary(self, jobs: List[VideoJob], elapsed: float):
+        done = sum(job.status == "done" for job in jobs)
+        videos_per_hour = done / elapsed * 3600 if elapsed > 0 else 0
+        print(colored(
+            f"[+] Batch finished: {done}/{len(jobs)} videos in {elapsed:.1f}s "
+            f"({videos_per_hour:.1f} videos/hour)",
+            "green" if done == len(jobs) else "yellow",
+        ))
+
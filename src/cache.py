@@ -0,0 +1,347 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+# 他のプロセスが書き込んだ分は、インスタンスが数えている合計サイズに含まれない。
+# そのため、このインスタンスがmax_bytesのこの割合を書き込むたびにディレクトリを数え直す
+# （複数のプロセスで使っても、上限を超える量はプロセスごとにこの割合までになる）
+DISK_CACHE_RESCAN_FRACTION = 0.1
+
+
+def make_cache_key(**params) -> str:
+    """
+    パラメータの組み合わせからキャッシュのキーを生成します。
+
+    Args:
+        **params: キーに含める値。JSONに変換できる必要があります。
+
+    Returns:
+        str: パラメータのSHA-256ハッシュ（16進数）。
+    """
+    payload = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def link_or_copy(source: str, destination: str):
+    """
+    ファイルのハードリンクを作成します。作成できない場合（別のファイルシステムなど）はコピーします。
+
+    Args:
+        source (str): 元のファイルのパス。
+        destination (str): 作成するファイルのパス。
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class DiskCache:
+    """
+    ディスク上に内容を保存する、容量上限付きのキャッシュ。
+
+    エントリはキーのハッシュをファイル名として保存されます。書き込みは一時ファイルを
+    経由したアトミックな置き換えで行うため、同じディレクトリを複数のプロセスやスレッドから
+    同時に使用できます。合計サイズがmax_bytesを超えると、最後に使用された時刻が
+    古いものから削除します（LRU）。
+
+    Args:
+        directory (str): キャッシュを保存するディレクトリ。
+        max_bytes (int): キャッシュ全体の容量上限（バイト）。
+        suffix (str): エントリのファイル名に付ける拡張子。
+    """
+
+    def __init__(self, directory: str, max_bytes: int, suffix: str = ""):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        self._written_since_scan = 0
+
+    def path_for(self, key: str) -> Path:
+        """
+        キーに対応するエントリのパスを返します。
+
+        Args:
+            key (str): キャッシュのキー。
+
+        Returns:
+            Path: エントリのファイルパス（存在するとは限りません）。
+        """
+        return self.directory / key[:2] / f"{key}{self.suffix}"
+
+    def get_path(self, key: str) -> Path:
+        """
+        キーに対応するエントリのパスを返し、使用時刻を更新します。
+
+        Args:
+            key (str): キャッシュのキー。
+
+        Returns:
+            Path: エントリのファイルパス。存在しない場合はNone。
+        """
+        path = self.path_for(key)
+        try:
+            os.utime(path)  # LRUのために最終使用時刻を更新する
+        except FileNotFoundError:
+            self._count(hit=False)
+            return None
+        self._count(hit=True)
+        return path
+
+    def get(self, key: str) -> bytes:
+        """
+        キーに対応するエントリの内容を返します。
+
+        Args:
+            key (str): キャッシュのキー。
+
+        Returns:
+            bytes: エントリの内容。存在しない場合はNone。
+        """
+        path = self.get_path(key)
+        if path is None:
+            return None
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            # 読み込みの直前に別のプロセスが削除した場合
+            return None
+
+    def put(self, key: str, data: bytes) -> Path:
+        """
+        エントリをアトミックに書き込み、必要に応じて古いエントリを削除します。
+
+        Args:
+            key (str): キャッシュのキー。
+            data (bytes): 保存する内容。
+
+        Returns:
+            Path: 保存したエントリのファイルパス。
+        """
+        path = self.path_for(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        replaced = _file_size(path)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+
+        self._added(len(data) - replaced)
+        self.evict()
+        return path
+
+    def put_file(self, key: str, source: str) -> Path:
+        """
+        ファイルをエントリとしてアトミックに登録し、必要に応じて古いエントリを削除します。
+
+        内容をメモリに読み込まないよう、同じファイルシステム上ではハードリンクを作成し、
+        それ以外の場合はコピーします。
+
+        Args:
+            key (str): キャッシュのキー。
+            source (str): 登録するファイルのパス。
+
+        Returns:
+            Path: 保存したエントリのファイルパス。
+        """
+        path = self.path_for(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        replaced = _file_size(path)
+        tmp_path = path.parent / f"{uuid.uuid4().hex}.tmp"
+        try:
+            link_or_copy(source, tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+        self._added(path.stat().st_size - replaced)
+        self.evict()
+        return path
+
+    def evict(self):
+        """
+        合計サイズがmax_bytesを超えている場合、最終使用時刻の古いエントリから削除します。
+        """
+        with self._lock:
+            if (
+                self._total_bytes is not None
+                and self._total_bytes <= self.max_bytes
+                and self._written_since_scan <= self.max_bytes * DISK_CACHE_RESCAN_FRACTION
+            ):
+                return
+
+            entries = []
+            total = 0
+            for path in self.directory.glob(f"*/*{self.suffix}"):
+                if path.suffix == ".tmp":
+                    continue
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+            self._total_bytes = total
+            self._written_since_scan = 0
+
+    def stats(self) -> dict:
+        """
+        キャッシュのヒット数とミス数を返します。
+
+        Returns:
+            dict: "hits"と"misses"を含む辞書。
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    def _added(self, size: int):
+        # 書き込んだ分（置き換えた場合は差分）を合計サイズに加える
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += size
+            self._written_since_scan += max(0, size)
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+def _file_size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+class ResponseCache:
+    """
+    SQLiteに保存する、有効期限付きのレスポンスキャッシュ。
+
+    1つのデータベースファイルを複数のプロセスやスレッドから同時に使用できます。
+
+    Args:
+        path (str): SQLiteデータベースファイルのパス。
+        ttl (float): エントリの有効期限（秒）。Noneの場合は期限なし。
+    """
+
+    def __init__(self, path: str, ttl: float = None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:  # 正常終了時にコミット、例外時にロールバック
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str, ttl: float = None) -> str:
+        """
+        キーに対応する有効なレスポンスを返します。
+
+        Args:
+            key (str): キャッシュのキー。
+            ttl (float): このエントリに適用する有効期限（秒）。省略時はインスタンスのttl。
+
+        Returns:
+            str: 保存されたレスポンス。存在しないか期限切れの場合はNone。
+        """
+        ttl = self.ttl if ttl is None else ttl
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or (ttl is not None and time.time() - row[1] > ttl):
+            self._count(hit=False)
+            return None
+        self._count(hit=True)
+        return row[0]
+
+    def put(self, key: str, response: str, model: str = None):
+        """
+        レスポンスを保存します。同じキーのエントリは上書きされます。
+
+        Args:
+            key (str): キャッシュのキー。
+            response (str): 保存するレスポンス。
+            model (str): レスポンスを生成したモデル名。
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, model, response, time.time()),
+            )
+
+    def delete(self, key: str):
+        """
+        キーに対応するエントリを削除します。
+
+        Args:
+            key (str): キャッシュのキー。
+        """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def stats(self) -> dict:
+        """
+        キャッシュのヒット数とミス数を返します。
+
+        Returns:
+            dict: "hits"と"misses"を含む辞書。
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
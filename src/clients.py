@@ -0,0 +1,89 @@
+import os
+import threading
+from typing import Callable
+
+# プロセス全体で共有するクライアント（名前ごとに最初に使われた時点で作成する）
+_clients = {}
+# 名前ごとの作成用のロック。_clients_lockはこの辞書を更新する間だけ取る
+_client_locks = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(name: str, factory: Callable[[], object]):
+    """
+    名前に対応する共有のクライアントを返します。まだなければfactoryで作成します。
+
+    モジュールの読み込み時にはクライアントを作成せず、重い依存関係（openaiなど）も
+    factoryの中で読み込むことで、src以下のモジュールを軽く読み込めるようにします。
+    同じ名前のクライアントは1回だけ作成します。
+
+    Args:
+        name (str): クライアントの名前。
+        factory (Callable[[], object]): クライアントを作成する関数。
+
+    Returns:
+        object: プロセス全体で共有するクライアント。
+    """
+    # 作成済みであればロックを取らずに返す
+    client = _clients.get(name)
+    if client is not None:
+        return client
+    # factoryは名前ごとのロックの中で実行する。作成に時間のかかるクライアントがあっても
+    # 他の名前のクライアントは待たず、factoryの中でget_clientを呼び出しても止まらない
+    with _clients_lock:
+        lock = _client_locks.setdefault(name, threading.Lock())
+    with lock:
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
+
+
+def get_openai_client():
+    """
+    OpenAIのクライアントを返します。
+
+    チャット・画像生成の全てのステージで1つのクライアントと接続プールを共有します。
+    プールの大きさは環境変数OPENAI_MAX_CONNECTIONS（既定値20）で指定します。
+
+    Returns:
+        OpenAI: プロセス全体で共有するクライアント。
+    """
+    def create():
+        import httpx
+        from openai import DefaultHttpxClient, OpenAI
+
+        max_connections = max(1, int(os.getenv("OPENAI_MAX_CONNECTIONS", "20")))
+        http_client = DefaultHttpxClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            )
+        )
+        return OpenAI(http_client=http_client)  # 環境変数からAPIキーを取得
+
+    return get_client("openai", create)
+
+
+def get_http_session(name: str, pool_size: int = 10, retries: int = 3):
+    """
+    接続をプールするrequestsのセッションを返します。
+
+    Args:
+        name (str): セッションの名前（用途ごとに別のプールを使います）。
+        pool_size (int): 1つのホストに対して保持する接続の数。最初の呼び出しの値を使います。
+        retries (int): 接続エラーの再試行の回数。
+
+    Returns:
+        requests.Session: プロセス全体で共有するセッション。
+    """
+    def create():
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        adapter = HTTPAdapter(pool_maxsize=max(1, pool_size), max_retries=retries)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    return get_client(f"http:{name}", create)
@@ -0,0 +1,266 @@
+import hashlib
+import os
+import random
+import sqlite3
+import time
+import unicodedata
+from array import array
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Tuple
+
+from src.clients import get_client
+
+# MinHashのハッシュ関数の数と、LSHのバンドの分け方（NUM_BANDS * BAND_ROWS == NUM_PERM）
+# 類似度がおおよそ(1 / NUM_BANDS) ** (1 / BAND_ROWS) ≒ 0.5以上のものが候補になる
+NUM_PERM = 64
+NUM_BANDS = 16
+BAND_ROWS = 4
+
+# 日本語は単語の区切りがないため、文字単位のn-gramで比較する
+SHINGLE_SIZE = 2
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+# ハッシュ関数の係数（保存したシグネチャと比較するため、乱数のシードを固定する）
+_rng = random.Random(20240101)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(NUM_PERM)
+]
+
+
+def normalize_text(text: str) -> str:
+    """
+    比較用に文章を正規化します（全角・半角の統一、小文字化、空白と記号の削除）。
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(
+        c for c in text if not unicodedata.category(c).startswith(("Z", "P", "S", "C"))
+    )
+
+
+def shingles(text: str) -> set:
+    """
+    正規化した文章の文字n-gramの集合を返します。
+    """
+    normalized = normalize_text(text)
+    if len(normalized) <= SHINGLE_SIZE:
+        return {normalized}
+    return {normalized[i:i + SHINGLE_SIZE] for i in range(len(normalized) - SHINGLE_SIZE + 1)}
+
+
+def minhash(text: str) -> List[int]:
+    """
+    文章のMinHashシグネチャを計算します。
+
+    2つのシグネチャで値が一致する割合は、文字n-gramの集合のJaccard係数の推定値になります。
+
+    Args:
+        text (str): 文章。
+
+    Returns:
+        List[int]: NUM_PERM個のハッシュ値。
+    """
+    hashes = [
+        int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little")
+        for shingle in shingles(text)
+    ]
+    return [
+        min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+        for a, b in _PERMUTATIONS
+    ]
+
+
+def band_hashes(signature: List[int]) -> List[int]:
+    """
+    シグネチャをバンドに分け、バンドごとのハッシュ（SQLiteの整数に収まる64ビット）を返します。
+    """
+    result = []
+    for band in range(NUM_BANDS):
+        rows = array("I", signature[band * BAND_ROWS:(band + 1) * BAND_ROWS]).tobytes()
+        digest = hashlib.blake2b(rows, digest_size=8).digest()
+        result.append(int.from_bytes(digest, "little", signed=True))
+    return result
+
+
+def similarity(a: List[int], b: List[int]) -> float:
+    """
+    2つのシグネチャからJaccard係数を推定します。
+    """
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+class IdeaIndex:
+    """
+    制作済みの動画のアイデアとタイトルを保存し、似たものを高速に検索するインデックス。
+
+    文字n-gramのMinHashをLSHのバンドに分けてSQLiteに保存します。検索では同じバンドの
+    ハッシュを持つ候補だけをインデックスで取り出してシグネチャを比較するため、
+    登録数が数万件になっても全件と比較しません。
+
+    Args:
+        path (str): SQLiteデータベースファイルのパス。
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS ideas (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    text TEXT NOT NULL,
+                    normalized TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    signature BLOB NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS bands (band INTEGER, hash INTEGER, idea_id INTEGER)")
+            conn.execute("CREATE INDEX IF NOT EXISTS bands_hash ON bands (band, hash)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ideas_normalized ON ideas (normalized)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:  # 正常終了時にコミット、例外時にロールバック
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, text: str, kind: str = "idea"):
+        """
+        制作済みのアイデアまたはタイトルを登録します。同じ文章（正規化後）が登録済みの場合は何もしません。
+
+        Args:
+            text (str): アイデアまたはタイトル。
+            kind (str): "idea"または"title"。
+        """
+        normalized = normalize_text(text)
+        if not normalized:
+            return
+        signature = minhash(text)
+        with self._connect() as conn:
+            if conn.execute(
+                "SELECT 1 FROM ideas WHERE normalized = ?", (normalized,)
+            ).fetchone():
+                return
+            idea_id = conn.execute(
+                "INSERT INTO ideas (text, normalized, kind, signature, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (text, normalized, kind, array("I", signature).tobytes(), time.time()),
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO bands (band, hash, idea_id) VALUES (?, ?, ?)",
+                [(band, value, idea_id) for band, value in enumerate(band_hashes(signature))],
+            )
+
+    def find(self, text: str, threshold: float = None) -> Tuple[str, float]:
+        """
+        登録済みの中から最も似ている文章を検索します。
+
+        Args:
+            text (str): 検索する文章。
+            threshold (float): 似ているとみなす類似度（Jaccard係数の推定値）。
+                省略時は環境変数IDEA_DUPLICATE_THRESHOLD（既定値0.6）。
+
+        Returns:
+            Tuple[str, float]: 最も似ている登録済みの文章と類似度。threshold以上のものがなければNone。
+        """
+        if threshold is None:
+            threshold = float(os.getenv("IDEA_DUPLICATE_THRESHOLD", "0.6"))
+        normalized = normalize_text(text)
+        signature = minhash(text)
+        conditions = " OR ".join(["(band = ? AND hash = ?)"] * NUM_BANDS)
+        params = [value for pair in enumerate(band_hashes(signature)) for value in pair]
+        with self._connect() as conn:
+            exact = conn.execute(
+                "SELECT text FROM ideas WHERE normalized = ?", (normalized,)
+            ).fetchone()
+            if exact is not None:
+                return exact[0], 1.0
+            rows = conn.execute(
+                "SELECT text, signature FROM ideas WHERE id IN "
+                f"(SELECT idea_id FROM bands WHERE {conditions})",
+                params,
+            ).fetchall()
+
+        best = None
+        for candidate, blob in rows:
+            score = similarity(signature, array("I", blob).tolist())
+            if score >= threshold and (best is None or score > best[1]):
+                best = (candidate, score)
+        return best
+
+    def count(self) -> int:
+        """
+        登録済みの件数を返します。
+        """
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM ideas").fetchone()[0]
+
+
+def get_idea_index() -> IdeaIndex:
+    """
+    制作済みのアイデアのインデックスを返します。
+
+    保存先は環境変数IDEA_INDEX_PATHで指定します。
+
+    Returns:
+        IdeaIndex: プロセス全体で共有するインデックス。IDEA_INDEX=0の場合はNone。
+    """
+    if os.getenv("IDEA_INDEX", "1") == "0":
+        return None
+    return get_client(
+        "idea_index",
+        lambda: IdeaIndex(os.getenv("IDEA_INDEX_PATH", "./cache/ideas.sqlite3")),
+    )
+
+
+def filter_duplicates(ideas: List[str], index: IdeaIndex = None) -> Tuple[List[str], List[str]]:
+    """
+    制作済みのものや、リスト内で先に出てきたものと似ているアイデアを取り除きます。
+
+    Args:
+        ideas (List[str]): アイデアのリスト。
+        index (IdeaIndex): 制作済みのアイデアのインデックス。Noneの場合はリスト内の重複だけを取り除きます。
+
+    Returns:
+        Tuple[List[str], List[str]]: (残ったアイデア, 取り除いたアイデア)
+    """
+    threshold = float(os.getenv("IDEA_DUPLICATE_THRESHOLD", "0.6"))
+    unique, duplicates, signatures = [], [], []
+    for idea in ideas:
+        signature = minhash(idea)
+        if (index is not None and index.find(idea, threshold) is not None) or any(
+            similarity(signature, other) >= threshold for other in signatures
+        ):
+            duplicates.append(idea)
+            continue
+        unique.append(idea)
+        signatures.append(signature)
+    return unique, duplicates
+
+
+def record_produced(video_subject: str, clips: dict = None):
+    """
+    完成した動画のアイデアとタイトルをインデックスに登録します。
+
+    Args:
+        video_subject (str): ビデオの主題（アイデア）。
+        clips (dict): 生成されたスクリプト。"title"があれば合わせて登録します。
+    """
+    index = get_idea_index()
+    if index is None:
+        return
+    index.add(video_subject, kind="idea")
+    title = (clips or {}).get("title")
+    if isinstance(title, str) and title:
+        index.add(title, kind="title")
@@ -1,13 +1,49 @@
-from openai import OpenAI
 import json
+import os
 from termcolor import colored
 
-client = OpenAI()
+from src.clients import get_openai_client
+from src.dedup import filter_duplicates, get_idea_index
+from src.llm import create_json_completion
 
 
-def generate_ideas(meta_topic: str, num_ideas: int) -> dict:
+def validate_ideas(ideas: dict) -> bool:
+    """
+    生成されたアイデアが期待する形式かどうかを検証する。
+
+    Args:
+        ideas (dict): 生成されたアイデア
+
+    Returns:
+        bool: "ideas"が空でない文字列のリストであればTrue
+    """
+    return (
+        isinstance(ideas, dict)
+        and isinstance(ideas.get("ideas"), list)
+        and len(ideas["ideas"]) > 0
+        and all(isinstance(idea, str) and idea for idea in ideas["ideas"])
+    )
+
+
+def generate_ideas(
+    meta_topic: str,
+    num_ideas: int,
+    use_cache: bool = None,
+    refresh: bool = False,
+    exclude: list = None,
+) -> dict:
     """
     メタトピックについて、アイデアを生成する。
+
+    Args:
+        meta_topic (str): メタトピック
+        num_ideas (int): 生成するアイデアの個数
+        use_cache (bool): レスポンスキャッシュを使用するかどうか（省略時は環境変数LLM_CACHE）
+        refresh (bool): Trueの場合はキャッシュを読まずに生成し直す
+        exclude (list): 似たものを避けるアイデアのリスト
+
+    Returns:
+        dict: 生成されたアイデア
     """
     # プロンプトの構築
     prompt_valuables = f"""
@@ -16,6 +52,12 @@ def generate_ideas(meta_topic: str, num_ideas: int) -> dict:
     主題: {meta_topic}
     出力するアイデアの個数: {num_ideas}
     """
+    if exclude:
+        avoid = "\n".join(f"    - {idea}" for idea in exclude)
+        prompt_valuables += f"""
+    次のアイデアは制作済みなので、これらと似ていないアイデアにしてください。
+{avoid}
+    """
 
     prompt_format = """
     次の形式のjsonで出力するようにしてください。
@@ -28,23 +70,26 @@ def generate_ideas(meta_topic: str, num_ideas: int) -> dict:
         "実は宇宙人はすでに紛れ込んでいる", "ドラえもんが怒った時に何が起こるか", ...
     ]
     """
-    response = client.chat.completions.create(
-        model="gpt-4-1106-preview",
-        # model="gpt-3.5-turbo-1106",
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
-            {
-                "role": "user",
-                "content": f"次の文章からJSONを生成してください。\n{prompt_valuables}{prompt_format}",
-            },
-        ],
-        response_format={"type": "json_object"},
-    )
-
-    script = response.choices[0].message.content.strip()
     # scriptをjsonに変換
     try:
-        script = json.loads(script)
+        script = create_json_completion(
+            get_openai_client(),
+            model="gpt-4-1106-preview",
+            # model="gpt-3.5-turbo-1106",
+            messages=[
+                {"role": "system", "content": "You are a helpful assistant."},
+                {
+                    "role": "user",
+                    "content": f"次の文章からJSONを生成してください。\n{prompt_valuables}{prompt_format}",
+                },
+            ],
+            response_format={"type": "json_object"},
+            validate=validate_ideas,
+            use_cache=use_cache,
+            refresh=refresh,
+            # 同じメタトピックで毎回同じアイデアにならないよう、有効期限は短めにする
+            ttl=float(os.getenv("LLM_IDEAS_CACHE_TTL", str(6 * 60 * 60))),
+        )
         return script
     except json.JSONDecodeError as e:
         print(colored("スクリプトの生成に失敗しました。", "red"))
@@ -52,6 +97,39 @@ def generate_ideas(meta_topic: str, num_ideas: int) -> dict:
         return None
 
 
+def generate_unique_ideas(meta_topic: str, num_ideas: int, max_rounds: int = 3) -> dict:
+    """
+    制作済みの動画と似ていないアイデアを生成する。
+
+    生成したアイデアのうち、制作済みのアイデアやタイトル（src.dedup.IdeaIndex）や
+    同じ結果の中のアイデアと似ているものを取り除き、足りない分は取り除いたものを避けるよう
+    指示して生成し直す。スクリプトや音声・画像を生成する前に重複を除くための関数。
+
+    Args:
+        meta_topic (str): メタトピック
+        num_ideas (int): 生成するアイデアの個数
+        max_rounds (int): 生成する回数の上限
+
+    Returns:
+        dict: 生成されたアイデア（上限の回数で足りなければnum_ideasより少ない）
+    """
+    index = get_idea_index()
+    ideas, excluded = [], []
+    for attempt in range(max(1, max_rounds)):
+        result = generate_ideas(
+            meta_topic, num_ideas - len(ideas), refresh=attempt > 0, exclude=excluded)
+        if result is None:
+            break
+        unique, duplicates = filter_duplicates(ideas + result["ideas"], index)
+        if duplicates:
+            print(colored(f"[-] Skipped ideas similar to produced videos: {duplicates}", "yellow"))
+        ideas = unique[:num_ideas]
+        excluded += duplicates
+        if len(ideas) >= num_ideas:
+            break
+    return {"ideas": ideas}
+
+
 if __name__ == "__main__":
     meta_topic = "SFチックな、ちょっとオカルトな話を具体的に。"
     num_ideas = 2
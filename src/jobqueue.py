@@ -0,0 +1,383 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, List
+
+from termcolor import colored
+
+# ジョブの状態
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+@dataclass
+class Job:
+    """
+    キューに登録された1つのジョブ。
+
+    Attributes:
+        id (int): ジョブのID。
+        kind (str): "idea"（1本の動画を生成）または"topic"（アイデアを生成してideaのジョブを追加）。
+        subject (str): ビデオの主題、またはアイデアを生成する大まかなトピック。
+        params (dict): ジョブのパラメータ（クリップ数、レンダリング方式、アップロードの有無など）。
+        status (str): queued, running, done, failedのいずれか。
+        attempts (int): 実行を開始した回数。
+        max_attempts (int): 実行を開始できる回数の上限。
+        worker (str): 最後にリースを取得したワーカー。
+        timings (dict): 処理ごとの所要時間（秒）。
+        output_path (str): 完成した動画のパス。
+        error (str): 失敗した場合のエラー内容。
+        parent_id (int): topicのジョブから追加された場合、そのジョブのID。
+    """
+
+    id: int
+    kind: str
+    subject: str
+    params: dict = field(default_factory=dict)
+    status: str = QUEUED
+    attempts: int = 0
+    max_attempts: int = 3
+    worker: str = None
+    timings: dict = field(default_factory=dict)
+    output_path: str = None
+    error: str = None
+    parent_id: int = None
+
+
+_COLUMNS = (
+    "id, kind, subject, params, status, attempts, max_attempts, worker, timings, "
+    "output_path, error, parent_id"
+)
+
+
+def _to_job(row: tuple) -> Job:
+    (job_id, kind, subject, params, status, attempts, max_attempts, worker, timings,
+     output_path, error, parent_id) = row
+    return Job(
+        job_id, kind, subject, json.loads(params), status, attempts, max_attempts, worker,
+        json.loads(timings or "{}"), output_path, error, parent_id,
+    )
+
+
+class JobQueue:
+    """
+    SQLiteに保存する、複数のワーカーで共有できるジョブキュー。
+
+    ワーカーはclaimでジョブのリースを取得し、実行中はheartbeatで延長します。
+    ワーカーが異常終了してリースが期限切れになったジョブは、別のワーカーが再び取得します
+    （max_attemptsに達したものは失敗として扱います）。更新はBEGIN IMMEDIATEで行うため、
+    同じファイルを使う複数のプロセスが同じジョブを取得することはありません。
+    複数のホストで共有する場合は、ファイルロックが正しく動作するファイルシステムに置いてください
+    （WALはネットワークファイルシステムで使えないため、ロールバックジャーナルを使います）。
+
+    Args:
+        path (str): SQLiteデータベースファイルのパス。省略時は環境変数JOB_QUEUE_PATH
+            （既定値./cache/jobs.sqlite3）。
+    """
+
+    def __init__(self, path: str = None):
+        self.path = Path(path or os.getenv("JOB_QUEUE_PATH", "./cache/jobs.sqlite3"))
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    subject TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL,
+                    worker TEXT,
+                    lease_expires_at REAL,
+                    timings TEXT,
+                    output_path TEXT,
+                    error TEXT,
+                    parent_id INTEGER,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires_at)")
+
+    @contextmanager
+    def _transaction(self):
+        # 読み込みから書き込みまでの間に他のワーカーが更新しないよう、最初に書き込みロックを取る
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def enqueue(
+        self, subject: str, kind: str = "idea", max_attempts: int = 3, parent_id: int = None,
+        **params,
+    ) -> int:
+        """
+        ジョブを追加します。
+
+        Args:
+            subject (str): ビデオの主題（kind="idea"）、または大まかなトピック（kind="topic"）。
+            kind (str): "idea"または"topic"。
+            max_attempts (int): 実行を開始できる回数の上限。
+            parent_id (int): 追加元のジョブのID。
+            **params: ジョブのパラメータ。JSONに変換できる必要があります。
+
+        Returns:
+            int: 追加したジョブのID。
+        """
+        if kind not in ("idea", "topic"):
+            raise ValueError(f"Unknown job kind: {kind}")
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO jobs (kind, subject, params, status, max_attempts, parent_id, "
+                "created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, subject, json.dumps(params, ensure_ascii=False), QUEUED,
+                 max(1, max_attempts), parent_id, time.time()),
+            )
+            return cursor.lastrowid
+
+    def enqueue_children(self, parent: Job, subjects: List[str], **params) -> List[int]:
+        """
+        topicのジョブから生成したアイデアを、ideaのジョブとして追加します。
+
+        リースの期限切れで同じtopicのジョブが再実行された場合に重複しないよう、
+        既に追加済みであれば何もしません。
+
+        Args:
+            parent (Job): 追加元のtopicのジョブ。
+            subjects (List[str]): ビデオの主題のリスト。
+            **params: 追加するジョブのパラメータ。
+
+        Returns:
+            List[int]: 追加元のジョブから追加されたジョブのID。
+        """
+        with self._transaction() as conn:
+            existing = [
+                row[0] for row in conn.execute(
+                    "SELECT id FROM jobs WHERE parent_id = ? ORDER BY id", (parent.id,))
+            ]
+            if existing:
+                return existing
+            payload = json.dumps(params, ensure_ascii=False)
+            now = time.time()
+            return [
+                conn.execute(
+                    "INSERT INTO jobs (kind, subject, params, status, max_attempts, parent_id, "
+                    "created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    ("idea", subject, payload, QUEUED, parent.max_attempts, parent.id, now),
+                ).lastrowid
+                for subject in subjects
+            ]
+
+    def claim(self, worker: str, lease_seconds: float) -> Job:
+        """
+        実行待ちのジョブ（またはリースが期限切れになったジョブ）を1つ取得します。
+
+        Args:
+            worker (str): ワーカーの名前。
+            lease_seconds (float): リースの期間（秒）。
+
+        Returns:
+            Job: 取得したジョブ。実行できるジョブがない場合はNone。
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            # 上限まで実行を開始したのに完了しなかったジョブは失敗とする
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? "
+                "WHERE status = ? AND lease_expires_at < ? AND attempts >= max_attempts",
+                (FAILED, "リースの期限切れが上限の回数に達しました。", now, RUNNING, now),
+            )
+            row = conn.execute(
+                f"SELECT {_COLUMNS} FROM jobs "
+                "WHERE status = ? OR (status = ? AND lease_expires_at < ?) "
+                "ORDER BY id LIMIT 1",
+                (QUEUED, RUNNING, now),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker = ?, lease_expires_at = ?, "
+                "attempts = attempts + 1, started_at = ?, error = NULL WHERE id = ?",
+                (RUNNING, worker, now + lease_seconds, now, row[0]),
+            )
+        job = _to_job(row)
+        if job.status == RUNNING:
+            print(colored(f"[-] Job {job.id} lease expired ({job.worker}), re-leasing...", "yellow"))
+        job.status = RUNNING
+        job.worker = worker
+        job.attempts += 1
+        return job
+
+    def heartbeat(self, job_id: int, worker: str, lease_seconds: float) -> bool:
+        """
+        リースを延長します。
+
+        Returns:
+            bool: リースを保持している場合はTrue。期限切れで他のワーカーに取得された場合はFalse。
+        """
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND worker = ? AND status = ?",
+                (time.time() + lease_seconds, job_id, worker, RUNNING),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, job: Job, output_path: str = None):
+        """
+        ジョブを完了として記録します。リースを失っていた場合は記録しません。
+        """
+        self._finish(job, DONE, output_path=output_path)
+
+    def fail(self, job: Job, error: str):
+        """
+        ジョブの失敗を記録します。実行を開始した回数が上限に達していなければ実行待ちに戻します。
+        """
+        status = QUEUED if job.attempts < job.max_attempts else FAILED
+        self._finish(job, status, error=error)
+
+    def _finish(self, job: Job, status: str, output_path: str = None, error: str = None):
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, output_path = ?, error = ?, timings = ?, "
+                "lease_expires_at = NULL, finished_at = ? WHERE id = ? AND worker = ? AND status = ?",
+                (status, output_path, error, json.dumps(job.timings), time.time(), job.id,
+                 job.worker, RUNNING),
+            )
+        job.status = status
+        job.output_path = output_path
+        job.error = error
+
+    def jobs(self, status: str = None) -> List[Job]:
+        """
+        ジョブの一覧を返します。
+
+        Args:
+            status (str): 指定した場合、その状態のジョブだけを返します。
+
+        Returns:
+            List[Job]: ID順のジョブ。
+        """
+        with self._transaction() as conn:
+            if status is None:
+                rows = conn.execute(f"SELECT {_COLUMNS} FROM jobs ORDER BY id").fetchall()
+            else:
+                rows = conn.execute(
+                    f"SELECT {_COLUMNS} FROM jobs WHERE status = ? ORDER BY id", (status,)
+                ).fetchall()
+        return [_to_job(row) for row in rows]
+
+    def counts(self) -> dict:
+        """
+        状態ごとのジョブの数を返します。
+        """
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+
+def default_worker_name() -> str:
+    """
+    ホスト名・プロセスID・乱数からワーカーの名前を作成します。
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+def run_worker(
+    queue: JobQueue,
+    handler: Callable[[Job], str],
+    worker: str = None,
+    concurrency: int = 1,
+    lease_seconds: float = None,
+    poll_interval: float = 5.0,
+    exit_when_empty: bool = False,
+):
+    """
+    キューからジョブを取得して実行し続けます。
+
+    実行中はリースの期間の1/3ごとにリースを延長します。ワーカーが異常終了すると延長が止まり、
+    リースの期限が切れたジョブは他のワーカーが取得して続きから実行します。
+
+    Args:
+        queue (JobQueue): ジョブキュー。
+        handler (Callable[[Job], str]): ジョブを実行し、出力のパスを返す関数。
+            job.timingsに所要時間を記録できます。例外を送出すると失敗として記録します。
+        worker (str): ワーカーの名前。省略時はdefault_worker_name()。
+        concurrency (int): このプロセスで同時に実行するジョブの数。
+        lease_seconds (float): リースの期間（秒）。省略時は環境変数JOB_LEASE_SECONDS（既定値300）。
+        poll_interval (float): 実行できるジョブがない場合に再確認するまでの時間（秒）。
+        exit_when_empty (bool): Trueの場合、実行できるジョブがなくなったら終了します。
+    """
+    worker = worker or default_worker_name()
+    if lease_seconds is None:
+        lease_seconds = float(os.getenv("JOB_LEASE_SECONDS", "300"))
+
+    def loop(name):
+        while True:
+            job = queue.claim(name, lease_seconds)
+            if job is None:
+                if exit_when_empty:
+                    return
+                time.sleep(poll_interval)
+                continue
+            _run_job(queue, handler, job, lease_seconds)
+
+    names = [worker if concurrency <= 1 else f"{worker}/{i}" for i in range(max(1, concurrency))]
+    threads = [threading.Thread(target=loop, args=(name,), name=name) for name in names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _run_job(queue: JobQueue, handler: Callable[[Job], str], job: Job, lease_seconds: float):
+    print(colored(
+        f"[+] Job {job.id} ({job.kind}) started by {job.worker} "
+        f"(attempt {job.attempts}/{job.max_attempts}): {job.subject}", "cyan"))
+
+    # リースを延長し続けるスレッド
+    stopped = threading.Event()
+
+    def heartbeat():
+        while not stopped.wait(lease_seconds / 3):
+            if not queue.heartbeat(job.id, job.worker, lease_seconds):
+                print(colored(f"[-] Job {job.id} lease lost.", "red"))
+                return
+
+    keeper = threading.Thread(target=heartbeat, daemon=True)
+    keeper.start()
+    started = time.perf_counter()
+    try:
+        output_path = handler(job)
+    except Exception as e:
+        job.timings["total"] = time.perf_counter() - started
+        queue.fail(job, str(e))
+        print(colored(f"[-] Job {job.id} failed ({job.status}): {e}", "red"))
+    else:
+        job.timings["total"] = time.perf_counter() - started
+        queue.complete(job, output_path)
+        print(colored(
+            f"[+] Job {job.id} done in {job.timings['total']:.1f}s: {output_path}", "green"))
+    finally:
+        stopped.set()
+        keeper.join()
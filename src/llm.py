@@ -0,0 +1,325 @@
+import json
+import os
+import threading
+from typing import Callable
+
+from termcolor import colored
+
+from src.cache import ResponseCache, make_cache_key
+from src.ratelimit import call_with_rate_limit, rate_limited
+from src.tracing import span
+
+# レート制限で確保する、1回の応答で生成されるトークン数の見積もり
+COMPLETION_TOKENS_ESTIMATE = 1000
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """
+    LLMのレスポンスキャッシュを返します。
+
+    保存先は環境変数LLM_CACHE_PATH、有効期限（秒）はLLM_CACHE_TTLで指定します。
+
+    Returns:
+        ResponseCache: プロセス全体で共有するキャッシュ。
+    """
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            ttl = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 60 * 60)))
+            _response_cache = ResponseCache(
+                os.getenv("LLM_CACHE_PATH", "./cache/llm.sqlite3"),
+                ttl=ttl if ttl > 0 else None,
+            )
+        return _response_cache
+
+
+def estimate_tokens(messages: list) -> int:
+    """
+    リクエストで使用するトークン数を見積もります（レート制限の確保用）。
+
+    日本語はおおむね1文字が1トークン以上になるため、文字数をそのまま入力のトークン数とし、
+    応答の分としてCOMPLETION_TOKENS_ESTIMATEを加えます。
+    """
+    return sum(len(str(message.get("content", ""))) for message in messages) + COMPLETION_TOKENS_ESTIMATE
+
+
+def create_json_completion(
+    client,
+    model: str,
+    messages: list,
+    response_format: dict = None,
+    validate: Callable[[dict], bool] = None,
+    use_cache: bool = None,
+    refresh: bool = False,
+    ttl: float = None,
+) -> dict:
+    """
+    チャット補完APIでJSONを生成し、辞書に変換して返します。
+
+    モデル・メッセージ・response_formatが同じリクエストはキャッシュから返します。
+    キャッシュされたレスポンスは再利用する前にvalidateで検証し、
+    不正なものは削除して生成し直します。
+
+    Args:
+        client (OpenAI): OpenAIクライアント。
+        model (str): 使用するモデル名。
+        messages (list): チャットのメッセージ。
+        response_format (dict): レスポンスの形式。省略時はjson_object。
+        validate (Callable[[dict], bool]): 生成結果の形式を検証する関数。
+        use_cache (bool): キャッシュを使用するかどうか。
+            省略時は環境変数LLM_CACHE（既定値1）に従います。
+        refresh (bool): Trueの場合はキャッシュを読まずに生成し、結果で上書きします。
+        ttl (float): キャッシュの有効期限（秒）。省略時は環境変数LLM_CACHE_TTL。
+
+    Returns:
+        dict: 生成されたJSON。
+
+    Raises:
+        json.JSONDecodeError: 生成結果がJSONとして解釈できない場合に発生する例外
+    """
+    if response_format is None:
+        response_format = {"type": "json_object"}
+    if use_cache is None:
+        use_cache = os.getenv("LLM_CACHE", "1") != "0"
+
+    cache = get_response_cache() if use_cache else None
+    cache_key = make_cache_key(
+        model=model, messages=messages, response_format=response_format)
+
+    if cache is not None and not refresh:
+        data = _load_cached(cache, cache_key, validate, ttl)
+        if data is not None:
+            return data
+
+    def request(slot):
+        # 再試行はレートリミッターが行い、429/5xxを同時実行数の調整に反映する
+        response = client.with_options(max_retries=0).chat.completions.create(
+            model=model,
+            messages=messages,
+            response_format=response_format,
+        )
+        usage = getattr(response, "usage", None)
+        slot.record(status=200, tokens_used=usage.total_tokens if usage else None)
+        return response
+
+    with span("llm.chat", model=model) as current:
+        response = call_with_rate_limit(
+            "chat", request, tokens=estimate_tokens(messages), current_span=current)
+        content = response.choices[0].message.content.strip()
+        current.add_bytes(len(content.encode("utf-8")))
+    data = json.loads(content)
+    if cache is not None and (validate is None or validate(data)):
+        cache.put(cache_key, content, model=model)
+    return data
+
+
+class JsonStreamParser:
+    """
+    ストリーミングで届くJSONオブジェクトから、指定したキーの配列の要素を
+    完成したものから順に取り出すパーサー。
+
+    文字列とエスケープを考慮して括弧の深さを追跡し、トップレベルのキーの配列内で
+    閉じたオブジェクトだけをjson.loadsで変換します。
+
+    Args:
+        key (str): 要素を取り出す配列のキー（例: "clips"）。
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None
+        self._in_array = False
+        self._item_start = None
+
+    def feed(self, chunk: str) -> list:
+        """
+        受信したテキストを追加し、新たに完成した要素を返します。
+
+        Args:
+            chunk (str): 受信したテキスト。
+
+        Returns:
+            list: 完成した要素のリスト。
+
+        Raises:
+            ValueError: JSONとして不正な場合に発生する例外
+        """
+        self.text += chunk
+        items = []
+        text = self.text
+        while self._pos < len(text):
+            i = self._pos
+            c = text[i]
+            self._pos += 1
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_string = text[self._string_start:i + 1]
+            elif c == '"':
+                self._in_string = True
+                self._string_start = i
+            elif c in "{[":
+                if c == "[" and self._depth == 1 and self._is_key(self._last_string):
+                    self._in_array = True
+                elif c == "{" and self._in_array and self._depth == 2:
+                    self._item_start = i
+                self._depth += 1
+            elif c in "}]":
+                self._depth -= 1
+                if self._depth < 0:
+                    raise ValueError(f"Unexpected '{c}' at position {i}")
+                if c == "}" and self._item_start is not None and self._depth == 2:
+                    items.append(json.loads(text[self._item_start:i + 1]))
+                    self._item_start = None
+                elif c == "]" and self._in_array and self._depth == 1:
+                    self._in_array = False
+            elif c == "," and self._depth == 1:
+                self._last_string = None
+        return items
+
+    def _is_key(self, token: str) -> bool:
+        return token is not None and json.loads(token) == self.key
+
+
+def stream_json_completion(
+    client,
+    model: str,
+    messages: list,
+    item_key: str,
+    on_item: Callable[[dict], None],
+    response_format: dict = None,
+    validate: Callable[[dict], bool] = None,
+    use_cache: bool = None,
+    refresh: bool = False,
+    ttl: float = None,
+    on_reset: Callable[[], None] = None,
+) -> dict:
+    """
+    ストリーミングのチャット補完APIでJSONを生成し、配列の要素が完成するたびにon_itemを呼び出します。
+
+    生成の途中から後続の処理を始められるよう、item_keyの配列の要素を完成した順に渡します。
+    全体を受信したら、create_json_completionと同じく全体をjson.loadsで変換して返します。
+    ストリームが不正な場合や途中で切断された場合は、ストリーミングを使わずに生成し直します。
+    生成し直した結果は既にon_itemに渡した要素と異なる可能性があるため、その前にon_resetを
+    呼び出して、渡した要素を破棄するよう呼び出し元に伝えます。
+    キャッシュの扱いはcreate_json_completionと同じで、キャッシュから返す場合も各要素をon_itemに渡します。
+
+    Args:
+        client (OpenAI): OpenAIクライアント。
+        model (str): 使用するモデル名。
+        messages (list): チャットのメッセージ。
+        item_key (str): 要素を取り出す配列のキー。
+        on_item (Callable[[dict], None]): 完成した要素を受け取る関数。
+        response_format (dict): レスポンスの形式。省略時はjson_object。
+        validate (Callable[[dict], bool]): 生成結果の形式を検証する関数。
+        use_cache (bool): キャッシュを使用するかどうか。
+        refresh (bool): Trueの場合はキャッシュを読まずに生成し、結果で上書きします。
+        ttl (float): キャッシュの有効期限（秒）。
+        on_reset (Callable[[], None]): on_itemに要素を渡した後でストリーミングに失敗し、
+            生成し直す場合に呼び出す関数。
+
+    Returns:
+        dict: 生成されたJSON。
+
+    Raises:
+        json.JSONDecodeError: 生成し直した結果もJSONとして解釈できない場合に発生する例外
+    """
+    if response_format is None:
+        response_format = {"type": "json_object"}
+    if use_cache is None:
+        use_cache = os.getenv("LLM_CACHE", "1") != "0"
+
+    cache = get_response_cache() if use_cache else None
+    cache_key = make_cache_key(
+        model=model, messages=messages, response_format=response_format)
+
+    if cache is not None and not refresh:
+        data = _load_cached(cache, cache_key, validate, ttl)
+        if data is not None:
+            for item in (data.get(item_key) if isinstance(data, dict) else None) or []:
+                on_item(item)
+            return data
+
+    from openai import APIError
+
+    parser = JsonStreamParser(item_key)
+    emitted = 0
+    try:
+        prompt_tokens = estimate_tokens(messages) - COMPLETION_TOKENS_ESTIMATE
+        # ストリームを読み終えるまで枠を確保し、失敗した場合はストリーミングを使わずに再試行する
+        with span("llm.chat", model=model, stream=True) as current, \
+                rate_limited("chat", tokens=estimate_tokens(messages)) as slot:
+            stream = client.with_options(max_retries=0).chat.completions.create(
+                model=model,
+                messages=messages,
+                response_format=response_format,
+                stream=True,
+            )
+            finish_reason = None
+            for chunk in stream:
+                slot.record(status=200)  # 最初のチャンクまでを応答時間とする
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                finish_reason = choice.finish_reason or finish_reason
+                delta = choice.delta.content
+                if delta:
+                    current.add_bytes(len(delta.encode("utf-8")))
+                    for item in parser.feed(delta):
+                        emitted += 1
+                        on_item(item)
+            slot.record(tokens_used=prompt_tokens + len(parser.text))
+            if finish_reason not in (None, "stop"):
+                raise ValueError(f"Stream finished with reason: {finish_reason}")
+        content = parser.text.strip()
+        data = json.loads(content)
+    except (ValueError, APIError) as e:
+        print(colored(f"[-] Streaming response failed ({e}), retrying without streaming...", "red"))
+        if emitted and on_reset is not None:
+            on_reset()
+        # キャッシュは確認済みなので、読まずに生成して結果を保存する
+        return create_json_completion(
+            client,
+            model=model,
+            messages=messages,
+            response_format=response_format,
+            validate=validate,
+            use_cache=use_cache,
+            refresh=True,
+            ttl=ttl,
+        )
+
+    if cache is not None and (validate is None or validate(data)):
+        cache.put(cache_key, content, model=model)
+    return data
+
+
+def _load_cached(cache: ResponseCache, cache_key: str, validate: Callable, ttl: float) -> dict:
+    # 検証に合格したキャッシュだけを返し、不正なものは削除する
+    content = cache.get(cache_key, ttl=ttl)
+    if content is None:
+        return None
+    try:
+        data = json.loads(content)
+        if validate is None or validate(data):
+            print(colored("[+] Loaded response from cache.", "green"))
+            return data
+    except json.JSONDecodeError:
+        pass
+    print(colored("[-] Cached response is invalid, regenerating...", "red"))
+    cache.delete(cache_key)
+    return None
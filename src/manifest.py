@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+from src.cache import make_cache_key
+from src.topic2text import validate_script
+from src.workspace import Workspace
+
+# スクリプト以外に、マニフェストへ記録しないクリップのキー（メモリ上のデータ、生成物のパス、音声から計算した値）
+_ARTIFACT_KEYS = ("audio", "audio_path", "gain_db", "image_path", "video_path")
+
+
+def job_id_for(video_subject: str, num_clips: int) -> str:
+    """
+    ビデオの主題とクリップ数から、再実行時にも同じになるジョブIDを生成します。
+
+    Args:
+        video_subject (str): ビデオの主題。
+        num_clips (int): クリップ数。
+
+    Returns:
+        str: ジョブID。
+    """
+    return make_cache_key(video_subject=video_subject, num_clips=num_clips)[:16]
+
+
+def file_sha256(path: str) -> str:
+    """
+    ファイルの内容のSHA-256ハッシュを計算します。
+
+    Args:
+        path (str): ファイルのパス。
+
+    Returns:
+        str: SHA-256ハッシュ（16進数）。
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    ジョブの各ステージの生成物を記録するマニフェスト。
+
+    生成物ごとに、入力から計算したキー・ファイルのパス・内容のハッシュを
+    ワークスペースのmanifest.jsonに保存します。再実行時は、キーが一致し、
+    ファイルが存在して内容のハッシュも一致する生成物だけを再利用します。
+    スクリプトはワークスペースのscript.jsonに保存され、これを編集して再実行すると
+    変更したクリップと最終的な動画だけが生成し直されます。
+
+    Args:
+        workspace (Workspace): ジョブのワークスペース。
+    """
+
+    def __init__(self, workspace: Workspace):
+        self.workspace = workspace
+        self.path = workspace.path / "manifest.json"
+        self.script_path = workspace.path / "script.json"
+        self._lock = threading.Lock()
+        try:
+            self.data = json.loads(self.path.read_text(encoding="utf-8"))
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.data = {"artifacts": {}}
+
+    def load_script(self) -> dict:
+        """
+        保存されたスクリプトを読み込みます。
+
+        マニフェストは書き換えないため、ワークスペースのロックを取らずに呼び出せます
+        （バッチのスクリプト生成で、保存済みのスクリプトがあるかを確認する場合など）。
+        読み込んだスクリプトを使う場合は、ロックを取った上でrecord_scriptで記録します。
+
+        Returns:
+            dict: スクリプト。存在しないか形式が不正な場合はNone。
+        """
+        try:
+            script = json.loads(self.script_path.read_text(encoding="utf-8"))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if not validate_script(script):
+            return None
+        return script
+
+    def record_script(self, script: dict):
+        """
+        script.jsonに保存されているスクリプトをマニフェストに記録します。
+
+        Args:
+            script (dict): script.jsonの内容。
+        """
+        self.record("script", make_cache_key(script=script), str(self.script_path))
+
+    def save_script(self, script: dict):
+        """
+        スクリプトをscript.jsonに保存し、マニフェストに記録します。
+
+        Args:
+            script (dict): 生成されたスクリプト。
+        """
+        script = {
+            **script,
+            "clips": [
+                {k: v for k, v in clip.items() if k not in _ARTIFACT_KEYS}
+                for clip in script["clips"]
+            ],
+        }
+        _write_atomic(
+            self.script_path,
+            json.dumps(script, ensure_ascii=False, indent=2).encode("utf-8"),
+        )
+        self.record_script(script)
+
+    def lookup(self, name: str, key: str) -> str:
+        """
+        キーが一致し、内容も変わっていない生成物のパスを返します。
+
+        Args:
+            name (str): 生成物の名前（例: "clips/0/audio"）。
+            key (str): 生成物の入力から計算したキー。
+
+        Returns:
+            str: 生成物のパス。再利用できない場合はNone。
+        """
+        with self._lock:
+            entry = self.data["artifacts"].get(name)
+        if entry is None or entry["key"] != key:
+            return None
+        try:
+            if file_sha256(entry["path"]) != entry["sha256"]:
+                return None
+        except FileNotFoundError:
+            return None
+        return entry["path"]
+
+    def get_value(self, name: str):
+        """
+        記録された値を返します。
+
+        Args:
+            name (str): 値の名前（例: "loudness_gain_db"）。
+
+        Returns:
+            値。記録されていない場合はNone。
+        """
+        with self._lock:
+            return self.data.get("values", {}).get(name)
+
+    def set_value(self, name: str, value):
+        """
+        ファイルではない生成物（音声から計算したゲインなど）を記録し、マニフェストを保存します。
+
+        Args:
+            name (str): 値の名前。
+            value: JSONに変換できる値。
+        """
+        with self._lock:
+            self.data.setdefault("values", {})[name] = value
+            payload = json.dumps(self.data, ensure_ascii=False, indent=2)
+            _write_atomic(self.path, payload.encode("utf-8"))
+
+    def record(self, name: str, key: str, path: str):
+        """
+        生成物を記録し、マニフェストを保存します。
+
+        Args:
+            name (str): 生成物の名前。
+            key (str): 生成物の入力から計算したキー。
+            path (str): 生成物のパス。
+        """
+        entry = {"key": key, "path": str(path), "sha256": file_sha256(path)}
+        with self._lock:
+            self.data["artifacts"][name] = entry
+            payload = json.dumps(self.data, ensure_ascii=False, indent=2)
+            _write_atomic(self.path, payload.encode("utf-8"))
+
+
+def _write_atomic(path: Path, data: bytes):
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
@@ -0,0 +1,389 @@
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from termcolor import colored
+
+from src.audio import decode_wav, to_segment, to_wav_bytes
+from src.cache import make_cache_key
+from src.manifest import Manifest
+from src.subtitles import clip_subtitle_text, get_subtitle_mode, get_subtitle_style
+from src.tracing import propagate, span
+from src.topic2text import generate_script
+from src.text2voice import (
+    generate_audio_for_clips,
+    get_tts_client,
+    process_and_combine_audio,
+)
+from src.voice2video import (
+    CLIP_MAX_DURATION,
+    CLIP_SILENCE_DURATION,
+    RENDER_ENGINES,
+    RenderProfile,
+    convert_image,
+    download_and_save_image,
+    generate_images_for_clips,
+    get_render_profile,
+    image_cache_key,
+    process_json_data,
+    render_profile_params,
+)
+from src.workspace import Workspace
+
+
+def image_preconvert_enabled() -> bool:
+    """
+    画像を生成した時点でエンコード設定の解像度に変換するかどうかを返します（環境変数IMAGE_PRECONVERT）。
+
+    変換しておくと、CPUが中心のレンダリングのステージで画像の拡大・切り抜きが不要になります。
+    """
+    return os.getenv("IMAGE_PRECONVERT") == "1"
+
+
+def clip_artifact_keys(clip: dict, profile: RenderProfile = None, subtitles: str = None) -> dict:
+    """
+    クリップの各生成物の入力から、マニフェストで使用するキーを計算します。
+
+    音声はテキストと合成パラメータ、画像はプロンプトと生成パラメータ
+    （変換する場合は変換後の解像度も）、クリップの動画は音声・画像・ラウドネスのゲイン・
+    レンダリングのパラメータ（字幕を焼き込む場合は字幕も）から決まります。
+
+    Args:
+        clip (dict): クリップ情報。
+        profile (RenderProfile): エンコード設定。省略時はget_render_profile()。
+        subtitles (str): 字幕の付け方。省略時は環境変数SUBTITLES。
+
+    Returns:
+        dict: "audio"、"image"、"video"のキー。
+    """
+    profile = profile or get_render_profile()
+    audio_key = make_cache_key(text=clip["text"], **get_tts_client().params)
+    image_key = image_cache_key(clip["video_prompt"])
+    if image_preconvert_enabled():
+        image_key = make_cache_key(image=image_key, convert=render_profile_params(profile))
+    video_key = make_cache_key(
+        audio=audio_key,
+        image=image_key,
+        gain_db=clip.get("gain_db", 0.0),
+        silence_duration=CLIP_SILENCE_DURATION,
+        video_duration=CLIP_MAX_DURATION,
+        profile=render_profile_params(profile),
+    )
+    if get_subtitle_mode(subtitles) == "burn":
+        video_key = make_cache_key(
+            video=video_key, subtitle=clip_subtitle_text(clip), style=get_subtitle_style())
+    return {"audio": audio_key, "image": image_key, "video": video_key}
+
+
+class ClipPrefetcher:
+    """
+    スクリプトの生成中に、完成したクリップから順に音声と画像の生成を始めます。
+
+    結果は文章とプロンプトごとに保持し、applyで最終的なスクリプトの内容が一致するクリップにだけ
+    割り当てます。ストリームが途中で生成し直された場合はdiscardで全て破棄し、
+    失敗したものと合わせてprepare_assetsで改めて生成されます。
+
+    Args:
+        workspace (Workspace): 画像を保存するジョブのワークスペース。
+        max_workers (int): 同時に実行する生成の上限。
+            省略時は環境変数IMAGE_MAX_WORKERS（既定値3）に音声の分の1を加えた数。
+    """
+
+    def __init__(self, workspace: Workspace, max_workers: int = None):
+        if max_workers is None:
+            max_workers = int(os.getenv("IMAGE_MAX_WORKERS", "3")) + 1
+        self.workspace = workspace
+        self._executor = ThreadPoolExecutor(max(1, max_workers), thread_name_prefix="prefetch")
+        self._audio = {}
+        self._images = {}
+
+    def submit(self, clip: dict):
+        """
+        クリップの音声と画像の生成を開始します。
+
+        Args:
+            clip (dict): 完成したクリップ。
+        """
+        text = clip.get("text")
+        if isinstance(text, str) and text and text not in self._audio:
+            self._audio[text] = self._executor.submit(
+                propagate(process_and_combine_audio), text)
+        prompt = clip.get("video_prompt")
+        if isinstance(prompt, str) and prompt:
+            key = image_cache_key(prompt)
+            if key not in self._images:
+                self._images[key] = self._executor.submit(
+                    propagate(download_and_save_image), prompt, workspace=self.workspace)
+
+    def discard(self):
+        """
+        開始した生成を全て破棄します。まだ始まっていないものは取り消します。
+
+        ストリーミングで受け取ったクリップが最終的なスクリプトにならない場合
+        （ストリーミングに失敗して生成し直す場合）に呼び出します。
+        """
+        for future in [*self._audio.values(), *self._images.values()]:
+            future.cancel()
+        self._audio.clear()
+        self._images.clear()
+
+    def close(self):
+        """
+        開始した全ての生成の完了を待ちます。
+        """
+        self._executor.shutdown(wait=True)
+
+    def apply(self, clips: dict) -> dict:
+        """
+        生成済みの音声と画像を、内容が一致するクリップに割り当てます。
+
+        Args:
+            clips (dict): 最終的なスクリプト。
+
+        Returns:
+            dict: 音声と"image_path"の一部が追加されたクリップ情報。
+        """
+        self.close()
+        for clip in clips["clips"]:
+            audio = self._result(self._audio.get(clip["text"]))
+            if audio is not None and clip.get("audio") is None:
+                clip["audio"] = audio
+            image_path = self._result(self._images.get(image_cache_key(clip["video_prompt"])))
+            if image_path and not clip.get("image_path"):
+                clip["image_path"] = image_path
+        return clips
+
+    @staticmethod
+    def _result(future):
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            print(colored(f"[-] Prefetch failed: {e}", "red"))
+            return None
+
+
+def prepare_script(
+    video_subject: str,
+    num_clips: int,
+    manifest: Manifest = None,
+    workspace: Workspace = None,
+    script: dict = None,
+) -> dict:
+    """
+    ビデオの主題からスクリプトを生成します（ネットワーク待ちが中心のステージ）。
+
+    ワークスペースを指定した場合はスクリプトをストリーミングで生成し、
+    クリップが完成するたびにその音声と画像の生成を始めます。
+    generate_scriptsでまとめて生成したスクリプトがあれば、生成せずにそれを使用します。
+
+    Args:
+        video_subject (str): ビデオの主題。
+        num_clips (int): クリップ数。
+        manifest (Manifest): ジョブのマニフェスト。保存済みのスクリプトがあれば再利用します。
+        workspace (Workspace): 先に生成する画像を保存するジョブのワークスペース。
+        script (dict): 生成済みのスクリプト。
+
+    Returns:
+        dict: 生成されたスクリプト。生成に失敗した場合はNone。
+    """
+    with span("stage.script"):
+        if manifest is not None:
+            clips = manifest.load_script()
+            if clips is not None:
+                manifest.record_script(clips)
+                print(colored("[+] Loaded script from checkpoint.", "green"))
+                return clips
+
+        if script is not None:
+            if manifest is not None:
+                manifest.save_script(script)
+            return script
+
+        print(colored("[+] Generating script...", "yellow"))
+        prefetcher = ClipPrefetcher(workspace) if workspace is not None else None
+        try:
+            clips = generate_script(
+                video_subject,
+                num_clips,
+                on_clip=prefetcher.submit if prefetcher is not None else None,
+                on_reset=prefetcher.discard if prefetcher is not None else None,
+            )
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+        print(clips)
+        if clips is not None and manifest is not None:
+            manifest.save_script(clips)
+        if clips is not None and prefetcher is not None:
+            prefetcher.apply(clips)
+        return clips
+
+
+def prepare_assets(
+    clips: dict,
+    workspace: Workspace,
+    manifest: Manifest = None,
+    render_profile: str = None,
+) -> dict:
+    """
+    全てのクリップの音声と画像を生成します（ネットワーク待ちが中心のステージ）。
+
+    音声合成と画像生成は互いに独立しているため同時に実行します。
+    マニフェストがある場合は、入力が変わっていない音声と画像を再利用し、
+    新しく生成したものを記録します。音声のラウドネスのゲインも記録し、再開時に
+    ゲインがほとんど変わらなければ前回の値を使います（編集していないクリップの動画を再利用するため）。
+    環境変数IMAGE_PRECONVERT=1の場合は、新しい画像をエンコード設定の解像度に変換します。
+
+    Args:
+        clips (dict): スクリプト。
+        workspace (Workspace): 画像を保存するジョブのワークスペース。
+        manifest (Manifest): ジョブのマニフェスト。
+        render_profile (str): 画像を変換するエンコード設定の名前。省略時は環境変数RENDER_PROFILE。
+
+    Returns:
+        dict: 音声と"image_path"が追加されたクリップ情報。
+    """
+    profile = get_render_profile(render_profile)
+    with span("stage.assets", clips=len(clips["clips"])):
+        restored_images = set()
+        if manifest is not None:
+            for i, clip in enumerate(clips["clips"]):
+                keys = clip_artifact_keys(clip, profile)
+                audio_path = manifest.lookup(f"clips/{i}/audio", keys["audio"])
+                if audio_path is not None:
+                    clip["audio"] = to_segment(decode_wav(Path(audio_path).read_bytes()))
+                image_path = manifest.lookup(f"clips/{i}/image", keys["image"])
+                if image_path is not None:
+                    clip["image_path"] = image_path
+                    restored_images.add(i)
+
+        print(colored("[+] Generating audio and images for clips...", "yellow"))
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            previous_gain_db = (
+                manifest.get_value("loudness_gain_db") if manifest is not None else None)
+            audio_future = executor.submit(
+                propagate(generate_audio_for_clips), clips, previous_gain_db=previous_gain_db)
+            image_future = executor.submit(
+                propagate(generate_images_for_clips), clips, workspace=workspace)
+            audio_future.result()
+            image_future.result()
+
+            if image_preconvert_enabled():
+                # 同じ画像を共有するクリップは1回だけ変換する
+                sources = {
+                    clip["image_path"] for i, clip in enumerate(clips["clips"])
+                    if i not in restored_images and clip.get("image_path")
+                }
+                convert = propagate(lambda path: convert_image(path, profile, workspace))
+                converted = dict(zip(sources, executor.map(convert, sources)))
+                for i, clip in enumerate(clips["clips"]):
+                    if i not in restored_images and clip.get("image_path") in converted:
+                        clip["image_path"] = converted[clip["image_path"]]
+        print(clips)
+
+        if manifest is not None:
+            for i, clip in enumerate(clips["clips"]):
+                keys = clip_artifact_keys(clip, profile)
+                if clip.get("audio") is not None and manifest.lookup(
+                    f"clips/{i}/audio", keys["audio"]
+                ) is None:
+                    # チェックポイント用に、メモリ上の音声を可逆のWAVで保存する
+                    audio_path = workspace.new_path(".wav")
+                    audio_path.write_bytes(to_wav_bytes(clip["audio"]))
+                    manifest.record(f"clips/{i}/audio", keys["audio"], audio_path)
+                if clip.get("image_path"):
+                    manifest.record(f"clips/{i}/image", keys["image"], clip["image_path"])
+            if clips["clips"]:
+                manifest.set_value("loudness_gain_db", clips["clips"][0].get("gain_db", 0.0))
+        return clips
+
+
+def render_video(
+    clips: dict,
+    output_file_path: str,
+    workspace: Workspace,
+    render_engine: str = None,
+    manifest: Manifest = None,
+    render_profile: str = None,
+    subtitles: str = None,
+) -> str:
+    """
+    音声と画像から完成した動画をエンコードします（CPUが中心のステージ）。
+
+    マニフェストがある場合は、入力が変わっていないクリップの動画と完成した動画を再利用し、
+    変更されたクリップだけをエンコードし直します。
+
+    Args:
+        clips (dict): 音声と"image_path"を含むクリップ情報。
+        output_file_path (str): 完成した動画を保存するパス。
+        workspace (Workspace): 中間ファイルを保存するジョブのワークスペース。
+        render_engine (str): "per_clip"（クリップごとにMP4を作って結合）または
+            "single_pass"（1回のffmpegで直接出力）。省略時は環境変数RENDER_ENGINE。
+        manifest (Manifest): ジョブのマニフェスト。
+        render_profile (str): エンコード設定の名前（"quality"、"balanced"、"fast"、"square"）。
+            省略時は環境変数RENDER_PROFILE。
+        subtitles (str): 字幕の付け方（"off"、"soft"、"burn"）。省略時は環境変数SUBTITLES。
+
+    Returns:
+        str: 完成した動画のパス。
+    """
+    render_engine = render_engine or os.getenv("RENDER_ENGINE", "per_clip")
+    profile = get_render_profile(render_profile)
+    subtitles = get_subtitle_mode(subtitles)
+    with span("stage.render", render_engine=render_engine, render_profile=render_profile,
+              subtitles=subtitles):
+        create_video = RENDER_ENGINES[render_engine]
+        Path(output_file_path).parent.mkdir(parents=True, exist_ok=True)
+
+        clip_keys = [clip_artifact_keys(clip, profile, subtitles) for clip in clips["clips"]]
+        final_key = make_cache_key(
+            render_engine=render_engine,
+            profile=render_profile_params(profile),
+            clips=[keys["video"] for keys in clip_keys],
+            subtitles=subtitles,
+            subtitle_texts=(
+                [clip_subtitle_text(clip) for clip in clips["clips"]]
+                if subtitles != "off" else None
+            ),
+            subtitle_style=get_subtitle_style() if subtitles != "off" else None,
+        )
+        if manifest is not None:
+            final_path = manifest.lookup("final", final_key)
+            if final_path is not None and Path(final_path) == Path(output_file_path):
+                print(colored("[+] Loaded video from checkpoint.", "green"))
+                return final_path
+
+        if render_engine == "per_clip":
+            if manifest is not None:
+                for i, (clip, keys) in enumerate(zip(clips["clips"], clip_keys)):
+                    video_path = manifest.lookup(f"clips/{i}/video", keys["video"])
+                    if video_path is not None:
+                        clip["video_path"] = video_path
+
+            process_json_data(clips, workspace=workspace, profile=profile, subtitles=subtitles)
+            print(colored("[+] Processing JSON data...", "yellow"))
+            print(clips)
+
+            if manifest is not None:
+                for i, (clip, keys) in enumerate(zip(clips["clips"], clip_keys)):
+                    manifest.record(f"clips/{i}/video", keys["video"], clip["video_path"])
+
+        print(colored("[+] Creating combined video...", "yellow"))
+        # 出力先と同じディレクトリの一時ファイルに書き出してから置き換える。
+        # 失敗しても前回の完成した動画は残り、再開時も既存の出力の上書きで止まらない
+        output_path = Path(output_file_path)
+        partial_path = output_path.with_name(f".{uuid.uuid4().hex}.partial{output_path.suffix}")
+        try:
+            create_video(
+                clips, str(partial_path), workspace=workspace, profile=profile,
+                subtitles=subtitles)
+            os.replace(partial_path, output_path)
+        finally:
+            partial_path.unlink(missing_ok=True)
+        video_path = output_file_path
+        if manifest is not None:
+            manifest.record("final", final_key, video_path)
+        return video_path
@@ -0,0 +1,505 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable
+
+from termcolor import colored
+
+from src.tracing import Span, span
+
+# バックエンドごとの既定の上限。環境変数RATE_LIMIT_<BACKEND>_<NAME>で上書きできる
+# rpm/tpm: 1分あたりのリクエスト数/トークン数（0は無制限）
+# concurrency: 同時に実行するリクエストの上限（AIMDで1〜この値の間を調整する）
+# latency: この秒数より遅い応答を過負荷とみなす（0は判定しない）
+BACKEND_LIMITS = {
+    "chat": {"rpm": 500, "tpm": 30000, "concurrency": 8, "latency": 0},
+    "image": {"rpm": 5, "tpm": 0, "concurrency": 3, "latency": 0},
+    "tts": {"rpm": 0, "tpm": 0, "concurrency": 4, "latency": 15},
+}
+
+# バケットに貯められる量（秒数分）。これを超える瞬間的な集中は平準化される
+BURST_SECONDS = 10
+
+# 過負荷のときに同時実行数を減らす割合と、続けて減らさない期間（秒）
+DECREASE_FACTOR = 0.5
+DECREASE_INTERVAL = 2.0
+
+# リースの有効期限（秒）。解放せずに終了したプロセスの分はこの時間で回収される。
+# 実行中のリクエストのリースは、プロセスのスレッドがLEASE_HEARTBEAT秒ごとに延長する
+LEASE_TTL = 60
+LEASE_HEARTBEAT = LEASE_TTL / 3
+
+# 過負荷とみなすHTTPステータス
+OVERLOAD_STATUSES = (429, 500, 502, 503, 504)
+
+
+class Slot:
+    """
+    レート制限の枠を確保した1つのリクエスト。
+
+    呼び出し側はrecordで応答の内容を記録します。枠を解放するときに、
+    その内容から同時実行数を増やすか減らすかを決めます。
+
+    Attributes:
+        tokens (int): 確保したトークン数（見積もり）。
+        status (int): 応答のHTTPステータス。
+        tokens_used (int): 実際に使用したトークン数。見積もりとの差はバケットに戻します。
+        overloaded (bool): 過負荷の兆候（内部での再試行など）があったかどうか。
+        latency (float): 応答までの時間（秒）。
+    """
+
+    def __init__(self, tokens: int = 0):
+        self.tokens = tokens
+        self.status = None
+        self.tokens_used = None
+        self.overloaded = False
+        self.latency = None
+        self._started = time.perf_counter()
+
+    def record(self, status: int = None, tokens_used: int = None, overloaded: bool = False):
+        """
+        応答の内容を記録します。最初に呼び出した時点までを応答時間とします
+        （ストリーミングの場合は最初のチャンクを受信した時点で呼び出します）。
+        """
+        if self.latency is None:
+            self.latency = time.perf_counter() - self._started
+        if status is not None:
+            self.status = status
+        if tokens_used is not None:
+            self.tokens_used = tokens_used
+        self.overloaded = self.overloaded or overloaded or status in OVERLOAD_STATUSES
+
+
+class RateLimiter:
+    """
+    1つのバックエンドへのリクエストを制限する、プロセス間で共有できるレートリミッター。
+
+    1分あたりのリクエスト数とトークン数をそれぞれトークンバケットで制限し、
+    同時実行数をAIMDで調整します（成功するたびに少しずつ増やし、429/5xxや遅い応答で半分にする）。
+    状態はSQLiteに保存し、BEGIN IMMEDIATEで更新するため、同じホストの複数のプロセスが
+    同じファイルを使うと、全体で上限を超えません。
+    確保中のリースはバックグラウンドのスレッドが延長し続けるため、LEASE_TTLより長い
+    リクエストでも期限切れになりません。解放せずに終了したプロセスのリースはLEASE_TTLで回収されます。
+
+    Args:
+        backend (str): バックエンドの名前（例: "chat"）。
+        path (str): SQLiteデータベースファイルのパス。
+        rpm (float): 1分あたりのリクエスト数の上限。0は無制限。
+        tpm (float): 1分あたりのトークン数の上限。0は無制限。
+        max_concurrency (int): 同時実行数の上限。
+        latency_target (float): この秒数より遅い応答を過負荷とみなします。0は判定しません。
+    """
+
+    def __init__(
+        self,
+        backend: str,
+        path: str,
+        rpm: float = 0,
+        tpm: float = 0,
+        max_concurrency: int = 4,
+        latency_target: float = 0,
+    ):
+        self.backend = backend
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max(1, max_concurrency)
+        self.latency_target = latency_target
+        self.request_capacity = max(1.0, rpm * BURST_SECONDS / 60)
+        self.token_capacity = max(1.0, tpm * BURST_SECONDS / 60)
+        self._held = set()
+        self._held_lock = threading.Lock()
+        self._keeper = None
+        self._stopped = threading.Event()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS buckets (
+                    backend TEXT PRIMARY KEY,
+                    requests REAL NOT NULL,
+                    tokens REAL NOT NULL,
+                    concurrency REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    blocked_until REAL NOT NULL,
+                    decreased_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS leases (
+                    id TEXT PRIMARY KEY,
+                    backend TEXT NOT NULL,
+                    tokens REAL NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        # 読み込みから書き込みまでの間に他のプロセスが更新しないよう、最初に書き込みロックを取る
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def _load(self, conn: sqlite3.Connection, now: float) -> dict:
+        row = conn.execute(
+            "SELECT requests, tokens, concurrency, updated_at, blocked_until, decreased_at "
+            "FROM buckets WHERE backend = ?",
+            (self.backend,),
+        ).fetchone()
+        if row is None:
+            return {
+                "requests": self.request_capacity,
+                "tokens": self.token_capacity,
+                "concurrency": float(self.max_concurrency),
+                "blocked_until": 0.0,
+                "decreased_at": 0.0,
+            }
+        requests, tokens, concurrency, updated_at, blocked_until, decreased_at = row
+        elapsed = max(0.0, now - updated_at)
+        return {
+            "requests": min(self.request_capacity, requests + elapsed * self.rpm / 60),
+            "tokens": min(self.token_capacity, tokens + elapsed * self.tpm / 60),
+            # 設定の上限が下げられた場合にも従う
+            "concurrency": min(concurrency, float(self.max_concurrency)),
+            "blocked_until": blocked_until,
+            "decreased_at": decreased_at,
+        }
+
+    def _save(self, conn: sqlite3.Connection, state: dict, now: float):
+        conn.execute(
+            "INSERT OR REPLACE INTO buckets "
+            "(backend, requests, tokens, concurrency, updated_at, blocked_until, decreased_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (self.backend, state["requests"], state["tokens"], state["concurrency"], now,
+             state["blocked_until"], state["decreased_at"]),
+        )
+
+    def _hold(self, lease_id: str):
+        # このプロセスが確保しているリースとして、延長の対象にする
+        with self._held_lock:
+            self._held.add(lease_id)
+            if self._keeper is None:
+                self._keeper = threading.Thread(
+                    target=self._heartbeat, name=f"ratelimit-{self.backend}", daemon=True)
+                self._keeper.start()
+
+    def _heartbeat(self):
+        # プロセスが終了するまで、確保中のリースをまとめて延長し続ける
+        while not self._stopped.wait(LEASE_HEARTBEAT):
+            with self._held_lock:
+                held = list(self._held)
+            if held:
+                self.renew(held)
+
+    def renew(self, lease_ids: list) -> int:
+        """
+        リースの有効期限を現在からLEASE_TTL秒後まで延長します。
+
+        Args:
+            lease_ids (list): 延長するリースのID。
+
+        Returns:
+            int: 延長できたリースの数。期限切れで回収されたリースは含みません。
+        """
+        expires_at = time.time() + LEASE_TTL
+        with self._transaction() as conn:
+            return sum(
+                conn.execute(
+                    "UPDATE leases SET expires_at = ? WHERE id = ?", (expires_at, lease_id)
+                ).rowcount
+                for lease_id in lease_ids
+            )
+
+    def acquire(self, tokens: int = 0) -> str:
+        """
+        リクエストの枠を確保します。確保できるまで待機します。
+
+        1回で必要なトークン数がバケットの容量を超える場合は、バケットが満杯になった時点で
+        確保し、不足分は後のリクエストが待つことで返済します。
+
+        Args:
+            tokens (int): 使用するトークン数の見積もり。
+
+        Returns:
+            str: リースのID。releaseに渡します。
+        """
+        lease_id = uuid.uuid4().hex
+        with span("ratelimit.acquire", backend=self.backend, tokens=tokens) as current:
+            waits = 0
+            while True:
+                now = time.time()
+                with self._transaction() as conn:
+                    state = self._load(conn, now)
+                    conn.execute(
+                        "DELETE FROM leases WHERE backend = ? AND expires_at < ?",
+                        (self.backend, now),
+                    )
+                    in_flight = conn.execute(
+                        "SELECT COUNT(*) FROM leases WHERE backend = ?", (self.backend,)
+                    ).fetchone()[0]
+                    needed_tokens = min(tokens, self.token_capacity)
+
+                    wait = 0.0
+                    if state["blocked_until"] > now:
+                        wait = max(wait, state["blocked_until"] - now)
+                    if self.rpm and state["requests"] < 1:
+                        wait = max(wait, (1 - state["requests"]) * 60 / self.rpm)
+                    if self.tpm and state["tokens"] < needed_tokens:
+                        wait = max(wait, (needed_tokens - state["tokens"]) * 60 / self.tpm)
+                    if in_flight >= int(state["concurrency"]):
+                        wait = max(wait, 0.1)  # 他のリクエストが終わるのを待つ
+
+                    if wait == 0.0:
+                        if self.rpm:
+                            state["requests"] -= 1
+                        if self.tpm:
+                            state["tokens"] -= tokens
+                        conn.execute(
+                            "INSERT INTO leases (id, backend, tokens, expires_at) "
+                            "VALUES (?, ?, ?, ?)",
+                            (lease_id, self.backend, tokens, now + LEASE_TTL),
+                        )
+                    self._save(conn, state, now)
+
+                if wait == 0.0:
+                    self._hold(lease_id)
+                    current.set(waits=waits)
+                    return lease_id
+                waits += 1
+                # 複数のプロセスが同時に再確認しないよう、待機時間をばらつかせる
+                time.sleep(min(wait, 1.0) * random.uniform(1.0, 1.2))
+
+    def release(
+        self,
+        lease_id: str,
+        latency: float = None,
+        overloaded: bool = False,
+        tokens_used: int = None,
+        retry_after: float = None,
+    ):
+        """
+        枠を解放し、結果に応じて同時実行数を調整します。
+
+        Args:
+            lease_id (str): acquireが返したリースのID。
+            latency (float): 応答までの時間（秒）。
+            overloaded (bool): 429/5xxやタイムアウトなど、過負荷の応答だったかどうか。
+            tokens_used (int): 実際に使用したトークン数。
+            retry_after (float): サーバーが指定した再試行までの秒数。その間は新しい枠を確保しません。
+        """
+        with self._held_lock:
+            self._held.discard(lease_id)
+        now = time.time()
+        if self.latency_target and latency is not None and latency > self.latency_target:
+            overloaded = True
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT tokens FROM leases WHERE id = ?", (lease_id,)
+            ).fetchone()
+            conn.execute("DELETE FROM leases WHERE id = ?", (lease_id,))
+            state = self._load(conn, now)
+            if row is not None and tokens_used is not None and self.tpm:
+                state["tokens"] = min(self.token_capacity, state["tokens"] + row[0] - tokens_used)
+            if overloaded:
+                # 同時に失敗したリクエストで何度も半分にしないよう、一定時間に1回だけ減らす
+                if now - state["decreased_at"] >= DECREASE_INTERVAL:
+                    state["concurrency"] = max(1.0, state["concurrency"] * DECREASE_FACTOR)
+                    state["decreased_at"] = now
+                if retry_after:
+                    state["blocked_until"] = max(state["blocked_until"], now + retry_after)
+            else:
+                # 同時実行数の分だけ成功すると1増える
+                state["concurrency"] = min(
+                    float(self.max_concurrency),
+                    state["concurrency"] + 1 / max(1.0, state["concurrency"]),
+                )
+            self._save(conn, state, now)
+
+    @contextmanager
+    def slot(self, tokens: int = 0):
+        """
+        枠を確保し、ブロックを抜けるときに解放します。
+
+        ブロック内で例外が発生した場合は、429/5xx・タイムアウト・接続エラーを過負荷として扱います。
+
+        Args:
+            tokens (int): 使用するトークン数の見積もり。
+
+        Yields:
+            Slot: 応答の内容を記録するオブジェクト。
+        """
+        lease_id = self.acquire(tokens)
+        current = Slot(tokens)
+        retry_after = None
+        try:
+            yield current
+        except BaseException as e:
+            if is_overload_error(e):
+                current.record(overloaded=True)
+                retry_after = retry_after_seconds(e)
+            raise
+        finally:
+            current.record()
+            self.release(
+                lease_id,
+                latency=current.latency,
+                overloaded=current.overloaded,
+                tokens_used=current.tokens_used,
+                retry_after=retry_after,
+            )
+
+
+def status_code_of(error: BaseException) -> int:
+    """
+    例外に含まれるHTTPステータスを返します（openaiとrequestsの例外に対応）。
+    """
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+
+def is_overload_error(error: BaseException) -> bool:
+    """
+    例外が過負荷（429/5xx、タイムアウト、接続エラー）によるものかどうかを返します。
+    """
+    if not isinstance(error, Exception):
+        return False
+    status = status_code_of(error)
+    if status is not None:
+        return status in OVERLOAD_STATUSES
+    name = type(error).__name__
+    return isinstance(error, (TimeoutError, ConnectionError)) or "Timeout" in name or "Connection" in name
+
+
+def retry_after_seconds(error: BaseException) -> float:
+    """
+    例外のレスポンスのRetry-Afterヘッダーの秒数を返します。ない場合はNone。
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(backend: str) -> RateLimiter:
+    """
+    バックエンドのレートリミッターを返します。
+
+    状態の保存先は環境変数RATE_LIMIT_PATH、上限はRATE_LIMIT_<BACKEND>_RPM・_TPM・
+    _CONCURRENCY・_LATENCYで指定します（既定値はBACKEND_LIMITS）。
+
+    Args:
+        backend (str): バックエンドの名前（"chat"、"image"、"tts"）。
+
+    Returns:
+        RateLimiter: プロセス全体で共有するレートリミッター。RATE_LIMIT=0の場合はNone。
+    """
+    if os.getenv("RATE_LIMIT", "1") == "0":
+        return None
+    with _rate_limiters_lock:
+        if backend not in _rate_limiters:
+            limits = {
+                name: float(os.getenv(f"RATE_LIMIT_{backend.upper()}_{name.upper()}", str(value)))
+                for name, value in BACKEND_LIMITS[backend].items()
+            }
+            _rate_limiters[backend] = RateLimiter(
+                backend,
+                os.getenv("RATE_LIMIT_PATH", "./cache/ratelimit.sqlite3"),
+                rpm=limits["rpm"],
+                tpm=limits["tpm"],
+                max_concurrency=int(limits["concurrency"]),
+                latency_target=limits["latency"],
+            )
+        return _rate_limiters[backend]
+
+
+@contextmanager
+def rate_limited(backend: str, tokens: int = 0):
+    """
+    バックエンドの枠を確保してブロックを実行します。レート制限が無効な場合はそのまま実行します。
+
+    Args:
+        backend (str): バックエンドの名前。
+        tokens (int): 使用するトークン数の見積もり。
+
+    Yields:
+        Slot: 応答の内容を記録するオブジェクト。
+    """
+    limiter = get_rate_limiter(backend)
+    if limiter is None:
+        yield Slot(tokens)
+        return
+    with limiter.slot(tokens) as current:
+        yield current
+
+
+def call_with_rate_limit(
+    backend: str,
+    fn: Callable[[Slot], object],
+    tokens: int = 0,
+    retries: int = 3,
+    backoff_factor: float = 1.0,
+    current_span: Span = None,
+):
+    """
+    バックエンドの枠を確保して関数を呼び出し、過負荷で失敗した場合は待ってから再試行します。
+
+    待機時間はRetry-Afterがあればその秒数、なければ指数関数的に増やし、ばらつかせます。
+    再試行のたびに枠を確保し直すため、失敗はAIMDの調整にも反映されます。
+    current_spanを渡すと、再試行の回数と待機時間の合計（属性"backoff_seconds"）を記録し、
+    トレースで1回の遅い呼び出しと再試行を区別できるようにします。
+
+    Args:
+        backend (str): バックエンドの名前。
+        fn (Callable[[Slot], object]): 呼び出す関数。確保したSlotを受け取ります。
+        tokens (int): 使用するトークン数の見積もり。
+        retries (int): 再試行の回数。
+        backoff_factor (float): 再試行までの待機時間の基準（秒）。
+        current_span (Span): 呼び出しを囲むスパン。
+
+    Returns:
+        object: fnの戻り値。
+    """
+    for attempt in range(retries + 1):
+        try:
+            with rate_limited(backend, tokens) as current:
+                return fn(current)
+        except Exception as e:
+            if attempt == retries or not is_overload_error(e):
+                raise
+            delay = retry_after_seconds(e) or backoff_factor * 2 ** attempt * random.uniform(0.5, 1.5)
+            print(colored(f"[-] {backend} request failed ({e}), retrying in {delay:.1f}s...", "red"))
+            if current_span is not None:
+                current_span.add_retries(1)
+                current_span.set(
+                    backoff_seconds=current_span.attrs.get("backoff_seconds", 0.0) + delay)
+            time.sleep(delay)
@@ -0,0 +1,183 @@
+import os
+from pathlib import Path
+from typing import List, NamedTuple
+
+# 字幕の見た目（ASS）。解像度に対する割合で指定する。
+# フォントは環境変数SUBTITLE_FONTで上書きできる（get_subtitle_styleで読み込む）
+SUBTITLE_STYLE = {
+    "font": "Noto Sans CJK JP",
+    "font_size": 0.04,  # 高さに対する文字の大きさ
+    "margin_v": 0.15,  # ショートの操作ボタンと重ならないよう、下端から離す
+    "margin_h": 0.06,
+    "outline": 0.003,
+}
+
+
+class Cue(NamedTuple):
+    """
+    字幕の1つの表示区間。
+
+    Attributes:
+        start (float): 表示を開始する時刻（秒）。
+        end (float): 表示を終了する時刻（秒）。
+        text (str): 表示する文章。
+    """
+
+    start: float
+    end: float
+    text: str
+
+
+def get_subtitle_mode(mode: str = None) -> str:
+    """
+    字幕の付け方を返します。
+
+    Args:
+        mode (str): "off"（付けない）、"soft"（字幕トラックとして追加）、
+            "burn"（映像に焼き込む）。省略時は環境変数SUBTITLES（既定値"off"）。
+
+    Returns:
+        str: 字幕の付け方。
+    """
+    mode = mode or os.getenv("SUBTITLES", "off")
+    if mode not in ("off", "soft", "burn"):
+        raise ValueError(f"Unknown subtitle mode: {mode}")
+    return mode
+
+
+def get_subtitle_style() -> dict:
+    """
+    字幕の見た目を返します。
+
+    モジュールを読み込んだ後で（load_dotenvなどで）設定された環境変数も反映するよう、
+    呼び出すたびにSUBTITLE_FONTを読み込みます。
+
+    Returns:
+        dict: SUBTITLE_STYLEのフォントを環境変数SUBTITLE_FONTで上書きしたもの。
+    """
+    return {**SUBTITLE_STYLE, "font": os.getenv("SUBTITLE_FONT", SUBTITLE_STYLE["font"])}
+
+
+def clip_subtitle_text(clip: dict) -> str:
+    """
+    クリップの字幕の文章を返します。スクリプトに"subtitles"がなければ読み上げる文章を使います。
+    """
+    text = clip.get("subtitles")
+    if not isinstance(text, str) or not text.strip():
+        text = clip["text"]
+    return " ".join(text.split())
+
+
+def build_cues(clips: List[dict], durations: List[float]) -> List[Cue]:
+    """
+    各クリップの表示時間から、動画全体の字幕の表示区間を作成します。
+
+    Args:
+        clips (List[dict]): クリップ情報のリスト。
+        durations (List[float]): 各クリップの表示時間（秒）。レンダリングで使用したものと同じ値。
+
+    Returns:
+        List[Cue]: クリップの順番通りの表示区間。
+    """
+    cues = []
+    start = 0.0
+    for clip, duration in zip(clips, durations):
+        cues.append(Cue(start, start + duration, clip_subtitle_text(clip)))
+        start += duration
+    return cues
+
+
+def format_srt(cues: List[Cue]) -> str:
+    """
+    表示区間をSRT形式に変換します。
+    """
+    def timestamp(seconds: float) -> str:
+        ms = int(round(seconds * 1000))
+        return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d},{ms % 1000:03d}"
+
+    blocks = [
+        f"{i}\n{timestamp(cue.start)} --> {timestamp(cue.end)}\n{cue.text}\n"
+        for i, cue in enumerate(cues, start=1)
+    ]
+    return "\n".join(blocks)
+
+
+def format_ass(cues: List[Cue], width: int, height: int) -> str:
+    """
+    表示区間を、指定した解像度向けのASS形式に変換します。
+
+    長い文章はlibassが画面の幅で折り返します。
+    """
+    def timestamp(seconds: float) -> str:
+        cs = int(round(seconds * 100))
+        return f"{cs // 360000}:{cs // 6000 % 60:02d}:{cs // 100 % 60:02d}.{cs % 100:02d}"
+
+    style = get_subtitle_style()
+    font_size = round(height * style["font_size"])
+    outline = max(1, round(height * style["outline"]))
+    margin_h = round(width * style["margin_h"])
+    margin_v = round(height * style["margin_v"])
+    lines = [
+        "[Script Info]",
+        "ScriptType: v4.00+",
+        f"PlayResX: {width}",
+        f"PlayResY: {height}",
+        "WrapStyle: 0",
+        "ScaledBorderAndShadow: yes",
+        "",
+        "[V4+ Styles]",
+        "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, "
+        "BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, "
+        "BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding",
+        f"Style: Default,{style['font']},{font_size},&H00FFFFFF,&H000000FF,&H00000000,"
+        f"&H80000000,-1,0,0,0,100,100,0,0,1,{outline},0,2,{margin_h},{margin_h},{margin_v},1",
+        "",
+        "[Events]",
+        "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text",
+    ]
+    for cue in cues:
+        # ASSで特別な意味を持つ文字を無効にする
+        text = cue.text.replace("\\", "＼").replace("{", "｛").replace("}", "｝")
+        lines.append(
+            f"Dialogue: 0,{timestamp(cue.start)},{timestamp(cue.end)},Default,,0,0,0,,{text}")
+    return "\n".join(lines) + "\n"
+
+
+def write_subtitles(cues: List[Cue], path: Path, width: int = None, height: int = None) -> str:
+    """
+    字幕をファイルに書き込みます。拡張子が".ass"の場合はASS形式、それ以外はSRT形式。
+
+    Args:
+        cues (List[Cue]): 表示区間。
+        path (Path): 書き込むファイルのパス。
+        width (int): ASS形式の場合の動画の幅。
+        height (int): ASS形式の場合の動画の高さ。
+
+    Returns:
+        str: 書き込んだファイルのパス。
+    """
+    path = Path(path)
+    if path.suffix == ".ass":
+        content = format_ass(cues, width, height)
+    else:
+        content = format_srt(cues)
+    path.write_text(content, encoding="utf-8")
+    return str(path)
+
+
+def subtitles_filter(path: str) -> str:
+    """
+    字幕を焼き込むffmpegのフィルタを作成します。
+
+    Args:
+        path (str): ASS形式の字幕ファイルのパス。
+
+    Returns:
+        str: filter_complexに追加するフィルタ。
+    """
+    # オプションの値としてのエスケープと、フィルタグラフとしてのエスケープを順に行う
+    value = str(path).replace("\\", "/")
+    for char in "':":
+        value = value.replace(char, "\\" + char)
+    escaped = "".join("\\" + char if char in "\\'[],;" else char for char in value)
+    return f"subtitles=filename={escaped}"
@@ -1,41 +1,106 @@
 import requests
+from requests.adapters import HTTPAdapter
 from pydub import AudioSegment
-import io
-import uuid
-from pathlib import Path
 from termcolor import colored
 import os
-from dotenv import load_dotenv
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-# tempフォルダのパスを定義（存在しない場合は作成）
-temp_folder = Path("./temp")
-temp_folder.mkdir(exist_ok=True)
+from src.audio import concatenate, decode_wav, normalization_gain, to_samples, to_segment
+from src.cache import DiskCache, make_cache_key
+from src.clients import get_client
+from src.ratelimit import OVERLOAD_STATUSES, call_with_rate_limit
+from src.tracing import propagate, span
 
 
-def generate_audio_for_clips(clips):
+def generate_audio_for_clips(clips, max_workers: int = None, previous_gain_db: float = None):
     """
-    Generate audio files for each clip in the given list.
+    Generate audio for each clip in the given list.
+
+    All clips are synthesized concurrently. The audio is kept in memory as PCM
+    (an AudioSegment in the "audio" key of each clip) and is streamed to the
+    encoder later, so no intermediate audio files are written. The audio of
+    each clip is assigned in clip order once every clip has finished. Clips
+    that already have audio (e.g. restored from a checkpoint) are skipped.
 
     Args:
         clips (list): A list of clips, where each clip is a dictionary containing the "text" key.
+        max_workers (int): Maximum number of clips synthesized at the same time.
+            Defaults to the TTS_MAX_WORKERS environment variable (4).
+        previous_gain_db (float): The loudness gain of a previous run of the same
+            job, passed on to normalize_loudness.
 
     Returns:
-        None
+        dict: The clips with "audio" added to each clip (None if generation failed)
+            and the loudness gain in "gain_db" (see normalize_loudness).
     """
-    for clip in clips["clips"]:
-        filename = f"{str(uuid.uuid4())}.mp3"
-        filepath = temp_folder / filename  # 保存するファイルパス
-        text = clip["text"]  # 音声に変換するテキスト
-
-        combined_audio = process_and_combine_audio(text)
-        if combined_audio:
-            combined_audio.export(filepath, format="mp3")
-            clip["audio_path"] = str(filepath)  # 生成した音声ファイルのパスをJSONに追加
-        else:
-            clip["audio_path"] = None  # 音声生成に失敗した場合
+    if max_workers is None:
+        max_workers = int(os.getenv("TTS_MAX_WORKERS", "4"))
+
+    pending = [clip for clip in clips["clips"] if clip.get("audio") is None]
+    texts = [clip["text"] for clip in pending]  # 音声に変換するテキスト
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        audios = list(executor.map(propagate(process_and_combine_audio), texts))
+
+    for clip, audio in zip(pending, audios):
+        clip["audio"] = audio  # 生成した音声（PCM）をJSONに追加
+    normalize_loudness(clips, previous_gain_db)
+
+    cache = get_tts_client().cache
+    if cache is not None:
+        stats = cache.stats()
+        print(colored(
+            f"[+] TTS cache: {stats['hits']} hits, {stats['misses']} misses", "green"))
     return clips
 
 
+def normalize_loudness(clips, previous_gain_db: float = None) -> float:
+    """
+    Measure the loudness of the whole short and store the gain that brings it to the target.
+
+    The integrated loudness and peak are measured on the PCM already in memory
+    (see src.audio.measure_loudness), so no extra decode or ffmpeg loudnorm pass
+    is needed. The samples are not modified: the same gain is stored in
+    "gain_db" of every clip and applied by the encoder as a volume filter in
+    the encode that already runs. The gain is limited so that the sample peak
+    stays below LOUDNESS_PEAK_CEILING.
+
+    The gain is part of every clip's video key, so when a previous gain is
+    given (e.g. from the checkpoint of a resumed job) it is kept unless the
+    new one differs by more than LOUDNESS_TOLERANCE dB. Editing one clip then
+    only re-encodes that clip instead of every clip of the short.
+
+    Args:
+        clips (dict): The clips with "audio" in each clip.
+        previous_gain_db (float): The gain used by a previous run, if any.
+
+    Returns:
+        float: The gain in dB (0 if normalization is disabled or the audio is silent).
+    """
+    gain_db = 0.0
+    if os.getenv("LOUDNESS_NORMALIZE", "1") != "0":
+        samples = [
+            to_samples(clip["audio"]) for clip in clips["clips"]
+            if isinstance(clip.get("audio"), AudioSegment)
+        ]
+        if samples:
+            with span("audio.loudness", clips=len(samples)):
+                gain_db = round(normalization_gain(
+                    concatenate(samples),
+                    target_lufs=float(os.getenv("LOUDNESS_TARGET", "-14")),
+                    peak_ceiling_db=float(os.getenv("LOUDNESS_PEAK_CEILING", "-1")),
+                ), 2)
+            if previous_gain_db is not None and abs(gain_db - previous_gain_db) <= float(
+                os.getenv("LOUDNESS_TOLERANCE", "0.5")
+            ):
+                gain_db = previous_gain_db
+            print(colored(f"[+] Loudness gain: {gain_db:+.2f} dB", "green"))
+
+    for clip in clips["clips"]:
+        clip["gain_db"] = gain_db
+    return gain_db
+
+
 def process_and_combine_audio(text: str) -> AudioSegment:
     """
     Process and combine audio segments for each paragraph in the given text.
@@ -44,28 +109,170 @@ def process_and_combine_audio(text: str) -> AudioSegment:
         text (str): The input text.
 
     Returns:
-        AudioSegment: The combined audio segment.
+        AudioSegment: The combined audio segment, in the PCM format expected by
+            the encoder (see src.audio).
 
     """
     text_no_newlines = text.replace("\n\n", "")
     paragraphs = [f"{p}。" for p in text_no_newlines.split("。") if p]
 
-    combined_audio = None
-    for i, paragraph in enumerate(paragraphs):
-        print(
-            colored(f"[+] Processing paragraph {i+1}/{len(paragraphs)}...", "yellow"))
-        audio_content = get_tts_audio(paragraph)
-        if audio_content:
-            current_audio = AudioSegment.from_file(
-                io.BytesIO(audio_content), format="wav")
-            silence = AudioSegment.silent(duration=1000)  # 1秒の無音を追加
-            combined_audio = combined_audio + silence + \
-                current_audio if combined_audio else current_audio
-    return combined_audio
+    print(colored(f"[+] Processing {len(paragraphs)} paragraphs...", "yellow"))
+    # 文ごとのリクエストは並列に送り、結果は元の順番で結合する
+    audio_contents = get_tts_client().synthesize_many(paragraphs)
+
+    # 文と文の間には1秒の無音を挟み、1回のコピーで結合する
+    segments = [decode_wav(content) for content in audio_contents if content]
+    if not segments:
+        return None
+    return to_segment(concatenate(segments, gap_ms=1000))
+
+
+# Default synthesis parameters for the Style-Bert-VITS2 API
+TTS_PARAMS = {
+    "encoding": "utf-8",
+    "model_id": 4,
+    "speaker_id": 0,
+    "sdp_ratio": 0.6,
+    "noise": 0.7,
+    "noisew": 1.1,
+    "length": 0.75,
+    "language": "JP",
+    "auto_split": True,
+    "split_interval": 0.5,
+    "assist_text_weight": 1,
+    "style": "Neutral",
+    "style_weight": 5,
+}
+
+
+class TTSClient:
+    """
+    Reusable client for the Style-Bert-VITS2 API.
+
+    Connections are kept alive in a pool and the number of in-flight requests is
+    capped at max_concurrency across all threads sharing the client. Requests go
+    through the shared "tts" rate limiter, which caps concurrency across every
+    process on the host and backs off when the server slows down or fails.
+    Transient failures are retried by the limiter, not by the HTTP adapter, so
+    every attempt takes its own slot and counts towards the backoff.
+
+    Args:
+        url (str): The TTS endpoint. Defaults to the TTS_API_URL environment variable.
+        max_concurrency (int): Maximum number of simultaneous requests.
+            Defaults to the TTS_MAX_CONCURRENCY environment variable (4).
+        timeout (tuple): Connect and read timeouts in seconds.
+        retries (int): Number of retries for connection errors and 429/5xx responses.
+        backoff_factor (float): Backoff factor between retries.
+        params (dict): Synthesis parameters overriding TTS_PARAMS.
+        cache (DiskCache): Cache for synthesized WAV bytes, keyed on the text and
+            every synthesis parameter. None disables caching.
+    """
+
+    def __init__(
+        self,
+        url: str = None,
+        max_concurrency: int = None,
+        timeout: tuple = (5, 120),
+        retries: int = 3,
+        backoff_factor: float = 0.5,
+        params: dict = None,
+        cache: DiskCache = None,
+    ):
+        self.url = url or os.getenv("TTS_API_URL")
+        self.max_concurrency = max(
+            1, max_concurrency or int(os.getenv("TTS_MAX_CONCURRENCY", "4")))
+        self.timeout = timeout
+        self.params = {**TTS_PARAMS, **(params or {})}
+        self.cache = cache
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.max_concurrency, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._semaphore = threading.BoundedSemaphore(self.max_concurrency)
+
+    def synthesize(self, text: str) -> bytes:
+        """
+        Get text-to-speech audio for the given text.
+
+        Args:
+            text (str): The text to convert to audio.
+
+        Returns:
+            bytes: The audio content in bytes if successful, None otherwise.
+        """
+        with span("tts.synthesize", characters=len(text)) as current:
+            return self._synthesize(text, current)
+
+    def _synthesize(self, text: str, current) -> bytes:
+        params = {**self.params, "text": text}
+        cache_key = make_cache_key(**params)
+        if self.cache is not None:
+            audio_content = self.cache.get(cache_key)
+            current.set(cache_hit=audio_content is not None)
+            if audio_content is not None:
+                return audio_content
+
+        def request(slot):
+            response = self.session.get(self.url, params=params, timeout=self.timeout)
+            slot.record(status=response.status_code)
+            if response.status_code in OVERLOAD_STATUSES:
+                response.raise_for_status()
+            return response
 
+        with self._semaphore:
+            try:
+                response = call_with_rate_limit(
+                    "tts", request, retries=self.retries,
+                    backoff_factor=self.backoff_factor, current_span=current)
+            except requests.RequestException as e:
+                print(colored(f"[-] TTS request failed: {e}", "red"))
+                return None
+        current.add_bytes(len(response.content))
+        current.set(status=response.status_code)
+        if response.status_code == 200 and "audio/wav" in response.headers.get("Content-Type", ""):
+            if self.cache is not None:
+                self.cache.put(cache_key, response.content)
+            return response.content
+        return None
+
+    def synthesize_many(self, texts: list) -> list:
+        """
+        Synthesize several texts in parallel.
+
+        Args:
+            texts (list): The texts to convert to audio.
+
+        Returns:
+            list: The audio content for each text, in the same order as texts.
+        """
+        if not texts:
+            return []
+        workers = min(self.max_concurrency, len(texts))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(propagate(self.synthesize), texts))
+
+
+def get_tts_client() -> TTSClient:
+    """
+    Return the TTS client shared by the whole process.
+
+    Returns:
+        TTSClient: The shared client, created on first use.
+    """
+    def create():
+        cache = DiskCache(
+            os.getenv("TTS_CACHE_DIR", "./cache/tts"),
+            max_bytes=int(os.getenv("TTS_CACHE_MAX_BYTES", str(1024 ** 3))),
+            suffix=".wav",
+        )
+        return TTSClient(cache=cache)
+
+    return get_client("tts", create)
 
-# Load environment variables from .env file
-load_dotenv()
 
 def get_tts_audio(text: str) -> bytes:
     """
@@ -77,27 +284,7 @@ def get_tts_audio(text: str) -> bytes:
     Returns:
         bytes: The audio content in bytes if successful, None otherwise.
     """
-    url = os.getenv("TTS_API_URL")  # Read URL from environment variable
-    params = {
-        "text": text,
-        "encoding": "utf-8",
-        "model_id": 4,
-        "speaker_id": 0,
-        "sdp_ratio": 0.6,
-        "noise": 0.7,
-        "noisew": 1.1,
-        "length": 0.75,
-        "language": "JP",
-        "auto_split": True,
-        "split_interval": 0.5,
-        "assist_text_weight": 1,
-        "style": "Neutral",
-        "style_weight": 5,
-    }
-    response = requests.get(url, params=params)
-    if response.status_code == 200 and "audio/wav" in response.headers.get("Content-Type"):
-        return response.content
-    return None
+    return get_tts_client().synthesize(text)
 
 
 if __name__ == "__main__":
@@ -1,32 +1,17 @@
 import json
-from termcolor import colored
-from openai import OpenAI
-
-client = OpenAI()
-
-
-def generate_script(video_subject: str, num_clips: int) -> dict:
-    """
-    ビデオの主題に応じたスクリプトを生成する。
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
 
-    Args:
-        video_subject (str): ビデオの主題
-        num_clips (int): クリップ数
+from termcolor import colored
 
-    Returns:
-        dict: 生成されたスクリプト
+from src.clients import get_openai_client
+from src.llm import create_json_completion, stream_json_completion
+from src.tracing import propagate
 
-    Raises:
-        json.JSONDecodeError: スクリプトの生成に失敗した場合に発生する例外
-    """
-    # プロンプトの構築
-    prompt_valuables = f"""
-    ビデオの主題に応じたスクリプトを生成してください。
-    主題: {video_subject}
-    クリップ数: {num_clips}
-    """
 
-    prompt_format = """
+# スクリプトの出力形式の指示（generate_scriptとgenerate_scriptsで共通）
+SCRIPT_FORMAT_PROMPT = """
     次の形式のjsonで出力するようにしてください。
     {
     "title": str（ビデオのタイトル）,
@@ -75,23 +60,92 @@ def generate_script(video_subject: str, num_clips: int) -> dict:
     ]
     }
     """
-    response = client.chat.completions.create(
+
+
+def validate_script(script: dict) -> bool:
+    """
+    生成されたスクリプトが期待する形式かどうかを検証する。
+
+    Args:
+        script (dict): 生成されたスクリプト
+
+    Returns:
+        bool: 動画の生成に必要なキーが全て揃っていればTrue
+    """
+    if not isinstance(script, dict):
+        return False
+    if not all(isinstance(script.get(key), str) for key in ("title", "description", "topic")):
+        return False
+    clips = script.get("clips")
+    if not isinstance(clips, list) or not clips:
+        return False
+    return all(
+        isinstance(clip, dict)
+        and isinstance(clip.get("text"), str)
+        and isinstance(clip.get("video_prompt"), str)
+        for clip in clips
+    )
+
+
+def generate_script(
+    video_subject: str,
+    num_clips: int,
+    use_cache: bool = None,
+    refresh: bool = False,
+    on_clip: Callable[[dict], None] = None,
+    on_reset: Callable[[], None] = None,
+) -> dict:
+    """
+    ビデオの主題に応じたスクリプトを生成する。
+
+    Args:
+        video_subject (str): ビデオの主題
+        num_clips (int): クリップ数
+        use_cache (bool): レスポンスキャッシュを使用するかどうか（省略時は環境変数LLM_CACHE）
+        refresh (bool): Trueの場合はキャッシュを読まずに生成し直す
+        on_clip (Callable[[dict], None]): 指定した場合はストリーミングで生成し、
+            クリップが1つ完成するたびに呼び出す（環境変数LLM_STREAM=0の場合は使用しない）。
+            ストリーミングに失敗して生成し直す場合は、先にon_resetを呼び出す
+        on_reset (Callable[[], None]): on_clipに渡したクリップを破棄させる関数
+
+    Returns:
+        dict: 生成されたスクリプト
+
+    Raises:
+        json.JSONDecodeError: スクリプトの生成に失敗した場合に発生する例外
+    """
+    # プロンプトの構築
+    prompt_valuables = f"""
+    ビデオの主題に応じたスクリプトを生成してください。
+    主題: {video_subject}
+    クリップ数: {num_clips}
+    """
+
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {
+            "role": "user",
+            "content": f"次の文章からJSONを生成してください。\n{prompt_valuables}{SCRIPT_FORMAT_PROMPT}",
+        },
+    ]
+    options = dict(
         model="gpt-4-1106-preview",
         # model="gpt-3.5-turbo-1106",
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
-            {
-                "role": "user",
-                "content": f"次の文章からJSONを生成してください。\n{prompt_valuables}{prompt_format}",
-            },
-        ],
+        messages=messages,
         response_format={"type": "json_object"},
+        validate=validate_script,
+        use_cache=use_cache,
+        refresh=refresh,
     )
-
-    script = response.choices[0].message.content.strip()
     # scriptをjsonに変換
     try:
-        script = json.loads(script)
+        if on_clip is not None and os.getenv("LLM_STREAM", "1") != "0":
+            # クリップが完成するたびに音声と画像の生成を始められるようにする
+            script = stream_json_completion(
+                get_openai_client(), item_key="clips", on_item=on_clip, on_reset=on_reset,
+                **options)
+        else:
+            script = create_json_completion(get_openai_client(), **options)
         return script
     except json.JSONDecodeError as e:
         print(colored("スクリプトの生成に失敗しました。", "red"))
@@ -99,6 +153,117 @@ def generate_script(video_subject: str, num_clips: int) -> dict:
         return None
 
 
+def generate_scripts(
+    video_subjects: List[str],
+    num_clips: int,
+    batch_size: int = None,
+    max_retries: int = 1,
+    max_workers: int = 4,
+    use_cache: bool = None,
+) -> List[dict]:
+    """
+    複数の主題のスクリプトを、数件ずつまとめたリクエストで生成する。
+
+    出力形式の長い指示をリクエストごとに1回だけ送り、往復の回数を減らす。
+    主題ごとにvalidate_scriptで検証し、不正なものや欠けているものだけを
+    まとめてmax_retries回まで生成し直す。
+
+    Args:
+        video_subjects (List[str]): ビデオの主題のリスト
+        num_clips (int): 1動画あたりのクリップ数
+        batch_size (int): 1リクエストにまとめる主題の数。出力トークンの上限を超えないよう
+            クリップ数に応じて調整する（省略時は環境変数LLM_SCRIPT_BATCH_SIZE、既定値5）
+        max_retries (int): 失敗した主題を生成し直す回数
+        max_workers (int): 同時に送信するリクエストの上限
+        use_cache (bool): レスポンスキャッシュを使用するかどうか（省略時は環境変数LLM_CACHE）
+
+    Returns:
+        List[dict]: 主題の順番通りのスクリプト。生成に失敗した主題はNone
+    """
+    if batch_size is None:
+        batch_size = int(os.getenv("LLM_SCRIPT_BATCH_SIZE", "5"))
+    batch_size = max(1, batch_size)
+
+    scripts = [None] * len(video_subjects)
+    pending = list(range(len(video_subjects)))
+    for attempt in range(max_retries + 1):
+        if not pending:
+            break
+        if attempt > 0:
+            print(colored(f"[-] Retrying {len(pending)} scripts...", "yellow"))
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+
+        def generate(batch):
+            return _generate_script_batch(
+                [video_subjects[i] for i in batch], num_clips, use_cache=use_cache)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches)))) as executor:
+            results = list(executor.map(propagate(generate), batches))
+        for batch, batch_scripts in zip(batches, results):
+            for i, script in zip(batch, batch_scripts):
+                scripts[i] = script
+        pending = [i for i in pending if scripts[i] is None]
+
+    if pending:
+        print(colored(f"{len(pending)}件のスクリプトの生成に失敗しました。", "red"))
+    return scripts
+
+
+def _generate_script_batch(
+    video_subjects: List[str], num_clips: int, use_cache: bool = None
+) -> List[dict]:
+    # 1回のリクエストで複数の主題のスクリプトを生成し、検証に合格したものだけを返す
+    subject_list = "\n".join(f"    {i}: {subject}" for i, subject in enumerate(video_subjects))
+    prompt_valuables = f"""
+    次の主題の一覧のそれぞれについて、ビデオの主題に応じたスクリプトを生成してください。
+    主題の一覧:
+{subject_list}
+    クリップ数: {num_clips}
+
+    全体は次の形式のjsonで出力し、"scripts"には全ての主題のスクリプトを含めてください。
+    {{"scripts": [{{"index": int（主題の番号）, "script": スクリプト}}, ...]}}
+
+    各スクリプトは、
+    """
+
+    def parse(data):
+        scripts = [None] * len(video_subjects)
+        items = data.get("scripts") if isinstance(data, dict) else None
+        for item in items if isinstance(items, list) else []:
+            if not isinstance(item, dict):
+                continue
+            index = item.get("index")
+            if isinstance(index, int) and 0 <= index < len(scripts) and validate_script(
+                item.get("script")
+            ):
+                scripts[index] = item["script"]
+        return scripts
+
+    from openai import APIError
+
+    try:
+        data = create_json_completion(
+            get_openai_client(),
+            model="gpt-4-1106-preview",
+            messages=[
+                {"role": "system", "content": "You are a helpful assistant."},
+                {
+                    "role": "user",
+                    "content": f"次の文章からJSONを生成してください。\n{prompt_valuables}{SCRIPT_FORMAT_PROMPT}",
+                },
+            ],
+            response_format={"type": "json_object"},
+            # 全ての主題のスクリプトが揃っている場合だけキャッシュする
+            validate=lambda data: all(script is not None for script in parse(data)),
+            use_cache=use_cache,
+        )
+    except (json.JSONDecodeError, APIError) as e:
+        print(colored("スクリプトの生成に失敗しました。", "red"))
+        print(colored("エラー内容: ", "red"), e)
+        return [None] * len(video_subjects)
+    return parse(data)
+
+
 if __name__ == "__main__":
     video_subject = "宇宙の謎"
     num_clips = 2
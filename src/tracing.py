@@ -0,0 +1,326 @@
+import contextvars
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, List
+
+# 現在のジョブのトレーサー（ジョブごとに別のコンテキストで設定する）
+_current_tracer = contextvars.ContextVar("tracer", default=None)
+
+# 子プロセスの最大メモリ使用量（/proc/<pid>/statusのVmHWM）を読み取る間隔（秒）
+RSS_SAMPLE_INTERVAL = 0.05
+
+
+class Span:
+    """
+    1つのステージや外部呼び出しの計測結果。
+
+    Attributes:
+        name (str): スパンの名前（例: "tts.synthesize"）。
+        attrs (dict): 任意の属性。
+        bytes (int): 送受信したバイト数。
+        retries (int): 再試行の回数。
+        child_cpu_seconds (float): 子プロセスが使用したCPU時間（秒）。
+        child_max_rss_kb (int): 子プロセスの最大メモリ使用量（KiB）。計測できない場合はNone。
+        error (str): 例外が発生した場合の内容。
+    """
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.bytes = 0
+        self.retries = 0
+        self.child_cpu_seconds = 0.0
+        self.child_max_rss_kb = None
+        self.error = None
+
+    def set(self, **attrs):
+        """
+        属性を追加します。
+        """
+        self.attrs.update(attrs)
+
+    def add_bytes(self, num_bytes: int):
+        """
+        送受信したバイト数を加算します。
+        """
+        self.bytes += num_bytes
+
+    def add_retries(self, retries: int):
+        """
+        再試行の回数を加算します。
+        """
+        self.retries += retries
+
+
+class Tracer:
+    """
+    1つのジョブのスパンを記録し、JSON LinesとPrometheusのtextfile形式で出力します。
+
+    スパンは終了するたびに<trace_dir>/<job_id>.jsonlへ1行ずつ追記し、
+    closeの時にスパン名ごとの集計を<trace_dir>/<job_id>.promへ書き出します。
+
+    Args:
+        job_id (str): ジョブのID。
+        trace_dir (str): 出力先のディレクトリ。省略時は環境変数TRACE_DIR（既定値./traces）。
+    """
+
+    def __init__(self, job_id: str, trace_dir: str = None):
+        self.job_id = job_id
+        self.trace_dir = Path(trace_dir or os.getenv("TRACE_DIR", "./traces"))
+        self.trace_dir.mkdir(parents=True, exist_ok=True)
+        self.jsonl_path = self.trace_dir / f"{job_id}.jsonl"
+        self.prom_path = self.trace_dir / f"{job_id}.prom"
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def record(self, record: dict):
+        """
+        終了したスパンを記録します。
+
+        Args:
+            record (dict): スパンの計測結果。
+        """
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            with open(self.jsonl_path, "a", encoding="utf-8") as file:
+                file.write(line + "\n")
+            totals = self.totals.setdefault(
+                record["name"],
+                {"count": 0, "errors": 0, "wall": 0.0, "cpu": 0.0, "child_cpu": 0.0,
+                 "child_max_rss": 0, "bytes": 0, "retries": 0},
+            )
+            totals["count"] += 1
+            totals["errors"] += record["error"] is not None
+            totals["wall"] += record["wall_seconds"]
+            totals["cpu"] += record["cpu_seconds"]
+            totals["child_cpu"] += record["child_cpu_seconds"]
+            totals["child_max_rss"] = max(
+                totals["child_max_rss"], record["child_max_rss_kb"] or 0)
+            totals["bytes"] += record["bytes"]
+            totals["retries"] += record["retries"]
+
+    def close(self):
+        """
+        スパン名ごとの集計をPrometheusのtextfile形式で書き出します。
+
+        node_exporterのtextfile collectorが書きかけのファイルを読まないよう、
+        一時ファイルに書いてから置き換えます。
+        """
+        metrics = [
+            ("count", "shortcreator_span_count", "Number of finished spans."),
+            ("errors", "shortcreator_span_errors_total", "Number of spans that raised."),
+            ("wall", "shortcreator_span_wall_seconds_total", "Wall time spent in spans."),
+            ("cpu", "shortcreator_span_cpu_seconds_total", "Thread CPU time spent in spans."),
+            ("child_cpu", "shortcreator_span_child_cpu_seconds_total",
+             "CPU time of child processes (ffmpeg) started in spans."),
+            ("child_max_rss", "shortcreator_span_child_max_rss_kilobytes",
+             "Largest peak RSS of a child process (ffmpeg) started in spans."),
+            ("bytes", "shortcreator_span_bytes_total", "Bytes transferred in spans."),
+            ("retries", "shortcreator_span_retries_total", "Retries performed in spans."),
+        ]
+        lines = []
+        with self._lock:
+            for field, metric, help_text in metrics:
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} gauge")
+                for name, totals in sorted(self.totals.items()):
+                    lines.append(
+                        f'{metric}{{job="{self.job_id}",span="{name}"}} {totals[field]}')
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.trace_dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.prom_path)
+
+
+@contextmanager
+def trace_job(job_id: str, trace_dir: str = None):
+    """
+    ジョブのトレーサーを現在のコンテキストに設定します。
+
+    Args:
+        job_id (str): ジョブのID。
+        trace_dir (str): 出力先のディレクトリ。
+
+    Yields:
+        Tracer: ジョブのトレーサー。
+    """
+    tracer = Tracer(job_id, trace_dir)
+    token = _current_tracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        _current_tracer.reset(token)
+        tracer.close()
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    処理の実行時間やCPU時間などを計測するスパンを開始します。
+
+    トレーサーが設定されていない場合は計測結果を記録しません。
+
+    Args:
+        name (str): スパンの名前。
+        **attrs: スパンの属性。
+
+    Yields:
+        Span: 計測中のスパン。バイト数や再試行回数を追加できます。
+    """
+    current = Span(name, attrs)
+    started_at = time.time()
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield current
+    except BaseException as e:
+        current.error = repr(e)
+        raise
+    finally:
+        tracer = _current_tracer.get()
+        if tracer is not None:
+            tracer.record({
+                "job": tracer.job_id,
+                "name": current.name,
+                "start": started_at,
+                "wall_seconds": time.perf_counter() - wall_start,
+                "cpu_seconds": time.thread_time() - cpu_start,
+                "child_cpu_seconds": current.child_cpu_seconds,
+                "child_max_rss_kb": current.child_max_rss_kb,
+                "bytes": current.bytes,
+                "retries": current.retries,
+                "error": current.error,
+                "attrs": current.attrs,
+                "thread": threading.current_thread().name,
+            })
+
+
+def propagate(fn: Callable) -> Callable:
+    """
+    呼び出し元のコンテキスト（トレーサー）を引き継いで関数を実行するラッパーを返します。
+
+    スレッドプールに渡す関数をこれで包むと、ワーカースレッドで開始したスパンも
+    呼び出し元のジョブに記録されます。
+
+    Args:
+        fn (Callable): ラップする関数。
+
+    Returns:
+        Callable: コンテキストを引き継ぐ関数。
+    """
+    context = contextvars.copy_context()
+
+    def wrapper(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+
+    return wrapper
+
+
+def run_command(
+    cmd: List[str], input: bytes = None, check: bool = True, name: str = None
+) -> subprocess.CompletedProcess:
+    """
+    外部コマンド（ffmpegなど）をスパンの中で実行します。
+
+    subprocess.runと同じように使えます。子プロセスをos.wait4で回収することで、
+    そのプロセスだけのCPU時間を記録します。最大メモリ使用量は、実行中に
+    /proc/<pid>/statusのVmHWMを読み取って記録します（wait4のru_maxrssには
+    execの前にforkした時点の親プロセスのメモリ使用量が含まれてしまうため）。
+    inputを渡さない場合、標準入力は/dev/nullにします（端末から実行しても、
+    ffmpegが上書きの確認などで入力を待って止まらないようにするため）。
+
+    Args:
+        cmd (List[str]): 実行するコマンド。
+        input (bytes): 標準入力に渡すデータ。
+        check (bool): Trueの場合、終了コードが0以外ならCalledProcessErrorを送出します。
+        name (str): スパンの名前。省略時はコマンド名。
+
+    Returns:
+        subprocess.CompletedProcess: 実行結果。
+    """
+    with span(name or cmd[0], command=cmd[0]) as current:
+        process = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL)
+
+        sampler = _RssSampler(process.pid)
+        sampler.start()
+
+        writer = None
+        if input is not None:
+            current.add_bytes(len(input))
+            writer = threading.Thread(target=_write_stdin, args=(process, input))
+            writer.start()
+
+        if hasattr(os, "waitid"):
+            # 回収する前に終了を待ち、PIDが再利用される前に最後のVmHWMを読み取る
+            os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        sampler.stop()
+        if hasattr(os, "wait4"):
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            current.child_cpu_seconds = usage.ru_utime + usage.ru_stime
+        else:
+            process.wait()
+        current.child_max_rss_kb = sampler.max_rss_kb
+        if writer is not None:
+            writer.join()
+
+        current.set(returncode=process.returncode)
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+        return subprocess.CompletedProcess(cmd, process.returncode)
+
+
+class _RssSampler(threading.Thread):
+    """
+    実行中の子プロセスの/proc/<pid>/statusから、最大メモリ使用量（VmHWM）を読み取り続けます。
+
+    VmHWMはexecした後のプロセスの最大値で、単調に増えるため、読み取りの間隔が空いても
+    最後に読み取った値以降の増加分しか取りこぼしません。/procがない環境ではNoneのままです。
+    """
+
+    def __init__(self, pid: int):
+        super().__init__(daemon=True)
+        self.status_path = f"/proc/{pid}/status"
+        self.max_rss_kb = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        while True:
+            self._sample()
+            if self._stopped.wait(RSS_SAMPLE_INTERVAL):
+                return
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self._sample()  # 終了直前（回収前）の値
+
+    def _sample(self):
+        try:
+            with open(self.status_path, encoding="ascii") as file:
+                for line in file:
+                    if line.startswith("VmHWM:"):
+                        self.max_rss_kb = max(self.max_rss_kb or 0, int(line.split()[1]))
+                        return
+        except (OSError, ValueError):
+            pass  # 終了したプロセスや/procのない環境
+
+
+def _write_stdin(process: subprocess.Popen, data: bytes):
+    try:
+        process.stdin.write(data)
+    except BrokenPipeError:
+        pass  # 子プロセスが入力を読み終える前に終了した場合
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
@@ -0,0 +1,310 @@
+import json
+import os
+import random
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from termcolor import colored
+
+from src.cache import make_cache_key
+from src.tracing import propagate, span
+
+# YouTube Data APIの再開可能アップロードのエンドポイント
+UPLOAD_URL = "https://www.googleapis.com/upload/youtube/v3/videos"
+
+# 時間をおいて再試行すれば成功する可能性があるステータスコード
+RETRIABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# チャンクサイズは256KiBの倍数である必要がある
+CHUNK_ALIGNMENT = 256 * 1024
+
+
+class UploadError(Exception):
+    """
+    アップロードが再試行しても成功しなかった場合に発生する例外。
+    """
+
+
+class ResumableUploader:
+    """
+    YouTubeの再開可能アップロードプロトコルで動画をアップロードするクライアント。
+
+    動画は一定サイズのチャンクに分けて送信し、一時的なエラーは指数バックオフで
+    再試行します。アップロードセッションのURIはファイルに保存するため、
+    中断されたアップロードは次回の実行で最初からではなく続きから再開します。
+    upload_urlを変更すれば、ローカルの代替HTTPサーバーに対してテストできます。
+
+    Args:
+        session (requests.Session): 認証済みのセッション（AuthorizedSessionなど）。
+        upload_url (str): アップロードのエンドポイント。省略時はYouTube Data API。
+        chunk_size (int): 1回に送信するバイト数。省略時は環境変数UPLOAD_CHUNK_SIZE（既定値8MiB）。
+        max_retries (int): 連続して失敗した場合に再試行する回数。
+        state_dir (str): アップロードセッションを保存するディレクトリ。
+            省略時は環境変数UPLOAD_STATE_DIR（既定値./cache/uploads）。
+        timeout (tuple): 接続と読み込みのタイムアウト（秒）。
+    """
+
+    def __init__(
+        self,
+        session: requests.Session,
+        upload_url: str = None,
+        chunk_size: int = None,
+        max_retries: int = 8,
+        state_dir: str = None,
+        timeout: tuple = (10, 120),
+    ):
+        self.session = session
+        self.upload_url = upload_url or UPLOAD_URL
+        chunk_size = chunk_size or int(os.getenv("UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))
+        self.chunk_size = max(CHUNK_ALIGNMENT, chunk_size // CHUNK_ALIGNMENT * CHUNK_ALIGNMENT)
+        self.max_retries = max_retries
+        self.state_dir = Path(state_dir or os.getenv("UPLOAD_STATE_DIR", "./cache/uploads"))
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        self.timeout = timeout
+
+    def upload(self, file: str, body: dict) -> dict:
+        """
+        動画をアップロードします。
+
+        Args:
+            file (str): 動画ファイルのパス。
+            body (dict): 動画のメタデータ（snippet、statusなど）。
+
+        Returns:
+            dict: アップロードされた動画のリソース。
+
+        Raises:
+            UploadError: 再試行しても成功しなかった場合に発生する例外
+        """
+        with span("upload", file=os.path.basename(file)) as current:
+            return self._upload(file, body, current)
+
+    def _upload(self, file: str, body: dict, current) -> dict:
+        size = os.path.getsize(file)
+        state_path = self._state_path(file, body)
+        session_uri = self._load_session(state_path)
+        offset = 0
+        if session_uri is not None:
+            print(colored(f"[+] Resuming upload: {file}", "yellow"))
+            offset, response = self._query_offset(session_uri, size, current)
+            if response is not None:
+                state_path.unlink(missing_ok=True)
+                return response
+        if session_uri is None or offset is None:
+            session_uri = self._start_session(size, body)
+            state_path.write_text(json.dumps({"session_uri": session_uri}))
+            offset = 0
+
+        retries = 0
+        with open(file, "rb") as f:
+            while True:
+                f.seek(offset)
+                chunk = f.read(self.chunk_size)
+                end = offset + len(chunk) - 1
+                try:
+                    response = self.session.put(
+                        session_uri,
+                        data=chunk,
+                        headers={
+                            "Content-Length": str(len(chunk)),
+                            "Content-Range": f"bytes {offset}-{end}/{size}",
+                        },
+                        timeout=self.timeout,
+                    )
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    response = None
+                    error = str(e)
+
+                if response is not None and response.status_code in (200, 201):
+                    current.add_bytes(size - offset)
+                    state_path.unlink(missing_ok=True)
+                    print(colored(f"[+] Upload Complete: {file}", "green"))
+                    return response.json()
+                if response is not None and response.status_code == 308:
+                    next_offset = _next_offset(response)
+                    if next_offset > offset:
+                        # サーバーが受け取った分だけを数える（チャンクの一部だけの場合もある）
+                        current.add_bytes(next_offset - offset)
+                        offset = next_offset
+                        retries = 0
+                        print(f"Uploaded {int(offset / size * 100)}%.")
+                        continue
+                    # 受け取った位置が進まない場合は失敗として数え、際限なく繰り返さない
+                    offset = next_offset
+                    error = f"no progress at byte {offset}"
+                elif response is not None and response.status_code in (404, 410):
+                    # セッションの期限切れ。新しいセッションで最初からやり直す
+                    session_uri = self._start_session(size, body)
+                    state_path.write_text(json.dumps({"session_uri": session_uri}))
+                    offset = 0
+                    continue
+                elif response is not None and response.status_code not in RETRIABLE_STATUS_CODES:
+                    raise UploadError(
+                        f"Upload failed with status {response.status_code}: {response.text}")
+                elif response is not None:
+                    error = f"status {response.status_code}"
+
+                retries += 1
+                current.add_retries(1)
+                if retries > self.max_retries:
+                    raise UploadError(f"Upload failed after {self.max_retries} retries: {error}")
+                delay = _backoff(retries)
+                print(colored(f"[-] Upload error ({error}), retrying in {delay:.1f}s...", "red"))
+                time.sleep(delay)
+
+                # サーバーが受け取った位置から再開する
+                queried, response = self._query_offset(session_uri, size, current)
+                if response is not None:
+                    current.add_bytes(size - offset)
+                    state_path.unlink(missing_ok=True)
+                    return response
+                if queried is not None:
+                    current.add_bytes(max(0, queried - offset))
+                    offset = queried
+
+    def _start_session(self, size: int, body: dict) -> str:
+        retries = 0
+        while True:
+            try:
+                response = self.session.post(
+                    self.upload_url,
+                    params={"uploadType": "resumable", "part": ",".join(body.keys())},
+                    json=body,
+                    headers={
+                        "X-Upload-Content-Length": str(size),
+                        "X-Upload-Content-Type": "video/mp4",
+                    },
+                    timeout=self.timeout,
+                )
+                if response.status_code == 200 and "Location" in response.headers:
+                    return response.headers["Location"]
+                if response.status_code not in RETRIABLE_STATUS_CODES:
+                    raise UploadError(
+                        f"Failed to start upload session ({response.status_code}): {response.text}")
+                error = f"status {response.status_code}"
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+
+            retries += 1
+            if retries > self.max_retries:
+                raise UploadError(f"Failed to start upload session: {error}")
+            time.sleep(_backoff(retries))
+
+    def _query_offset(self, session_uri: str, size: int, current=None) -> tuple:
+        """
+        サーバーが受け取ったバイト数を問い合わせます。
+
+        一時的なエラーはチャンクの送信と同じ指数バックオフで再試行します
+        （問い合わせの失敗でセッションを作り直し、最初から送信し直さないため）。
+
+        Returns:
+            tuple: (次に送信する位置, 完了していれば動画のリソース)。
+                セッションが無効な場合、位置はNone。
+
+        Raises:
+            UploadError: 再試行しても問い合わせに成功しなかった場合に発生する例外
+        """
+        retries = 0
+        while True:
+            try:
+                response = self.session.put(
+                    session_uri,
+                    headers={"Content-Length": "0", "Content-Range": f"bytes */{size}"},
+                    timeout=self.timeout,
+                )
+                if response.status_code in (200, 201):
+                    return size, response.json()
+                if response.status_code == 308:
+                    return _next_offset(response), None
+                if response.status_code not in RETRIABLE_STATUS_CODES:
+                    return None, None
+                error = f"status {response.status_code}"
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+
+            retries += 1
+            if current is not None:
+                current.add_retries(1)
+            if retries > self.max_retries:
+                raise UploadError(f"Failed to query upload status: {error}")
+            delay = _backoff(retries)
+            print(colored(
+                f"[-] Upload status error ({error}), retrying in {delay:.1f}s...", "red"))
+            time.sleep(delay)
+
+    def _state_path(self, file: str, body: dict) -> Path:
+        stat = os.stat(file)
+        key = make_cache_key(
+            file=os.path.abspath(file), size=stat.st_size, mtime=stat.st_mtime, body=body)
+        return self.state_dir / f"{key}.json"
+
+    @staticmethod
+    def _load_session(state_path: Path) -> str:
+        try:
+            return json.loads(state_path.read_text())["session_uri"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return None
+
+
+class UploadQueue:
+    """
+    動画のアップロードをバックグラウンドで実行するキュー。
+
+    submitはすぐに戻るため、前の動画のアップロード中も次の動画のレンダリングを続けられます。
+
+    Args:
+        uploader (ResumableUploader): アップロードに使用するクライアント。
+        workers (int): 同時に実行するアップロードの数。
+            省略時は環境変数UPLOAD_WORKERS（既定値1）。
+    """
+
+    def __init__(self, uploader: ResumableUploader, workers: int = None):
+        self.uploader = uploader
+        workers = workers or int(os.getenv("UPLOAD_WORKERS", "1"))
+        self._executor = ThreadPoolExecutor(max(1, workers), thread_name_prefix="upload")
+        self._futures = []
+
+    def submit(self, file: str, body: dict) -> Future:
+        """
+        アップロードをキューに追加します。
+
+        Args:
+            file (str): 動画ファイルのパス。
+            body (dict): 動画のメタデータ。
+
+        Returns:
+            Future: アップロードされた動画のリソースを返すFuture。
+        """
+        future = self._executor.submit(propagate(self.uploader.upload), file, body)
+        self._futures.append((file, future))
+        return future
+
+    def close(self) -> list:
+        """
+        キューに追加された全てのアップロードの完了を待ちます。
+
+        Returns:
+            list: (ファイルのパス, 動画のリソースまたは例外)のリスト。
+        """
+        self._executor.shutdown(wait=True)
+        results = []
+        for file, future in self._futures:
+            error = future.exception()
+            if error is not None:
+                print(colored(f"[-] Upload failed: {file} - {error}", "red"))
+            results.append((file, error or future.result()))
+        return results
+
+
+def _next_offset(response: requests.Response) -> int:
+    # Rangeヘッダー（例: "bytes=0-1048575"）がなければ、まだ何も受け取っていない
+    range_header = response.headers.get("Range")
+    if not range_header:
+        return 0
+    return int(range_header.rsplit("-", 1)[1]) + 1
+
+
+def _backoff(attempt: int, base: float = 1.0, maximum: float = 64.0) -> float:
+    return min(maximum, base * 2 ** (attempt - 1)) + random.uniform(0, 1)
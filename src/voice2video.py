@@ -1,183 +1,699 @@
+import base64
 import os
-import requests
-import uuid
-from pathlib import Path
-from openai import OpenAI
+import struct
+import threading
+import unicodedata
+from contextlib import closing
+from dataclasses import asdict, dataclass
 from termcolor import colored
 from typing import List
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from pydub import AudioSegment
 
-client = OpenAI()  # 環境変数からAPIキーを取得
+from src.audio import (
+    CHANNELS,
+    SAMPLE_RATE,
+    normalize_format,
+    to_samples,
+    to_segment,
+    to_wav_bytes,
+)
+from src.cache import DiskCache, link_or_copy, make_cache_key
+from src.clients import get_http_session, get_openai_client
+from src.ratelimit import call_with_rate_limit
+from src.subtitles import (
+    Cue,
+    build_cues,
+    clip_subtitle_text,
+    get_subtitle_mode,
+    subtitles_filter,
+    write_subtitles,
+)
+from src.tracing import propagate, run_command, span
+from src.workspace import Workspace
 
+# 画像生成のパラメータ（キャッシュのキーにも含める）
+IMAGE_MODEL = "dall-e-3"
+IMAGE_SIZE = "1024x1024"
+IMAGE_QUALITY = "standard"
 
-def download_image(prompt="a white siamese cat") -> str:
+# 画像をファイルに書き込む単位（バイト）
+IMAGE_CHUNK_SIZE = 64 * 1024
+
+# 画像の先頭のバイト列と拡張子の対応
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"RIFF", ".webp"),
+)
+
+# クリップの音声の前後に追加する無音の期間と、1クリップの最大の長さ（秒）
+CLIP_SILENCE_DURATION = 0.5
+CLIP_MAX_DURATION = 10  # 仮の動画の長さを10秒とする
+
+
+
+@dataclass(frozen=True)
+class RenderProfile:
+    """
+    動画のエンコード設定。
+
+    各クリップは1枚の静止画なので、画像の拡大・切り抜き・色空間の変換は最初の1フレームだけで行い、
+    loopフィルタで同じフレームを繰り返します。x264には静止画向けのチューニングと
+    長いキーフレーム間隔を指定し、変化のないフレームをほとんど符号化しないようにします。
+
+    Attributes:
+        width (int): 出力の幅。
+        height (int): 出力の高さ。
+        fps (int): 出力のフレームレート。
+        preset (str): x264のプリセット（速度と圧縮率のトレードオフ）。
+        crf (int): x264の品質（小さいほど高品質）。
+        gop_seconds (float): キーフレームの間隔（秒）。
+        tune (str): x264のチューニング。Noneの場合は指定しません。
+        fit (str): 画像と出力の縦横比が異なる場合の合わせ方。
+            "crop"は出力を埋めるように拡大して切り抜き、"pad"は全体が収まるように縮小して余白を追加します。
+    """
+
+    width: int
+    height: int
+    fps: int
+    preset: str
+    crf: int
+    gop_seconds: float = 10
+    tune: str = "stillimage"
+    fit: str = "crop"
+
+
+# 画質と速度のプリセット。"square"は以前の1024x1024の出力と同じ設定
+RENDER_PROFILES = {
+    "quality": RenderProfile(1080, 1920, fps=30, preset="slow", crf=18),
+    "balanced": RenderProfile(1080, 1920, fps=24, preset="veryfast", crf=23),
+    "fast": RenderProfile(1080, 1920, fps=12, preset="ultrafast", crf=26),
+    "square": RenderProfile(1024, 1024, fps=24, preset="medium", crf=23, tune=None, fit="pad"),
+}
+
+
+def get_render_profile(name: str = None) -> RenderProfile:
+    """
+    名前からエンコード設定を取得します。
+
+    Args:
+        name (str): RENDER_PROFILESのキー。省略時は環境変数RENDER_PROFILE（既定値"balanced"）。
+
+    Returns:
+        RenderProfile: エンコード設定。
+    """
+    return RENDER_PROFILES[name or os.getenv("RENDER_PROFILE", "balanced")]
+
+
+def render_profile_params(profile: RenderProfile) -> dict:
+    """
+    生成物のキーに含めるためのエンコード設定を返します。
+    """
+    return asdict(profile)
+
+
+def fit_filter(profile: RenderProfile) -> str:
+    """
+    画像を出力の解像度に合わせるフィルタを作成します。
+    """
+    width, height = profile.width, profile.height
+    if profile.fit == "crop":
+        fit = (f"scale={width}:{height}:force_original_aspect_ratio=increase,"
+               f"crop={width}:{height}")
+    else:
+        fit = (f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+               f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2")
+    return f"{fit},setsar=1"
+
+
+def still_image_filter(
+    input_label: str,
+    profile: RenderProfile,
+    num_frames: int,
+    output_label: str,
+    subtitle_path: str = None,
+) -> str:
+    """
+    静止画を出力の解像度に合わせ、指定したフレーム数だけ繰り返すフィルタを作成します。
+
+    拡大・切り抜き・色空間の変換・字幕の描画はloopフィルタの前にあるため、1回だけ実行されます。
+
+    Args:
+        input_label (str): 入力のラベル（例: "0:v"）。
+        profile (RenderProfile): エンコード設定。
+        num_frames (int): 出力するフレーム数。
+        output_label (str): 出力のラベル。
+        subtitle_path (str): 焼き込むASS形式の字幕ファイル。最初のフレーム（0秒）に
+            表示される字幕が、繰り返される全てのフレームに残ります。
+
+    Returns:
+        str: filter_complexに追加するフィルタ。
+    """
+    burn = f",{subtitles_filter(subtitle_path)}" if subtitle_path else ""
+    return (
+        f"[{input_label}]{fit_filter(profile)}{burn},format=yuv420p,"
+        f"loop=loop={max(0, num_frames - 1)}:size=1:start=0,"
+        f"setpts=N/({profile.fps}*TB)[{output_label}]"
+    )
+
+
+def encoder_args(profile: RenderProfile) -> List[str]:
+    """
+    エンコード設定からffmpegの映像エンコーダの引数を作成します。
+    """
+    keyint = max(1, int(profile.fps * profile.gop_seconds))
+    args = [
+        "-c:v", "libx264",
+        "-preset", profile.preset,
+        "-crf", str(profile.crf),
+        "-g", str(keyint),
+        "-keyint_min", str(keyint),
+        "-sc_threshold", "0",
+        "-r", str(profile.fps),
+    ]
+    if profile.tune:
+        args += ["-tune", profile.tune]
+    return args
+
+
+def volume_filter(gain_db: float) -> str:
+    """
+    音声に加えるゲインのフィルタを返します。後ろにフィルタを続けるため末尾に","が付きます。
+
+    Args:
+        gain_db (float): ゲイン（dB）。
+
+    Returns:
+        str: volumeフィルタ。ゲインが0の場合は空文字列。
+    """
+    if not gain_db:
+        return ""
+    return f"volume={gain_db:.2f}dB,"
+
+
+def write_clip_subtitle(
+    text: str, duration: float, profile: RenderProfile, workspace: Workspace
+) -> str:
+    """
+    1つのクリップに焼き込む字幕を、クリップの先頭を0秒としたASSファイルに書き込みます。
+
+    Args:
+        text (str): 字幕の文章。
+        duration (float): クリップの長さ（秒）。
+        profile (RenderProfile): エンコード設定（字幕の大きさを解像度に合わせます）。
+        workspace (Workspace): 字幕ファイルを保存するジョブのワークスペース。
+
+    Returns:
+        str: 字幕ファイルのパス。
+    """
+    return write_subtitles(
+        [Cue(0.0, duration, text)], workspace.new_path(".ass"), profile.width, profile.height)
+
+
+def soft_subtitle_args() -> List[str]:
+    """
+    字幕をMP4の字幕トラック（mov_text）として出力するffmpegの引数を作成します。
+    """
+    return ["-c:s", "mov_text", "-metadata:s:s:0", "language=jpn"]
+
+
+def download_image(prompt="a white siamese cat", response_format: str = "url"):
     """
-    OpenAI APIを使用して画像を生成し、その画像のURLを取得します。
+    OpenAI APIを使用して画像を生成します。
 
     Args:
         prompt (str): 生成する画像のプロンプト。
+        response_format (str): "url"の場合は画像のURL、"b64_json"の場合は
+            Base64でエンコードされた画像データを取得します。
 
     Returns:
-        str: 生成された画像のURL。
+        str: 生成された画像のURL、またはBase64でエンコードされた画像データ。
     """
     print(colored("[+] Downloading image...", "yellow"))
 
-    response = client.images.generate(
-        model="dall-e-3",
-        prompt=f"{prompt} - できる限りリアルな画像を生成してください。めちゃくちゃ極端な表現描写をしてください",
-        size="1024x1024",
-        quality="standard",
-        n=1,
-    )
+    def request(slot):
+        # 再試行はレートリミッターが行い、429/5xxを同時実行数の調整に反映する
+        response = get_openai_client().with_options(max_retries=0).images.generate(
+            model=IMAGE_MODEL,
+            prompt=f"{prompt} - できる限りリアルな画像を生成してください。めちゃくちゃ極端な表現描写をしてください",
+            size=IMAGE_SIZE,
+            quality=IMAGE_QUALITY,
+            response_format=response_format,
+            n=1,
+        )
+        slot.record(status=200)
+        return response
+
+    with span("image.generate", model=IMAGE_MODEL, size=IMAGE_SIZE,
+              response_format=response_format) as current:
+        response = call_with_rate_limit("image", request, current_span=current)
 
-    image_url = response.data[0].url
     print(colored("[+] Image downloaded successfully!", "green"))
-    return image_url
+    if response_format == "b64_json":
+        return response.data[0].b64_json
+    return response.data[0].url
 
 
-def download_and_save_image(prompt="a white siamese cat") -> str:
+def get_image_session():
     """
-    画像をダウンロードして、指定されたパスに保存します。
+    画像のダウンロードに使用するセッションを返します。
+
+    接続はプールされ、同時にダウンロードする画像の数（IMAGE_MAX_WORKERS）まで再利用されます。
+
+    Returns:
+        requests.Session: プロセス全体で共有するセッション。
+    """
+    return get_http_session("image", pool_size=int(os.getenv("IMAGE_MAX_WORKERS", "3")))
+
+
+def fetch_image_chunks(prompt: str):
+    """
+    画像を生成し、その内容を少しずつ返します。
+
+    環境変数IMAGE_RESPONSE_FORMAT（既定値"url"）が"url"の場合は、URLから共有のセッションで
+    少しずつダウンロードするため、画像全体をメモリに保持しません。"b64_json"の場合は、
+    生成のレスポンスに含まれる画像データを少しずつデコードします。URLからのダウンロードの
+    往復はなくなりますが、レスポンスのBase64文字列（画像の約4/3倍）全体をメモリに保持します。
+    画像のバイト数は、どちらの場合も"image.download"のスパンに記録します。
 
     Args:
         prompt (str): 生成する画像のプロンプト。
 
+    Yields:
+        bytes: 画像の内容の一部。
+    """
+    response_format = os.getenv("IMAGE_RESPONSE_FORMAT", "url")
+    payload = download_image(prompt, response_format=response_format)
+    if response_format == "b64_json":
+        with span("image.download", response_format=response_format) as current:
+            # 4文字単位で区切ればBase64を途中からでもデコードできる
+            step = IMAGE_CHUNK_SIZE // 3 * 4
+            for start in range(0, len(payload), step):
+                decoded = base64.b64decode(payload[start:start + step])
+                current.add_bytes(len(decoded))
+                yield decoded
+        return
+
+    with span("image.download", response_format=response_format) as current:
+        with get_image_session().get(payload, stream=True, timeout=(5, 60)) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(IMAGE_CHUNK_SIZE):
+                current.add_bytes(len(chunk))
+                yield chunk
+
+
+def image_suffix(header: bytes) -> str:
+    """
+    画像の先頭のバイト列から拡張子を判定します。
+
+    Args:
+        header (bytes): 画像の先頭の12バイト以上。
+
     Returns:
-        str: 保存された画像ファイルのパス。
+        str: 拡張子（例: ".png"）。判定できない場合は".png"。
+    """
+    for signature, suffix in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            if suffix == ".webp" and header[8:12] != b"WEBP":
+                continue
+            return suffix
+    return ".png"
+
+
+def convert_image(image_path: str, profile: RenderProfile, workspace: Workspace = None) -> str:
+    """
+    画像をエンコード設定の解像度に合わせて変換します。
+
+    画像生成のステージで変換しておくことで、レンダリングのステージでは拡大・切り抜きが不要になります。
+
+    Args:
+        image_path (str): 変換する画像のパス。
+        profile (RenderProfile): エンコード設定。
+        workspace (Workspace): 変換した画像を保存するジョブのワークスペース。
+
+    Returns:
+        str: 変換した画像（PNG）のパス。
+    """
+    workspace = workspace or Workspace.default()
+    converted_path = str(workspace.new_path(".png"))
+    run_command(
+        ["ffmpeg", "-i", image_path, "-vf", fit_filter(profile), "-frames:v", "1",
+         converted_path],
+        name="ffmpeg.image",
+    )
+    return converted_path
+
+
+_image_cache = None
+_image_cache_lock = threading.Lock()
+
+
+def get_image_cache() -> DiskCache:
+    """
+    生成済み画像のキャッシュを返します。
+
+    保存先と容量上限は環境変数IMAGE_CACHE_DIRとIMAGE_CACHE_MAX_BYTESで指定します。
+
+    Returns:
+        DiskCache: プロセス全体で共有するキャッシュ。
+    """
+    global _image_cache
+    with _image_cache_lock:
+        if _image_cache is None:
+            _image_cache = DiskCache(
+                os.getenv("IMAGE_CACHE_DIR", "./cache/images"),
+                max_bytes=int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(2 * 1024 ** 3))),
+                suffix=".img",
+            )
+        return _image_cache
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    表記ゆれを吸収するため、プロンプトをNFKC正規化し空白をまとめます。
+
+    Args:
+        prompt (str): 画像生成のプロンプト。
+
+    Returns:
+        str: 正規化されたプロンプト。
+    """
+    return " ".join(unicodedata.normalize("NFKC", prompt).split())
+
+
+def image_cache_key(prompt: str) -> str:
+    """
+    プロンプトと画像生成のパラメータからキャッシュのキーを生成します。
+
+    Args:
+        prompt (str): 画像生成のプロンプト。
+
+    Returns:
+        str: キャッシュのキー。
+    """
+    return make_cache_key(
+        prompt=normalize_prompt(prompt),
+        model=IMAGE_MODEL,
+        size=IMAGE_SIZE,
+        quality=IMAGE_QUALITY,
+    )
+
+
+def download_and_save_image(
+    prompt="a white siamese cat",
+    refresh: bool = False,
+    workspace: Workspace = None,
+) -> str:
     """
-    # 画像URLを取得
-    image_url = download_image(prompt)
+    画像をダウンロードして、ワークスペースに保存します。
+
+    同じプロンプトの画像がキャッシュにあれば、生成せずにキャッシュから取り出します。
+    画像は少しずつ一時ファイルに書き込み、受信し終えてから内容に合った拡張子の名前に置き換えます。
+
+    Args:
+        prompt (str): 生成する画像のプロンプト。
+        refresh (bool): Trueの場合はキャッシュを無視して画像を生成し直します。
+            環境変数IMAGE_CACHE_REFRESH=1でも指定できます。
+        workspace (Workspace): 画像を保存するジョブのワークスペース。
+            省略時は共有の一時フォルダ（./temp）。
 
-    # 画像データをダウンロード
-    response = requests.get(image_url)
-    response.raise_for_status()
+    Returns:
+        str: 保存された画像ファイルのパス。
 
-    # 保存先のディレクトリを指定
-    save_dir = Path("./temp/")
-    save_dir.mkdir(parents=True, exist_ok=True)
+    Raises:
+        ValueError: 画像データが空の場合。
+    """
+    refresh = refresh or os.getenv("IMAGE_CACHE_REFRESH") == "1"
+    cache = get_image_cache()
+    cache_key = image_cache_key(prompt)
+    workspace = workspace or Workspace.default()
 
-    # 保存する画像ファイルのパスを生成
-    image_file_path = save_dir / f"{uuid.uuid4()}.jpg"
+    image_file_path = None
+    cached_path = None if refresh else cache.get_path(cache_key)
+    if cached_path is not None:
+        try:
+            with open(cached_path, "rb") as file:
+                suffix = image_suffix(file.read(12))
+            image_file_path = workspace.new_path(suffix)
+            link_or_copy(cached_path, image_file_path)
+            print(colored(f"[+] Image loaded from cache: {image_file_path}", "green"))
+        except FileNotFoundError:
+            image_file_path = None  # 取り出す直前に削除された場合は生成し直す
 
-    # 画像データをファイルに書き込む
-    with open(image_file_path, "wb") as file:
-        file.write(response.content)
-    print(colored(f"[+] Image saved successfully: {image_file_path}", "green"))
+    if image_file_path is None:
+        # 画像データを受信しながら一時ファイルに書き込み、書き終えてから置き換える。
+        # 途中で失敗しても、壊れた画像がワークスペースやキャッシュに残らない
+        partial_path = workspace.new_path(".partial")
+        with closing(fetch_image_chunks(prompt)) as chunks:
+            try:
+                with open(partial_path, "wb") as file:
+                    header = b""
+                    for chunk in chunks:
+                        if len(header) < 12:
+                            header += chunk[:12 - len(header)]
+                        file.write(chunk)
+                if not header:
+                    raise ValueError(f"画像データが空です: {prompt}")
+                image_file_path = workspace.new_path(image_suffix(header))
+                os.replace(partial_path, image_file_path)
+            finally:
+                partial_path.unlink(missing_ok=True)
+        cache.put_file(cache_key, image_file_path)
+        print(colored(f"[+] Image saved successfully: {image_file_path}", "green"))
     return str(image_file_path)
 
 
-def create_silence_audio(duration: int, silence_path: str):
+def load_clip_audio(clip: dict) -> AudioSegment:
     """
-    指定された秒数の無音オーディオファイルを生成します。
+    クリップの音声を取得します。
+
+    メモリ上の音声（"audio"）があればそれを、なければ"audio_path"のファイルを読み込みます。
 
     Args:
-        duration (int): 無音の長さ（秒）。
-        silence_path (str): 無音オーディオファイルの保存パス。
+        clip (dict): クリップ情報。
+
+    Returns:
+        AudioSegment: エンコーダに渡すPCM形式の音声。
+
+    Raises:
+        ValueError: クリップに音声がない場合（音声合成に失敗した場合など）。
     """
-    cmd = [
-        "ffmpeg",
-        "-f",
-        "lavfi",
-        "-i",
-        "anullsrc=r=44100:cl=stereo",
-        "-t",
-        str(duration),
-        silence_path,
+    if clip.get("audio") is not None:
+        return clip["audio"]
+    if not clip.get("audio_path"):
+        raise ValueError(f"クリップの音声がありません: {clip.get('text')}")
+    return normalize_format(AudioSegment.from_file(clip["audio_path"]))
+
+
+def check_clip_audio(clips: List[dict]):
+    """
+    エンコードを始める前に、全てのクリップに音声があることを確認します。
+
+    Args:
+        clips (List[dict]): クリップ情報のリスト。
+
+    Raises:
+        ValueError: 音声（"audio"も"audio_path"も）がないクリップがある場合。
+            メッセージには該当するクリップの番号を含めます。
+    """
+    missing = [
+        str(clip.get("num", i)) for i, clip in enumerate(clips)
+        if clip.get("audio") is None and not clip.get("audio_path")
     ]
-    subprocess.run(cmd, check=True)
+    if missing:
+        raise ValueError(
+            f"音声がないクリップがあります（音声合成に失敗した可能性があります）: "
+            f"{', '.join(missing)}")
 
 
 def create_video_with_audio(
-    image_path: str, audio_path: str, silence_duration: int, video_duration: int
+    image_path: str,
+    audio,
+    silence_duration: float,
+    video_duration: int,
+    workspace: Workspace = None,
+    profile: RenderProfile = None,
+    subtitle_text: str = None,
+    gain_db: float = 0.0,
 ) -> str:
     """
     画像と音声を組み合わせて動画を生成します。音声の前後に無音の期間を追加します。
 
+    無音はフィルタグラフ内で生成し、映像と音声を1回のffmpeg実行でエンコードします。
+    メモリ上の音声はWAVとして標準入力からffmpegに渡すため、中間ファイルを作りません。
+    画像は1回だけ読み込んで出力の解像度に合わせ、同じフレームを繰り返します。
+
     Args:
         image_path (str): 画像ファイルのパス。
-        audio_path (str): 音声ファイルのパス。
-        silence_duration (int): 音声の前後に追加する無音の期間（秒）。
+        audio (AudioSegment | str): メモリ上の音声、または音声ファイルのパス。
+        silence_duration (float): 音声の前後に追加する無音の期間（秒）。
         video_duration (int): 動画の長さ（秒）。
+        workspace (Workspace): 動画を保存するジョブのワークスペース。
+            省略時は共有の一時フォルダ（./temp）。
+        profile (RenderProfile): エンコード設定。省略時はget_render_profile()。
+        subtitle_text (str): 映像に焼き込む字幕。同じエンコードの中で静止画に1回だけ描画します。
+        gain_db (float): ラウドネスを揃えるために音声に加えるゲイン（dB）。同じエンコードの中で適用します。
 
     Returns:
         str: 生成された動画のパス。
     """
-    # 無音オーディオファイルのパス
-    silence_path_before = f"temp/silence_before_{uuid.uuid4()}.mp3"
-    silence_path_after = f"temp/silence_after_{uuid.uuid4()}.mp3"
+    profile = profile or get_render_profile()
+    # 生成された動画のパス
+    workspace = workspace or Workspace.default()
+    video_path = str(workspace.new_path(".mp4"))
+    subtitle_path = None
+    if subtitle_text:
+        subtitle_path = write_clip_subtitle(subtitle_text, video_duration, profile, workspace)
 
-    # 無音オーディオの生成
-    create_silence_audio(silence_duration, silence_path_before)
-    create_silence_audio(silence_duration, silence_path_after)
+    if isinstance(audio, AudioSegment):
+        audio_input = ["-f", "wav", "-i", "pipe:0"]
+        audio_data = to_wav_bytes(audio)
+    else:
+        audio_input = ["-i", audio]
+        audio_data = None
 
-    # 無音オーディオを音声ファイルの前後に結合
-    combined_audio_path = f"temp/combined_audio_{uuid.uuid4()}.mp3"
-    cmd_combine = [
-        "ffmpeg",
-        "-i",
-        silence_path_before,
-        "-i",
-        audio_path,
-        "-i",
-        silence_path_after,
-        "-filter_complex",
-        "[0:a][1:a][2:a]concat=n=3:v=0:a=1",
-        combined_audio_path,
-    ]
-    subprocess.run(cmd_combine, check=True)
-
-    # 生成された動画のパス
-    video_id = uuid.uuid4()
-    video_path = f"temp/{video_id}.mp4"
+    # 音声の前にadelayで、後ろにapadで無音を追加する
+    delay_ms = int(silence_duration * 1000)
+    num_frames = int(video_duration * profile.fps)
+    filter_complex = (
+        still_image_filter("0:v", profile, num_frames, "v", subtitle_path) + ";"
+        "[1:a]aformat=sample_rates=44100:channel_layouts=stereo,"
+        f"{volume_filter(gain_db)}"
+        f"adelay=delays={delay_ms}:all=1,"
+        f"apad=pad_dur={silence_duration}[a]"
+    )
 
-    # 画像と結合したオーディオを使用して動画を生成
+    # 画像と音声を使用して動画を生成
     cmd_video = [
         "ffmpeg",
-        "-loop",
-        "1",
+        "-framerate",
+        str(profile.fps),
         "-i",
         image_path,
-        "-i",
-        combined_audio_path,
-        "-c:v",
-        "libx264",
+        *audio_input,
+        "-filter_complex",
+        filter_complex,
+        "-map",
+        "[v]",
+        "-map",
+        "[a]",
+        *encoder_args(profile),
         "-t",
         str(video_duration),
-        "-pix_fmt",
-        "yuv420p",
-        "-vf",
-        "fps=24",
         "-c:a",
         "aac",
         "-shortest",
         video_path,
     ]
-    subprocess.run(cmd_video, check=True)
+    run_command(cmd_video, input=audio_data, name="ffmpeg.clip")
 
     # 生成された動画のパスを返す
     return video_path
 
 
-def process_json_data(clips: dict) -> dict:
+def generate_images_for_clips(
+    clips: dict,
+    max_workers: int = None,
+    refresh: bool = False,
+    workspace: Workspace = None,
+) -> dict:
+    """
+    全てのクリップの画像を同時に生成し、"image_path"としてJSONに追加します。
+
+    同じプロンプト（正規化後）のクリップが複数ある場合は、1回だけ生成して共有します。
+
+    Args:
+        clips (dict): クリップ情報が含まれた辞書。
+        max_workers (int): 同時に実行する画像生成リクエストの上限。
+            省略時は環境変数IMAGE_MAX_WORKERS（既定値3）を使用します。
+        refresh (bool): Trueの場合はキャッシュを無視して画像を生成し直します。
+        workspace (Workspace): 画像を保存するジョブのワークスペース。
+
+    Returns:
+        dict: "image_path"が追加されたクリップ情報。
+    """
+    if max_workers is None:
+        max_workers = int(os.getenv("IMAGE_MAX_WORKERS", "3"))
+
+    pending = [clip for clip in clips["clips"] if not clip.get("image_path")]
+
+    # 同じプロンプトのリクエストを1つにまとめる
+    prompts = {}
+    for clip in pending:
+        prompts.setdefault(image_cache_key(clip["video_prompt"]), clip["video_prompt"])
+
+    def generate(prompt):
+        return download_and_save_image(prompt, refresh=refresh, workspace=workspace)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        image_paths = dict(
+            zip(prompts, executor.map(propagate(generate), prompts.values())))
+
+    # クリップの順番通りにパスを割り当てる
+    for clip in pending:
+        clip["image_path"] = image_paths[image_cache_key(clip["video_prompt"])]
+    return clips
+
+
+def process_json_data(
+    clips: dict,
+    max_workers: int = None,
+    workspace: Workspace = None,
+    profile: RenderProfile = None,
+    subtitles: str = None,
+) -> dict:
     """
     JSONデータに基づき、画像生成と動画生成を行い、結果をJSONに追加します。
 
+    画像がまだ生成されていないクリップは先に画像をまとめて生成し、
+    その後、動画がまだないクリップの動画を並列にエンコードします。
+
     Args:
-        json_data (List[Dict]): 入力JSONデータ。
+        clips (dict): 入力JSONデータ。
+        max_workers (int): 同時に実行するffmpegの上限。
+            省略時は環境変数RENDER_MAX_WORKERS（既定値2）を使用します。
+        workspace (Workspace): 中間ファイルを保存するジョブのワークスペース。
+        profile (RenderProfile): エンコード設定。同じ動画のクリップは全て同じ設定で
+            エンコードする必要があります（結合時に再エンコードしないため）。
+        subtitles (str): 字幕の付け方。"burn"の場合は各クリップのエンコードで字幕を焼き込みます。
+            省略時は環境変数SUBTITLES。
+
+    Returns:
+        dict: "image_path"と"video_path"が追加されたクリップ情報。
+
+    Raises:
+        ValueError: 動画がまだないクリップに音声がない場合（check_clip_audioを参照）。
     """
-    for clip in clips["clips"]:
-        video_prompt = clip["video_prompt"]
-        audio_path = clip["audio_path"]
+    if max_workers is None:
+        max_workers = int(os.getenv("RENDER_MAX_WORKERS", "2"))
+    burn = get_subtitle_mode(subtitles) == "burn"
+    pending = [clip for clip in clips["clips"] if not clip.get("video_path")]
+    # 一部のクリップだけエンコードしてから失敗しないよう、先に音声を確認する
+    check_clip_audio(pending)
 
-        # 画像生成
-        image_path = download_and_save_image(video_prompt)
+    # 画像生成
+    generate_images_for_clips(clips, workspace=workspace)
 
+    def render(clip):
         # 動画生成
-        video_path = create_video_with_audio(
-            image_path, audio_path, silence_duration=0.5, video_duration=10
-        )  # 仮の動画の長さを10秒とする
+        return create_video_with_audio(
+            clip["image_path"],
+            load_clip_audio(clip),
+            silence_duration=CLIP_SILENCE_DURATION,
+            video_duration=CLIP_MAX_DURATION,
+            workspace=workspace,
+            profile=profile,
+            subtitle_text=clip_subtitle_text(clip) if burn else None,
+            gain_db=clip.get("gain_db", 0.0),
+        )
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        video_paths = list(executor.map(propagate(render), pending))
 
-        # 動画パスをJSONに追加
+    # 動画パスをJSONに追加
+    for clip, video_path in zip(pending, video_paths):
         clip["video_path"] = video_path
 
     # 結果を表示または保存
@@ -185,7 +701,10 @@ def process_json_data(clips: dict) -> dict:
 
 
 def concatenate_videos(
-    video_paths: List[str], output_path: str = "temp/final_video.mp4"
+    video_paths: List[str],
+    output_path: str = "temp/final_video.mp4",
+    workspace: Workspace = None,
+    subtitle_path: str = None,
 ) -> str:
     """
     複数の動画ファイルを一つの動画に結合します。
@@ -193,34 +712,47 @@ def concatenate_videos(
     Args:
         video_paths (List[str]): 結合する動画ファイルのパスのリスト。
         output_path (str): 結合された動画を保存するパス。
+        workspace (Workspace): ファイルリストを作成するジョブのワークスペース。
+        subtitle_path (str): 字幕トラックとして追加する字幕ファイル。映像と音声は
+            再エンコードせず、同じ結合の中で字幕だけをmov_textに変換します。
 
     Returns:
         str: 結合された動画のパス。
     """
-    # 一時的なファイルリストのパス
-    filelist_path = "temp/filelist.txt"
+    # 一時的なファイルリストのパス（同時に実行される結合処理と衝突しないよう一意にする）
+    workspace = workspace or Workspace.default()
+    filelist_path = str(workspace.new_path(".txt", prefix="filelist_"))
 
     # 一時的なファイルリストを作成
     with open(filelist_path, "w") as filelist:
         for path in video_paths:
-            # temp/filelist.txtに対する相対パスを計算
+            # ファイルリストに対する相対パスを計算
             relative_path = os.path.relpath(path, start=os.path.dirname(filelist_path))
             filelist.write(f"file '{relative_path}'\n")
 
-    # ffmpegを使用して動画を結合
+    subtitle_input = []
+    subtitle_output = []
+    if subtitle_path:
+        subtitle_input = ["-i", subtitle_path, "-map", "0:v", "-map", "0:a", "-map", "1:s"]
+        subtitle_output = soft_subtitle_args()
+
+    # ffmpegを使用して動画を結合（再開時など、既存の出力は上書きする）
     cmd = [
         "ffmpeg",
+        "-y",
         "-f",
         "concat",
         "-safe",
         "0",
         "-i",
-        "temp/filelist.txt",
+        filelist_path,
+        *subtitle_input,
         "-c",
         "copy",
+        *subtitle_output,
         output_path,
     ]
-    subprocess.run(cmd, check=True)
+    run_command(cmd, name="ffmpeg.concat")
 
     # 一時的なファイルリストを削除
     os.remove(filelist_path)
@@ -229,7 +761,11 @@ def concatenate_videos(
 
 
 def create_combined_video_from_clips(
-    json_data: dict, output_path: str = "temp/combined_video.mp4"
+    json_data: dict,
+    output_path: str = "temp/combined_video.mp4",
+    workspace: Workspace = None,
+    profile: RenderProfile = None,
+    subtitles: str = None,
 ) -> str:
     """
     json_dataから全てのクリップの動画パスを読み取り、それらを一つの動画に結合します。
@@ -237,6 +773,11 @@ def create_combined_video_from_clips(
     Args:
         json_data (dict): クリップ情報が含まれた辞書。
         output_path (str): 結合された動画を保存するパス。
+        workspace (Workspace): 中間ファイルを作成するジョブのワークスペース。
+        profile (RenderProfile): 使用しません（クリップの動画はエンコード済みのため）。
+            render_video_from_clipsと引数を揃えるために受け取ります。
+        subtitles (str): 字幕の付け方。"soft"の場合は結合と同時に字幕トラックを追加します
+            （"burn"の字幕はクリップのエンコードで焼き込み済み）。省略時は環境変数SUBTITLES。
 
     Returns:
         str: 結合された動画のパス。
@@ -244,10 +785,237 @@ def create_combined_video_from_clips(
     # 結合する動画ファイルのパスのリストを取得
     video_paths = [clip["video_path"] for clip in json_data["clips"]]
 
-    return concatenate_videos(video_paths, output_path)
+    subtitle_path = None
+    if get_subtitle_mode(subtitles) == "soft":
+        workspace = workspace or Workspace.default()
+        # concatデマクサーは各ファイルの長さだけ次のファイルをずらすため、音声の長さではなく
+        # エンコードされたクリップの長さで字幕の表示区間を決める（フレームやAACの単位で丸められる）
+        cues = build_cues(json_data["clips"], [read_mp4_duration(path) for path in video_paths])
+        subtitle_path = write_subtitles(cues, workspace.new_path(".srt"))
+
+    return concatenate_videos(
+        video_paths, output_path, workspace=workspace, subtitle_path=subtitle_path)
+
+
+def read_mp4_duration(path: str) -> float:
+    """
+    MP4ファイルの長さを、moovボックス内のmvhdボックスから読み取ります。
+
+    ffprobeを起動せず、トップレベルのボックスのヘッダーとmvhdだけを読みます。
+
+    Args:
+        path (str): MP4ファイルのパス。
+
+    Returns:
+        float: 動画の長さ（秒）。
+
+    Raises:
+        ValueError: mvhdボックスが見つからない場合。
+    """
+    def boxes(file, end):
+        # (種類, 内容の開始位置, ボックスの終了位置)を順に返す
+        while file.tell() + 8 <= end:
+            start = file.tell()
+            size, kind = struct.unpack(">I4s", file.read(8))
+            if size == 1:
+                size = struct.unpack(">Q", file.read(8))[0]
+            elif size == 0:
+                size = end - start
+            yield kind, file.tell(), start + size
+            file.seek(start + size)
+
+    with open(path, "rb") as file:
+        for kind, _, moov_end in boxes(file, os.path.getsize(path)):
+            if kind != b"moov":
+                continue
+            for child, body, _ in boxes(file, moov_end):
+                if child != b"mvhd":
+                    continue
+                file.seek(body)
+                version = file.read(4)[0]
+                if version == 1:
+                    file.seek(16, os.SEEK_CUR)
+                    timescale, duration = struct.unpack(">IQ", file.read(12))
+                else:
+                    file.seek(8, os.SEEK_CUR)
+                    timescale, duration = struct.unpack(">II", file.read(8))
+                return duration / timescale
+    raise ValueError(f"No mvhd box in {path}")
+
+
+def compute_clip_durations(
+    json_data: dict,
+    silence_duration: float = CLIP_SILENCE_DURATION,
+    video_duration: float = CLIP_MAX_DURATION,
+) -> List[float]:
+    """
+    音声の長さから各クリップの表示時間を計算します。
+
+    クリップごとの動画（create_video_with_audio）と同じく、音声の前後の無音を含めた長さを
+    video_durationで打ち切ります。サンプル単位のずれが生じないよう、ミリ秒単位に丸めます。
+
+    Args:
+        json_data (dict): "audio"または"audio_path"を含むクリップ情報。
+        silence_duration (float): 音声の前後に追加する無音の期間（秒）。
+        video_duration (float): 1クリップの最大の長さ（秒）。
+
+    Returns:
+        List[float]: クリップの順番通りの表示時間（秒）。
+    """
+    return [
+        min(
+            int(video_duration * 1000),
+            len(load_clip_audio(clip)) + 2 * int(silence_duration * 1000),
+        ) / 1000
+        for clip in json_data["clips"]
+    ]
+
+
+def build_audio_track(
+    json_data: dict, durations: List[float], silence_duration: float
+) -> AudioSegment:
+    """
+    全てのクリップの音声を、前後の無音を含めて1本の音声トラックに結合します。
+
+    Args:
+        json_data (dict): "audio"または"audio_path"を含むクリップ情報。
+        durations (List[float]): 各クリップの表示時間（秒）。
+        silence_duration (float): 音声の前後に追加する無音の期間（秒）。
+
+    Returns:
+        AudioSegment: 動画全体の音声トラック。
+    """
+    # 出力を無音で確保し、各クリップの音声を無音の後ろの位置に書き込む
+    silence_frames = int(SAMPLE_RATE * silence_duration)
+    clip_frames = [int(round(duration * SAMPLE_RATE)) for duration in durations]
+    track = np.zeros((sum(clip_frames), CHANNELS), dtype=np.int16)
+
+    offset = 0
+    for clip, num_frames in zip(json_data["clips"], clip_frames):
+        samples = to_samples(load_clip_audio(clip))[: max(0, num_frames - silence_frames)]
+        start = offset + silence_frames
+        track[start:start + len(samples)] = samples
+        offset += num_frames
+    return to_segment(track)
+
+
+def render_video_from_clips(
+    json_data: dict,
+    output_path: str = "temp/combined_video.mp4",
+    workspace: Workspace = None,
+    profile: RenderProfile = None,
+    subtitles: str = None,
+    silence_duration: float = CLIP_SILENCE_DURATION,
+    video_duration: float = CLIP_MAX_DURATION,
+) -> str:
+    """
+    全てのクリップの画像と音声から、1回のffmpeg実行で完成した動画を生成します。
+
+    クリップごとのMP4や結合用のファイルリストを作らず、1つのfilter_complexで
+    映像を結合してエンコードします。音声はメモリ上で1本のトラックに結合し、
+    WAVとして標準入力からffmpegに渡します。全ての映像を同じ解像度・フレームレートに
+    揃えてから結合するため、`-c copy`による結合で起こりうるタイムスタンプや
+    パラメータの不一致が発生しません。各クリップのフレーム数は開始・終了時刻を
+    フレーム単位に丸めて決めるため、クリップが多くても音声とのずれが蓄積しません。
+    字幕も同じ実行の中で、字幕トラックとして追加するか各クリップの静止画に焼き込みます。
+    ラウドネスを揃えるゲイン（"gain_db"）もvolumeフィルタとして同じ実行の中で適用します。
+    create_combined_video_from_clipsと同じ引数で呼び出せます。
+
+    Args:
+        json_data (dict): "image_path"と、"audio"または"audio_path"を含むクリップ情報。
+        output_path (str): 生成した動画を保存するパス。
+        workspace (Workspace): 字幕ファイルを保存するジョブのワークスペース。
+        profile (RenderProfile): エンコード設定。省略時はget_render_profile()。
+        subtitles (str): 字幕の付け方（"off"、"soft"、"burn"）。省略時は環境変数SUBTITLES。
+        silence_duration (float): 音声の前後に追加する無音の期間（秒）。
+        video_duration (float): 1クリップの最大の長さ（秒）。
+
+    Returns:
+        str: 生成された動画のパス。
+
+    Raises:
+        ValueError: 音声がないクリップがある場合（check_clip_audioを参照）。
+    """
+    profile = profile or get_render_profile()
+    subtitles = get_subtitle_mode(subtitles)
+    if subtitles != "off":
+        workspace = workspace or Workspace.default()
+    clips = json_data["clips"]
+    check_clip_audio(clips)
+    durations = compute_clip_durations(json_data, silence_duration, video_duration)
+    audio_track = build_audio_track(json_data, durations, silence_duration)
+
+    inputs = []
+    filters = []
+    concat_inputs = ""
+    frame_durations = []
+    start = 0.0
+    for i, (clip, duration) in enumerate(zip(clips, durations)):
+        end = start + duration
+        num_frames = round(end * profile.fps) - round(start * profile.fps)
+        # 字幕の切り替わりを映像のフレームの境界に合わせる
+        frame_durations.append(num_frames / profile.fps)
+        start = end
+        subtitle_path = None
+        if subtitles == "burn":
+            subtitle_path = write_clip_subtitle(
+                clip_subtitle_text(clip), frame_durations[-1], profile, workspace)
+        inputs += ["-framerate", str(profile.fps), "-i", clip["image_path"]]
+        filters.append(
+            still_image_filter(f"{i}:v", profile, num_frames, f"v{i}", subtitle_path))
+        concat_inputs += f"[v{i}]"
+    filters.append(f"{concat_inputs}concat=n={len(clips)}:v=1:a=0[v]")
+    # ゲインは動画全体のラウドネスから計算したもので、全てのクリップで同じ
+    gain_db = clips[0].get("gain_db", 0.0) if clips else 0.0
+    filters.append(f"[{len(clips)}:a]{volume_filter(gain_db)}anull[a]")
+
+    subtitle_input = []
+    subtitle_output = []
+    if subtitles == "soft":
+        cues = build_cues(clips, frame_durations)
+        subtitle_input = ["-i", write_subtitles(cues, workspace.new_path(".srt"))]
+        subtitle_output = ["-map", f"{len(clips) + 1}:s", *soft_subtitle_args()]
+
+    cmd = [
+        "ffmpeg",
+        "-y",  # 再開時など、既存の出力は上書きする
+        *inputs,
+        "-f",
+        "wav",
+        "-i",
+        "pipe:0",
+        *subtitle_input,
+        "-filter_complex",
+        ";".join(filters),
+        "-map",
+        "[v]",
+        "-map",
+        "[a]",
+        *encoder_args(profile),
+        "-c:a",
+        "aac",
+        *subtitle_output,
+        "-movflags",
+        "+faststart",
+        output_path,
+    ]
+    run_command(cmd, input=to_wav_bytes(audio_track), name="ffmpeg.single_pass")
+
+    return output_path
+
+
+# レンダリング方式ごとの最終動画の生成関数（呼び出し方は共通）
+RENDER_ENGINES = {
+    "per_clip": create_combined_video_from_clips,
+    "single_pass": render_video_from_clips,
+}
 
 
 if __name__ == "__main__":
+    # OpenAIとTTSを使わずに試す場合は、benchmarks/stub_servers.pyを起動して
+    # OPENAI_BASE_URLとTTS_API_URLをそのサーバーに向けてください
+    from src.text2voice import generate_audio_for_clips
+
     clips = {
         "clips": [
             {
@@ -256,8 +1024,6 @@ if __name__ == "__main__":
                 "text": "自然の美は私たちの心を癒やし、感動させます。",
                 "video_prompt": "自然の美しい風景が映るシーンを撮影してください。",
                 "theme": "自然の美",
-                "audio_path": "tests/test_data/4dbcd83a-b3d5-4d0a-aaf1-a5a8ca61c117.mp3",
-                "video_path": "tests/test_data/4097fa1c-deff-4486-af8a-db74b5cf0413.mp4",
             },
             {
                 "num": 1,
@@ -265,16 +1031,19 @@ if __name__ == "__main__":
                 "text": "自然は命を宿し、息づいている。",
                 "video_prompt": "自然の息吹を感じさせるショットを撮影してください。",
                 "theme": "自然の美",
-                "audio_path": "tests/test_data/3748d4e4-1283-4ac3-85e5-7f989855e125.mp3",
-                "video_path": "tests/test_data/53a2bd86-5968-4d8e-9e59-abf2ba0c59c3.mp4",
             },
         ]
     }
 
-    # 画像生成から各クリップの動画生成までの処理をテスト
-    updated_clips = process_json_data(clips)
-    print("画像と動画が生成されました。")
+    with Workspace.create() as workspace:
+        generate_audio_for_clips(clips)
+
+        # 画像生成から各クリップの動画生成までの処理をテスト
+        updated_clips = process_json_data(clips, workspace=workspace)
+        print("画像と動画が生成されました。")
 
-    # 動画の結合処理をテスト
-    create_combined_video_from_clips(clips)
-    print("結合後の動画が生成されました。")
+        # 動画の結合処理をテスト
+        os.makedirs("./output", exist_ok=True)
+        video_path = create_combined_video_from_clips(
+            clips, "./output/voice2video_sample.mp4", workspace=workspace)
+        print(f"結合後の動画が生成されました: {video_path}")
@@ -0,0 +1,150 @@
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# ワークスペースを指定しなかった場合に使用する共有の一時フォルダ
+TEMP_DIR = Path("./temp")
+
+# ジョブごとのワークスペースを作成する既定の場所（共有の一時フォルダとは別のサブディレクトリ）
+JOBS_DIR = TEMP_DIR / "jobs"
+
+# ワークスペースを使用中のジョブが排他ロックを取るファイル
+LOCK_FILE = ".lock"
+
+
+def job_root() -> Path:
+    """
+    ジョブのワークスペースを作成する場所を返します（環境変数WORKSPACE_ROOT、既定値./temp/jobs）。
+    """
+    return Path(os.getenv("WORKSPACE_ROOT", str(JOBS_DIR)))
+
+
+class WorkspaceInUseError(RuntimeError):
+    """
+    ワークスペースを他のジョブが使用している場合に送出される例外。
+    """
+
+
+class Workspace:
+    """
+    1つのジョブ専用の作業ディレクトリ。
+
+    ジョブの中間ファイル（画像、クリップごとの動画、ファイルリストなど）は全てこの
+    ディレクトリに作成し、ジョブの終了時にこのディレクトリだけを削除します。
+    ジョブごとにディレクトリが分かれるため、同じホストで複数のジョブを同時に実行できます。
+
+    Args:
+        path (str): 作業ディレクトリのパス。存在しない場合は作成します。
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def create(cls, job_id: str = None, root: str = None) -> "Workspace":
+        """
+        ジョブ用のワークスペースを作成します。
+
+        Args:
+            job_id (str): ジョブのID。省略時はランダムなIDを使用します。
+            root (str): ワークスペースを作成する親ディレクトリ。
+                省略時は環境変数WORKSPACE_ROOT（既定値./temp/jobs）。
+
+        Returns:
+            Workspace: 作成したワークスペース。
+        """
+        root = Path(root) if root else job_root()
+        return cls(root / (job_id or uuid.uuid4().hex))
+
+    @classmethod
+    def default(cls) -> "Workspace":
+        """
+        ワークスペースが指定されなかった場合に使用する、共有の一時フォルダを返します。
+
+        Returns:
+            Workspace: ./tempを指すワークスペース。
+        """
+        return cls(TEMP_DIR)
+
+    def new_path(self, suffix: str, prefix: str = "") -> Path:
+        """
+        ワークスペース内の一意なファイルパスを返します。
+
+        Args:
+            suffix (str): ファイルの拡張子（例: ".mp4"）。
+            prefix (str): ファイル名の先頭に付ける文字列。
+
+        Returns:
+            Path: 新しいファイルのパス。
+        """
+        return self.path / f"{prefix}{uuid.uuid4()}{suffix}"
+
+    @contextmanager
+    def lock(self):
+        """
+        ワークスペースの排他ロックを取り、ブロックの間このジョブが使用中であることを示します。
+
+        ジョブIDは主題とクリップ数から決まるため、同じ主題の2つのジョブ（バッチ内の重複や、
+        キューのワーカーとコマンドラインからの実行など）は同じワークスペースを使います。
+        ロックは別のプロセスやスレッドからの実行とも衝突するため、後から始めたジョブは
+        待たずに失敗し、先のジョブのマニフェストや中間ファイルを上書き・削除しません。
+        ロックはプロセスが異常終了しても解放されます。
+
+        Yields:
+            Workspace: このワークスペース。
+
+        Raises:
+            WorkspaceInUseError: 他のジョブがワークスペースを使用している場合。
+        """
+        if fcntl is None:
+            yield self
+            return
+        lock_file = open(self.path / LOCK_FILE, "a")
+        try:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise WorkspaceInUseError(
+                    f"ワークスペースは他のジョブが使用中です: {self.path}") from None
+            yield self
+        finally:
+            lock_file.close()  # ロックも解放される
+
+    def cleanup(self):
+        """
+        ワークスペースを中身ごと削除します。
+
+        共有の一時フォルダのように、ジョブのワークスペースを作成する場所（WORKSPACE_ROOT）を
+        含むディレクトリの場合は、その場所以外の中身だけを削除します。実行中の他のジョブの
+        ワークスペースは削除しません。
+        """
+        path = self.path.resolve()
+        jobs = job_root().resolve()
+        if path == jobs:
+            return
+        if path not in jobs.parents:
+            shutil.rmtree(self.path, ignore_errors=True)
+            return
+        if not path.is_dir():
+            return
+        for child in path.iterdir():
+            if child == jobs or child in jobs.parents:
+                continue
+            if child.is_dir() and not child.is_symlink():
+                shutil.rmtree(child, ignore_errors=True)
+            else:
+                child.unlink(missing_ok=True)
+
+    def __enter__(self) -> "Workspace":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
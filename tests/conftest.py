@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# `pytest`をどこから実行してもsrcを読み込めるよう、リポジトリのルートを追加する
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,53 @@
+import math
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("pydub")
+
+from src.audio import SAMPLE_RATE, measure_loudness, normalization_gain  # noqa: E402
+
+
+def sine(dbfs, seconds=5.0, frequency=997.0, channels=(1.0, 1.0)):
+    # 指定したピーク（dBFS）の正弦波。channelsはチャンネルごとの倍率
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    wave = 10 ** (dbfs / 20) * np.sin(2 * np.pi * frequency * t) * 32767
+    return np.stack([wave * gain for gain in channels], axis=1).round().astype(np.int16)
+
+
+@pytest.mark.parametrize("dbfs", [-23.0, -20.0, -10.0])
+def test_stereo_sine_reference(dbfs):
+    # EBU Tech 3341: 両チャンネルに同じ1kHz付近の正弦波を入れると、ピークのdBFSと同じLUFSになる
+    loudness, peak_db = measure_loudness(sine(dbfs))
+    assert loudness == pytest.approx(dbfs, abs=0.1)
+    assert peak_db == pytest.approx(dbfs, abs=0.01)
+
+
+def test_single_channel_is_3db_quieter():
+    loudness, _ = measure_loudness(sine(-20.0, channels=(1.0, 0.0)))
+    assert loudness == pytest.approx(-20.0 - 10 * math.log10(2), abs=0.1)
+
+
+def test_silence_is_gated():
+    # 絶対ゲート（-70LUFS）より静かなブロックは平均に含めない（含めると約-26LUFSになる）。
+    # 境界をまたぐブロックの分だけ下がるのはffmpegのebur128でも同じ（-23.1LUFS）
+    samples = np.concatenate([sine(-23.0), np.zeros((5 * SAMPLE_RATE, 2), dtype=np.int16)])
+    assert measure_loudness(samples)[0] == pytest.approx(-23.1, abs=0.05)
+    assert measure_loudness(np.zeros((SAMPLE_RATE, 2), dtype=np.int16))[0] == -math.inf
+
+
+def test_gain_reaches_target():
+    assert normalization_gain(sine(-23.0), target_lufs=-16.0) == pytest.approx(7.0, abs=0.1)
+    assert normalization_gain(sine(-10.0), target_lufs=-16.0) == pytest.approx(-6.0, abs=0.1)
+
+
+def test_peak_ceiling_clamps_gain():
+    # -12dBFSの正弦波を-5LUFSにするには+7dB必要だが、ピークを-10dBFSに抑えると+2dBまで
+    samples = sine(-12.0)
+    assert normalization_gain(samples, -5.0, peak_ceiling_db=-1.0) == pytest.approx(7.0, abs=0.1)
+    assert normalization_gain(samples, -5.0, peak_ceiling_db=-10.0) == pytest.approx(2.0, abs=0.01)
+
+
+def test_gain_limits():
+    assert normalization_gain(sine(-60.0), -16.0, max_gain_db=20.0) == 20.0
+    assert normalization_gain(np.zeros((SAMPLE_RATE, 2), dtype=np.int16), -16.0) == 0.0
@@ -0,0 +1,111 @@
+import os
+import threading
+
+from src.cache import DISK_CACHE_RESCAN_FRACTION, DiskCache
+
+
+def put_at(cache, key, data, mtime):
+    # 最終使用時刻を固定して、エントリの古さの順番を決める
+    path = cache.put(key, data)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def stored_keys(cache):
+    return sorted(path.name for path in cache.directory.glob("*/*") if path.suffix != ".tmp")
+
+
+def stored_bytes(cache):
+    return sum(path.stat().st_size for path in cache.directory.glob("*/*"))
+
+
+def test_evicts_least_recently_used_entries(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=300)
+    put_at(cache, "aa", b"a" * 100, 1000)
+    put_at(cache, "bb", b"b" * 100, 2000)
+    put_at(cache, "cc", b"c" * 100, 3000)
+
+    # 読み込んだエントリは最近使ったものとして残る
+    assert cache.get("aa") == b"a" * 100
+    cache.put("dd", b"d" * 100)
+
+    assert stored_keys(cache) == ["aa", "cc", "dd"]
+    assert cache.get("bb") is None
+    assert cache.stats() == {"hits": 1, "misses": 1}
+
+
+def test_evicts_until_total_fits(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=250)
+    for i, key in enumerate(["aa", "bb", "cc"]):
+        put_at(cache, key, b"x" * 100, 1000 + i)
+
+    cache.put("dd", b"x" * 200)
+
+    assert stored_keys(cache) == ["dd"]
+    assert cache._total_bytes == stored_bytes(cache) == 200
+
+
+def test_entry_larger_than_cache_is_not_kept(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=100)
+    cache.put("aa", b"x" * 101)
+
+    assert cache.get("aa") is None
+    assert cache._total_bytes == stored_bytes(cache) == 0
+
+
+def test_size_accounting_counts_overwrites_and_files(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache"), max_bytes=1000, suffix=".wav")
+    source = tmp_path / "source.wav"
+    source.write_bytes(b"s" * 70)
+
+    cache.put("aa", b"x" * 10)
+    cache.put("aa", b"x" * 30)  # 同じキーの上書きは差分だけ増える
+    cache.put_file("bb", str(source))
+
+    assert stored_keys(cache) == ["aa.wav", "bb.wav"]
+    assert cache._total_bytes == stored_bytes(cache) == 100
+    assert cache.get("bb") == b"s" * 70
+
+
+def test_other_instances_writes_are_rescanned(tmp_path):
+    # 同じディレクトリを別のプロセスのキャッシュが使う場合
+    first = DiskCache(str(tmp_path), max_bytes=1000)
+    second = DiskCache(str(tmp_path), max_bytes=1000)
+    first.put("aa", b"x" * 10)
+    second.put("bb", b"x" * 10)
+    entry = int(1000 * DISK_CACHE_RESCAN_FRACTION)
+
+    for i in range(12):
+        put_at(first, f"a{i:02d}", b"x" * entry, 1000 + i)
+    for i in range(3):
+        second.put(f"b{i:02d}", b"x" * entry)
+
+    # secondの数えた合計は上限に届かないが、ディレクトリを数え直して古いものから削除する
+    assert stored_bytes(second) <= 1000
+    assert all(second.get(f"b{i:02d}") for i in range(3))
+
+
+def test_concurrent_puts_stay_within_limit(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=20_000)
+    errors = []
+
+    def writer(worker):
+        try:
+            for i in range(50):
+                # 内容から壊れていないことを確認できるよう、同じバイトで埋める
+                cache.put(f"{worker}{i:03d}", bytes([65 + worker]) * 1000)
+        except Exception as exc:  # pragma: no cover - 失敗時に原因を表示する
+            errors.append(exc)
+
+    threads = [threading.Thread(target=writer, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert not list(tmp_path.glob("*/*.tmp"))
+    assert cache._total_bytes == stored_bytes(cache) <= 20_000
+    for path in tmp_path.glob("*/*"):
+        data = path.read_bytes()
+        assert len(data) == 1000 and data == data[:1] * 1000
@@ -0,0 +1,74 @@
+import sys
+import threading
+import time
+
+import pytest
+
+import src.clients as clients
+from src.clients import get_client
+
+
+@pytest.fixture(autouse=True)
+def empty_registry(monkeypatch):
+    monkeypatch.setattr(clients, "_clients", {})
+    monkeypatch.setattr(clients, "_client_locks", {})
+
+
+def test_factory_runs_once_per_name():
+    calls = []
+    barrier = threading.Barrier(8)
+
+    def factory():
+        calls.append(threading.current_thread().name)
+        time.sleep(0.05)
+        return object()
+
+    def use():
+        barrier.wait()
+        results.append(get_client("slow", factory))
+
+    results = []
+    threads = [threading.Thread(target=use) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_slow_factory_does_not_block_other_names():
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "slow"
+
+    thread = threading.Thread(target=get_client, args=("slow", slow))
+    thread.start()
+    started.wait(5)
+    try:
+        assert get_client("fast", lambda: "fast") == "fast"
+    finally:
+        release.set()
+        thread.join()
+
+
+def test_factory_can_use_other_clients():
+    # 作成中に別のクライアントを取得しても止まらない
+    assert get_client("outer", lambda: ("outer", get_client("inner", lambda: "inner"))) == (
+        "outer", "inner")
+
+
+def test_upload_module_does_not_import_pipeline(monkeypatch):
+    pytest.importorskip("dotenv")
+    pytest.importorskip("termcolor")
+    pytest.importorskip("requests")
+    for name in ["generate_and_upload_video", "src.batch"]:
+        monkeypatch.delitem(sys.modules, name, raising=False)
+
+    import generate_and_upload_video  # noqa: F401
+
+    assert "src.batch" not in sys.modules
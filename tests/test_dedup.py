@@ -0,0 +1,134 @@
+import random
+
+import pytest
+
+import src.clients as clients
+import src.dedup as dedup
+from src.dedup import IdeaIndex, filter_duplicates, minhash, record_produced, similarity
+
+PLACES = ["北海道", "沖縄", "京都", "しまなみ海道", "富士山", "瀬戸内", "軽井沢", "阿蘇", "奈良", "金沢"]
+THINGS = ["自転車道", "古い寺", "海沿いの道", "温泉街", "高原", "湖畔", "商店街", "棚田", "灯台", "峠道"]
+ACTIONS = ["を走る", "を巡る旅", "で見つけた絶景", "の朝", "を歩いてみた", "の秘密"]
+
+
+def random_ideas(rng, count, places=PLACES, things=THINGS):
+    ideas = set()
+    while len(ideas) < count:
+        ideas.add(f"{rng.choice(places)}の{rng.choice(things)}{rng.choice(ACTIONS)}")
+    return sorted(ideas)
+
+
+def near_duplicate(rng, idea):
+    # 記号や括弧を加えた、表記だけが違うアイデア
+    return rng.choice(["【{}】", "{}！", "「{}」", "{}♪"]).format(idea)
+
+
+@pytest.fixture
+def index(tmp_path):
+    return IdeaIndex(str(tmp_path / "ideas.sqlite3"))
+
+
+def test_signature_is_stable():
+    # 保存したシグネチャと比較するため、ハッシュ関数は実行ごとに変わらない
+    assert minhash("北海道の自転車道を走る")[:4] == minhash("北海道の自転車道を走る")[:4]
+    assert similarity(minhash("北海道の自転車道"), minhash("北海道の自転車道")) == 1.0
+    assert similarity(minhash("北海道の美しい自転車道を走る"), minhash("沖縄の海沿いをのんびりサイクリング")) < 0.1
+
+
+def test_near_duplicates_are_found_and_distinct_ideas_pass(index):
+    rng = random.Random(7)
+    produced = random_ideas(rng, 100, PLACES[:5], THINGS[:5])
+    unseen = random_ideas(rng, 100, PLACES[5:], THINGS[5:])
+    for idea in produced:
+        index.add(idea)
+    assert index.count() == len(produced)
+
+    for idea in produced:
+        variant = near_duplicate(rng, idea)
+        match = index.find(variant)
+        assert match is not None and match[0] == idea, variant
+        assert index.find(idea) == (idea, 1.0)
+
+    # 場所も内容も違うアイデアは、言い回しが同じでも重複とみなさない
+    assert [idea for idea in unseen if index.find(idea) is not None] == []
+
+
+def test_find_matches_brute_force(index):
+    rng = random.Random(11)
+    produced = random_ideas(rng, 100)
+    for idea in produced:
+        index.add(idea)
+    signatures = {idea: minhash(idea) for idea in produced}
+
+    for query in random_ideas(random.Random(12), 50):
+        signature = minhash(query)
+        best = max(produced, key=lambda idea: similarity(signature, signatures[idea]))
+        score = similarity(signature, signatures[best])
+        expected = (best, score) if score >= 0.6 else None
+        if query in signatures:
+            expected = (query, 1.0)
+        assert index.find(query, 0.6) == expected, query
+
+
+def test_filter_duplicates_within_list_and_against_index(index):
+    index.add("北海道の美しい自転車道を走る")
+    ideas = [
+        "【北海道】美しい自転車道を走る",
+        "沖縄の海沿いをのんびりサイクリング",
+        "沖縄の海沿いをのんびりサイクリング！",
+        "京都の古い寺を巡る旅",
+    ]
+
+    assert filter_duplicates(ideas, index) == (
+        ["沖縄の海沿いをのんびりサイクリング", "京都の古い寺を巡る旅"],
+        ["【北海道】美しい自転車道を走る", "沖縄の海沿いをのんびりサイクリング！"],
+    )
+    assert filter_duplicates(ideas)[1] == ["沖縄の海沿いをのんびりサイクリング！"]
+
+
+def test_record_produced_persists(tmp_path, monkeypatch):
+    path = tmp_path / "ideas.sqlite3"
+    monkeypatch.setenv("IDEA_INDEX_PATH", str(path))
+    monkeypatch.setattr(clients, "_clients", {})
+
+    record_produced("北海道の美しい自転車道を走る", {"title": "絶景サイクリングロード"})
+    record_produced("北海道の美しい自転車道を走る", {"title": "絶景サイクリングロード"})
+
+    # 別のプロセスから開き直しても残っている
+    reopened = IdeaIndex(str(path))
+    assert reopened.count() == 2
+    assert reopened.find("北海道の美しい自転車道を走る！")[0] == "北海道の美しい自転車道を走る"
+    assert reopened.find("絶景サイクリングロード")[0] == "絶景サイクリングロード"
+
+
+def test_record_produced_can_be_disabled(tmp_path, monkeypatch):
+    monkeypatch.setenv("IDEA_INDEX", "0")
+    monkeypatch.setenv("IDEA_INDEX_PATH", str(tmp_path / "ideas.sqlite3"))
+    record_produced("北海道の美しい自転車道を走る")
+    assert dedup.get_idea_index() is None
+    assert not (tmp_path / "ideas.sqlite3").exists()
+
+
+def test_generate_unique_ideas_regenerates_duplicates(tmp_path, monkeypatch):
+    pytest.importorskip("termcolor")
+    import src.generate_ideas as generate_ideas
+
+    monkeypatch.setenv("IDEA_INDEX_PATH", str(tmp_path / "ideas.sqlite3"))
+    monkeypatch.setattr(clients, "_clients", {})
+    record_produced("北海道の美しい自転車道を走る")
+    rounds = [
+        ["【北海道】美しい自転車道を走る", "沖縄の海沿いをのんびりサイクリング"],
+        ["京都の古い寺を巡る旅"],
+    ]
+    calls = []
+
+    def fake_generate_ideas(meta_topic, num_ideas, refresh=False, exclude=None):
+        calls.append((num_ideas, refresh, list(exclude)))
+        return {"ideas": rounds[len(calls) - 1]}
+
+    monkeypatch.setattr(generate_ideas, "generate_ideas", fake_generate_ideas)
+
+    assert generate_ideas.generate_unique_ideas("旅", 2) == {
+        "ideas": ["沖縄の海沿いをのんびりサイクリング", "京都の古い寺を巡る旅"]}
+    # 足りない分だけ、取り除いたアイデアを避けるよう指示して生成し直す
+    assert calls == [(2, False, []), (1, True, ["【北海道】美しい自転車道を走る"])]
@@ -0,0 +1,22 @@
+import pytest
+
+pytest.importorskip("dotenv")
+pytest.importorskip("openai")
+pytest.importorskip("pydub")
+pytest.importorskip("termcolor")
+
+import generate_video  # noqa: E402
+
+
+def test_failed_script_raises_clear_error(tmp_path, monkeypatch):
+    monkeypatch.setenv("WORKSPACE_ROOT", str(tmp_path / "jobs"))
+    monkeypatch.setenv("TRACE_DIR", str(tmp_path / "traces"))
+    monkeypatch.setattr(generate_video, "prepare_script", lambda *args, **kwargs: None)
+
+    def prepare_assets(*args, **kwargs):
+        raise AssertionError("スクリプトがないまま素材を生成した")
+
+    monkeypatch.setattr(generate_video, "prepare_assets", prepare_assets)
+
+    with pytest.raises(ValueError, match="スクリプトの生成に失敗しました"):
+        generate_video.topic2video("主題", 3, str(tmp_path / "out.mp4"))
@@ -0,0 +1,148 @@
+import threading
+
+import pytest
+
+pytest.importorskip("termcolor")
+
+import src.jobqueue as jobqueue  # noqa: E402
+from src.jobqueue import DONE, FAILED, QUEUED, RUNNING, JobQueue, run_worker  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(jobqueue.time, "time", clock.time)
+    return clock
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / "jobs.sqlite3"))
+
+
+def test_claim_in_order_and_complete(queue, clock):
+    first = queue.enqueue("一つ目", num_clips=3)
+    second = queue.enqueue("二つ目")
+
+    job = queue.claim("worker-a", 30)
+    assert (job.id, job.subject, job.params, job.status, job.attempts) == (
+        first, "一つ目", {"num_clips": 3}, RUNNING, 1)
+    assert queue.claim("worker-b", 30).id == second
+    assert queue.claim("worker-c", 30) is None
+
+    job.timings["video"] = 1.5
+    queue.complete(job, "out.mp4")
+    done = queue.jobs(DONE)
+    assert [(j.id, j.output_path, j.timings) for j in done] == [(first, "out.mp4", {"video": 1.5})]
+    assert queue.counts() == {DONE: 1, RUNNING: 1}
+
+
+def test_concurrent_claims_never_share_a_job(queue):
+    for i in range(20):
+        queue.enqueue(f"主題{i}")
+    claimed = []
+    lock = threading.Lock()
+
+    def worker(name):
+        # 同じファイルを別の接続から使う、別々のワーカーとして取得する
+        own = JobQueue(str(queue.path))
+        while (job := own.claim(name, 30)) is not None:
+            with lock:
+                claimed.append(job.id)
+
+    threads = [threading.Thread(target=worker, args=(f"w{i}",)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claimed) == list(range(1, 21))
+
+
+def test_fail_requeues_until_max_attempts(queue, clock):
+    job_id = queue.enqueue("失敗する主題", max_attempts=2)
+
+    job = queue.claim("worker", 30)
+    queue.fail(job, "一回目")
+    assert queue.jobs()[0].status == QUEUED
+
+    job = queue.claim("worker", 30)
+    assert (job.id, job.attempts) == (job_id, 2)
+    queue.fail(job, "二回目")
+    failed = queue.jobs(FAILED)
+    assert [(j.id, j.error) for j in failed] == [(job_id, "二回目")]
+    assert queue.claim("worker", 30) is None
+
+
+def test_heartbeat_keeps_lease(queue, clock):
+    queue.enqueue("主題")
+    job = queue.claim("worker-a", 30)
+
+    clock.now += 20
+    assert queue.heartbeat(job.id, "worker-a", 30)
+    clock.now += 20
+    # 延長したため、最初の期限を過ぎても他のワーカーは取得しない
+    assert queue.claim("worker-b", 30) is None
+
+
+def test_expired_lease_is_reclaimed_and_old_worker_is_ignored(queue, clock):
+    job_id = queue.enqueue("主題")
+    stale = queue.claim("worker-a", 30)
+
+    clock.now += 31
+    job = queue.claim("worker-b", 30)
+    assert (job.id, job.worker, job.attempts) == (job_id, "worker-b", 2)
+    # リースを失ったワーカーは延長も完了の記録もできない
+    assert not queue.heartbeat(stale.id, "worker-a", 30)
+    queue.complete(stale, "stale.mp4")
+    assert queue.jobs()[0].status == RUNNING
+
+    queue.complete(job, "out.mp4")
+    assert queue.jobs()[0].output_path == "out.mp4"
+
+
+def test_expired_lease_at_max_attempts_fails(queue, clock):
+    queue.enqueue("主題", max_attempts=1)
+    queue.claim("worker-a", 30)
+
+    clock.now += 31
+    assert queue.claim("worker-b", 30) is None
+    assert queue.jobs()[0].status == FAILED
+
+
+def test_enqueue_children_is_idempotent(queue, clock):
+    queue.enqueue("大まかなトピック", kind="topic", max_attempts=4, num_ideas=2)
+    parent = queue.claim("worker", 30)
+
+    ids = queue.enqueue_children(parent, ["案1", "案2"], num_clips=3)
+    # リースの期限切れで再実行されても、同じアイデアを追加し直さない
+    assert queue.enqueue_children(parent, ["別の案"], num_clips=3) == ids
+    children = [job for job in queue.jobs() if job.parent_id == parent.id]
+    assert [(j.kind, j.subject, j.params, j.max_attempts) for j in children] == [
+        ("idea", "案1", {"num_clips": 3}, 4), ("idea", "案2", {"num_clips": 3}, 4)]
+
+
+def test_enqueue_rejects_unknown_kind(queue):
+    with pytest.raises(ValueError):
+        queue.enqueue("主題", kind="video")
+
+
+def test_run_worker_records_results(queue):
+    queue.enqueue("成功")
+    queue.enqueue("失敗", max_attempts=1)
+
+    def handler(job):
+        if job.subject == "失敗":
+            raise RuntimeError("boom")
+        return f"{job.subject}.mp4"
+
+    run_worker(queue, handler, worker="w", lease_seconds=30, exit_when_empty=True)
+    assert [(j.subject, j.status, j.output_path, j.error) for j in queue.jobs()] == [
+        ("成功", DONE, "成功.mp4", None), ("失敗", FAILED, None, "boom")]
@@ -0,0 +1,124 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("termcolor")
+pytest.importorskip("openai")
+
+from src.llm import JsonStreamParser, stream_json_completion  # noqa: E402
+
+SCRIPT = {
+    "title": "タイトル",
+    "clips": [
+        {"text": "\"引用\"と}や]を含む文章。\\", "tags": [["a", "b"], []]},
+        {"text": "二つ目", "nested": {"clips": [{"text": "内側"}]}},
+    ],
+    "after": [{"text": "別の配列"}],
+}
+
+
+def feed_all(parser, chunks):
+    items = []
+    for chunk in chunks:
+        items += parser.feed(chunk)
+    return items
+
+
+def test_parser_emits_items_in_order():
+    text = json.dumps(SCRIPT, ensure_ascii=False)
+    assert feed_all(JsonStreamParser("clips"), [text]) == SCRIPT["clips"]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7])
+def test_parser_handles_any_chunk_boundary(size):
+    # キーやエスケープが分割されても同じ結果になる
+    text = json.dumps(SCRIPT, ensure_ascii=False)
+    chunks = [text[i:i + size] for i in range(0, len(text), size)]
+    assert feed_all(JsonStreamParser("clips"), chunks) == SCRIPT["clips"]
+
+
+def test_parser_ignores_key_inside_strings_and_other_arrays():
+    text = json.dumps({"note": "\"clips\": [{\"x\": 1}]", "other": [{"clips": 1}], "clips": []})
+    assert feed_all(JsonStreamParser("clips"), [text]) == []
+
+
+def test_parser_emits_item_before_stream_ends():
+    parser = JsonStreamParser("clips")
+    assert parser.feed('{"clips": [{"text": "一') == []
+    assert parser.feed('つ目"}, {"te') == [{"text": "一つ目"}]
+    assert parser.feed('xt": "二"}]}') == [{"text": "二"}]
+
+
+def test_parser_rejects_unbalanced_json():
+    with pytest.raises(ValueError):
+        JsonStreamParser("clips").feed('{"clips": []}}')
+
+
+class FakeCompletions:
+    """
+    ストリーミングでは用意したチャンクを、ストリーミングでなければ用意した本文を返す。
+    """
+
+    def __init__(self, chunks, finish_reason, content):
+        self.chunks = chunks
+        self.finish_reason = finish_reason
+        self.content = content
+        self.calls = []
+
+    def create(self, stream=False, **kwargs):
+        self.calls.append(stream)
+        if stream:
+            return [
+                SimpleNamespace(choices=[SimpleNamespace(
+                    delta=SimpleNamespace(content=chunk),
+                    finish_reason=self.finish_reason if i == len(self.chunks) - 1 else None,
+                )])
+                for i, chunk in enumerate(self.chunks)
+            ]
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=self.content))],
+            usage=None,
+        )
+
+
+def fake_client(completions):
+    client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    client.with_options = lambda **kwargs: client
+    return client
+
+
+@pytest.fixture(autouse=True)
+def no_rate_limit(monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT", "0")
+
+
+def test_truncated_stream_falls_back_and_discards_streamed_items():
+    streamed = '{"clips": [{"text": "途中まで"}, {"text": "切'
+    final = {"clips": [{"text": "生成し直した"}]}
+    completions = FakeCompletions([streamed], "length", json.dumps(final, ensure_ascii=False))
+    items, resets = [], []
+
+    data = stream_json_completion(
+        fake_client(completions), "model", [], "clips", items.append,
+        use_cache=False, on_reset=lambda: resets.append(len(items)))
+
+    assert data == final
+    assert completions.calls == [True, False]
+    # 途中までの要素を渡した後で生成し直したため、呼び出し元に破棄させる
+    assert items == [{"text": "途中まで"}]
+    assert resets == [1]
+
+
+def test_complete_stream_does_not_reset():
+    text = json.dumps({"clips": [{"text": "一"}, {"text": "二"}]}, ensure_ascii=False)
+    completions = FakeCompletions([text[:10], text[10:]], "stop", None)
+    items, resets = [], []
+
+    data = stream_json_completion(
+        fake_client(completions), "model", [], "clips", items.append,
+        use_cache=False, on_reset=lambda: resets.append(True))
+
+    assert data["clips"] == items
+    assert completions.calls == [True]
+    assert resets == []
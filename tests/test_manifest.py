@@ -0,0 +1,29 @@
+import pytest
+
+pytest.importorskip("termcolor")
+
+from src.manifest import Manifest  # noqa: E402
+from src.workspace import Workspace  # noqa: E402
+
+SCRIPT = {
+    "title": "タイトル",
+    "description": "説明",
+    "topic": "トピック",
+    "clips": [{"text": "文章。", "video_prompt": "風景"}],
+}
+
+
+def test_load_script_does_not_write_manifest(tmp_path):
+    workspace = Workspace(tmp_path / "job")
+    Manifest(workspace).save_script(SCRIPT)
+    manifest_path = workspace.path / "manifest.json"
+    before = manifest_path.read_bytes()
+    manifest_path.write_bytes(b'{"artifacts": {}}')
+
+    # ロックを取らない読み込み（バッチのスクリプト生成など）はマニフェストを書き換えない
+    assert Manifest(workspace).load_script() == SCRIPT
+    assert manifest_path.read_bytes() == b'{"artifacts": {}}'
+
+    manifest = Manifest(workspace)
+    manifest.record_script(manifest.load_script())
+    assert manifest_path.read_bytes() == before
@@ -0,0 +1,92 @@
+import copy
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("pydub")
+pytest.importorskip("termcolor")
+
+import src.text2voice as text2voice  # noqa: E402
+import src.voice2video as voice2video  # noqa: E402
+from src.audio import SAMPLE_RATE, to_segment  # noqa: E402
+from src.manifest import Manifest  # noqa: E402
+from src.pipeline import prepare_assets, render_video  # noqa: E402
+from src.workspace import Workspace  # noqa: E402
+
+SCRIPT = {
+    "title": "再開のテスト",
+    "clips": [
+        {"num": i, "title": f"クリップ{i}", "text": text, "video_prompt": f"風景{i}"}
+        for i, text in enumerate([
+            "自然の美は私たちの心を癒やします。",
+            "山の空気は澄んでいます。",
+            "川の流れは穏やかです。",
+            "夕日が海を赤く染めます。",
+        ])
+    ],
+}
+
+
+def fake_audio(text: str):
+    # 文章ごとに少しずつ音量の違う1秒の正弦波（TTSサーバーの代わり）
+    amplitude = 0.05 + 0.002 * len(text)
+    t = np.arange(SAMPLE_RATE) / SAMPLE_RATE
+    wave = amplitude * np.sin(2 * np.pi * 440 * t) * 32767
+    return to_segment(np.repeat(wave[:, None], 2, axis=1).astype(np.int16))
+
+
+@pytest.fixture
+def fake_pipeline(tmp_path, monkeypatch):
+    monkeypatch.setenv("TTS_CACHE_DIR", str(tmp_path / "cache" / "tts"))
+    encoded = []
+
+    def download_and_save_image(prompt, refresh=False, workspace=None):
+        path = workspace.new_path(".png")
+        path.write_bytes(prompt.encode("utf-8"))
+        return str(path)
+
+    def create_video_with_audio(image_path, audio, silence_duration, video_duration,
+                                workspace=None, profile=None, subtitle_text=None, gain_db=0.0):
+        encoded.append(image_path)
+        path = workspace.new_path(".mp4")
+        path.write_bytes(f"{image_path} {gain_db}".encode("utf-8"))
+        return str(path)
+
+    def concatenate(json_data, output_path, workspace=None, profile=None, subtitles=None):
+        with open(output_path, "wb") as file:
+            for clip in json_data["clips"]:
+                file.write(open(clip["video_path"], "rb").read())
+        return output_path
+
+    monkeypatch.setattr(text2voice, "process_and_combine_audio", fake_audio)
+    monkeypatch.setattr(voice2video, "download_and_save_image", download_and_save_image)
+    monkeypatch.setattr(voice2video, "create_video_with_audio", create_video_with_audio)
+    monkeypatch.setitem(voice2video.RENDER_ENGINES, "per_clip", concatenate)
+    return encoded
+
+
+def run_job(tmp_path, script):
+    workspace = Workspace(tmp_path / "job")
+    manifest = Manifest(workspace)
+    clips = copy.deepcopy(script)
+    prepare_assets(clips, workspace, manifest)
+    render_video(clips, str(tmp_path / "out.mp4"), workspace, "per_clip", manifest,
+                 subtitles="off")
+    return clips
+
+
+def test_editing_one_clip_reencodes_only_that_clip(tmp_path, fake_pipeline):
+    first = run_job(tmp_path, SCRIPT)
+    assert len(fake_pipeline) == 4
+
+    edited = copy.deepcopy(SCRIPT)
+    edited["clips"][2]["text"] = "川の流れはとても穏やかで、静かです。"
+    fake_pipeline.clear()
+    second = run_job(tmp_path, edited)
+
+    # 編集で動画全体のラウドネスは変わるが、差が小さいため前回のゲインを使う
+    remeasured = copy.deepcopy(second)
+    assert text2voice.normalize_loudness(remeasured) != first["clips"][0]["gain_db"]
+    assert [clip["gain_db"] for clip in second["clips"]] == [
+        clip["gain_db"] for clip in first["clips"]]
+    assert fake_pipeline == [second["clips"][2]["image_path"]]
@@ -0,0 +1,165 @@
+import json
+
+import pytest
+
+pytest.importorskip("termcolor")
+
+import src.ratelimit as ratelimit  # noqa: E402
+from src.ratelimit import call_with_rate_limit  # noqa: E402
+from src.tracing import span, trace_job  # noqa: E402
+
+
+class OverloadError(Exception):
+    status_code = 429
+
+
+def test_retries_and_backoff_are_recorded_on_enclosing_span(tmp_path, monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT", "0")
+    monkeypatch.setattr(ratelimit.time, "sleep", lambda seconds: None)
+    attempts = []
+
+    def request(slot):
+        attempts.append(slot)
+        if len(attempts) < 3:
+            raise OverloadError("rate limited")
+        return "ok"
+
+    with trace_job("job", str(tmp_path)):
+        with span("llm.chat") as current:
+            assert call_with_rate_limit(
+                "chat", request, backoff_factor=0.1, current_span=current) == "ok"
+
+    record = json.loads((tmp_path / "job.jsonl").read_text(encoding="utf-8"))
+    assert record["retries"] == 2
+    # 待機時間は0.1秒と0.2秒をそれぞれ0.5〜1.5倍にばらつかせたもの
+    assert 0.15 <= record["attrs"]["backoff_seconds"] <= 0.45
+
+
+class FakeClock:
+    """
+    sleepで進む時計。待機した時間の合計も記録する。
+    """
+
+    def __init__(self):
+        self.now = 1_000_000.0
+        self.slept = 0.0
+        self.perf_counter = ratelimit.time.perf_counter
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    return clock
+
+
+def make_limiter(tmp_path, **kwargs):
+    return ratelimit.RateLimiter("chat", str(tmp_path / "ratelimit.sqlite3"), **kwargs)
+
+
+def concurrency(limiter, clock):
+    with limiter._connect() as conn:
+        return limiter._load(conn, clock.now)["concurrency"]
+
+
+def test_overload_halves_concurrency_once_per_interval(tmp_path, clock):
+    limiter = make_limiter(tmp_path, max_concurrency=8)
+
+    limiter.release(limiter.acquire(), overloaded=True)
+    assert concurrency(limiter, clock) == 4
+    # 同時に失敗したリクエストでは続けて減らさない
+    limiter.release(limiter.acquire(), overloaded=True)
+    assert concurrency(limiter, clock) == 4
+
+    clock.now += ratelimit.DECREASE_INTERVAL
+    limiter.release(limiter.acquire(), overloaded=True)
+    assert concurrency(limiter, clock) == 2
+    clock.now += ratelimit.DECREASE_INTERVAL
+    limiter.release(limiter.acquire(), overloaded=True)
+    clock.now += ratelimit.DECREASE_INTERVAL
+    limiter.release(limiter.acquire(), overloaded=True)
+    assert concurrency(limiter, clock) == 1
+
+
+def test_success_increases_concurrency_additively(tmp_path, clock):
+    limiter = make_limiter(tmp_path, max_concurrency=4)
+    limiter.release(limiter.acquire(), overloaded=True)
+    assert concurrency(limiter, clock) == 2
+
+    # 同時実行数の分だけ成功すると1増え、上限で止まる
+    for expected in [2.5, 2.9, 2.9 + 1 / 2.9]:
+        limiter.release(limiter.acquire())
+        assert concurrency(limiter, clock) == pytest.approx(expected)
+    for _ in range(10):
+        limiter.release(limiter.acquire())
+    assert concurrency(limiter, clock) == 4
+
+
+def test_slow_response_counts_as_overload(tmp_path, clock):
+    limiter = make_limiter(tmp_path, max_concurrency=8, latency_target=5)
+    limiter.release(limiter.acquire(), latency=4)
+    assert concurrency(limiter, clock) == 8
+    limiter.release(limiter.acquire(), latency=6)
+    assert concurrency(limiter, clock) == 4
+
+
+def test_requests_per_minute_refill(tmp_path, clock):
+    # 60rpmではBURST_SECONDS分の10件まで続けて確保でき、その後は1秒に1件
+    limiter = make_limiter(tmp_path, rpm=60, max_concurrency=100)
+    for _ in range(10):
+        limiter.release(limiter.acquire())
+    assert clock.slept == 0
+
+    limiter.release(limiter.acquire())
+    assert 1.0 <= clock.slept <= 1.2
+    clock.now += 5
+    clock.slept = 0
+    for _ in range(5):
+        limiter.release(limiter.acquire())
+    assert clock.slept == 0
+
+
+def test_tokens_per_minute_refill_and_refund(tmp_path, clock):
+    # 600tpmではバケットの容量は100トークンで、1秒に10トークン回復する
+    limiter = make_limiter(tmp_path, tpm=600, max_concurrency=100)
+    lease = limiter.acquire(100)
+    # 見積もりより少なかった分はバケットに戻す
+    limiter.release(lease, tokens_used=40)
+    limiter.release(limiter.acquire(60), tokens_used=60)
+    assert clock.slept == 0
+
+    limiter.release(limiter.acquire(50), tokens_used=50)
+    assert 5.0 <= clock.slept <= 6.0
+
+
+def test_leases_of_crashed_process_expire(tmp_path, clock):
+    crashed = make_limiter(tmp_path, max_concurrency=2)
+    crashed.acquire()
+    crashed.acquire()
+
+    # 解放されないまま上限に達しているため、リースの期限まで待ってから確保する
+    limiter = make_limiter(tmp_path, max_concurrency=2)
+    limiter.release(limiter.acquire())
+    assert ratelimit.LEASE_TTL <= clock.slept <= ratelimit.LEASE_TTL + 2
+
+
+def test_held_leases_are_renewed(tmp_path, clock):
+    limiter = make_limiter(tmp_path, max_concurrency=1)
+    lease = limiter.acquire()
+    clock.now += ratelimit.LEASE_TTL - 1
+    assert limiter.renew([lease]) == 1
+
+    # 延長したため、元の期限を過ぎても他のプロセスに回収されない
+    clock.now += ratelimit.LEASE_TTL - 1
+    with limiter._connect() as conn:
+        conn.execute("DELETE FROM leases WHERE expires_at < ?", (clock.now,))
+        assert conn.execute("SELECT COUNT(*) FROM leases").fetchone()[0] == 1
+    limiter.release(lease)
+    assert limiter.renew([lease]) == 0
@@ -0,0 +1,62 @@
+import shutil
+import subprocess
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("pydub")
+pytest.importorskip("termcolor")
+
+if shutil.which("ffmpeg") is None:
+    pytest.skip("ffmpeg is not installed", allow_module_level=True)
+
+from src.audio import SAMPLE_RATE, to_segment  # noqa: E402
+from src.manifest import Manifest  # noqa: E402
+from src.pipeline import render_video  # noqa: E402
+from src.workspace import Workspace  # noqa: E402
+
+
+@pytest.fixture
+def clips(tmp_path):
+    image_path = tmp_path / "image.png"
+    subprocess.run(
+        ["ffmpeg", "-f", "lavfi", "-i", "color=c=blue:s=64x64", "-frames:v", "1",
+         str(image_path)],
+        check=True, stdin=subprocess.DEVNULL, capture_output=True,
+    )
+    t = np.arange(SAMPLE_RATE // 2) / SAMPLE_RATE
+    wave = (0.2 * np.sin(2 * np.pi * 440 * t) * 32767).astype(np.int16)
+    audio = to_segment(np.repeat(wave[:, None], 2, axis=1))
+    return {
+        "clips": [
+            {"num": i, "text": f"テスト{i}。", "video_prompt": f"青{i}",
+             "image_path": str(image_path), "audio": audio}
+            for i in range(2)
+        ]
+    }
+
+
+@pytest.mark.parametrize("render_engine", ["per_clip", "single_pass"])
+def test_render_overwrites_existing_output(tmp_path, clips, render_engine):
+    output_path = tmp_path / "output" / "out.mp4"
+    output_path.parent.mkdir()
+    output_path.write_bytes(b"stale video from an earlier run")
+
+    workspace = Workspace(tmp_path / "job")
+    manifest = Manifest(workspace)
+    video_path = render_video(
+        clips, str(output_path), workspace, render_engine, manifest, "fast", subtitles="off")
+
+    assert video_path == str(output_path)
+    assert output_path.read_bytes() != b"stale video from an earlier run"
+    assert output_path.stat().st_size > 0
+    # 一時ファイルは残らない
+    assert [path.name for path in output_path.parent.iterdir()] == ["out.mp4"]
+    # 入力を変えて再実行すると、完成した動画を上書きする
+    for clip in clips["clips"]:
+        clip.pop("video_path", None)
+        clip["gain_db"] = -3.0
+    before = output_path.read_bytes()
+    render_video(
+        clips, str(output_path), workspace, render_engine, manifest, "fast", subtitles="off")
+    assert output_path.read_bytes() != before
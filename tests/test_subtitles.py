@@ -0,0 +1,78 @@
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from src.subtitles import (
+    Cue,
+    build_cues,
+    format_ass,
+    format_srt,
+    get_subtitle_mode,
+    subtitles_filter,
+    write_subtitles,
+)
+
+CUES = [Cue(0.0, 2.5, "最初の字幕"), Cue(2.5, 3661.0456, "次の字幕")]
+
+
+def test_subtitles_are_off_by_default(monkeypatch):
+    monkeypatch.delenv("SUBTITLES", raising=False)
+    assert get_subtitle_mode() == "off"
+    monkeypatch.setenv("SUBTITLES", "burn")
+    assert get_subtitle_mode() == "burn"
+    assert get_subtitle_mode("soft") == "soft"
+    with pytest.raises(ValueError):
+        get_subtitle_mode("hard")
+
+
+def test_build_cues_uses_given_durations():
+    clips = [{"text": "一つ目"}, {"text": "読み上げ", "subtitles": " 表示 する\\n文章 "}]
+    assert build_cues(clips, [1.25, 2.0]) == [
+        Cue(0.0, 1.25, "一つ目"), Cue(1.25, 3.25, "表示 する\\n文章")]
+
+
+def test_format_srt():
+    assert format_srt(CUES) == (
+        "1\n00:00:00,000 --> 00:00:02,500\n最初の字幕\n\n"
+        "2\n00:00:02,500 --> 01:01:01,046\n次の字幕\n"
+    )
+
+
+def test_format_ass_escapes_override_tags(monkeypatch):
+    monkeypatch.setenv("SUBTITLE_FONT", "Test Sans")
+    ass = format_ass([Cue(0.0, 1.0, "{\\b1}太字\\N")], 1080, 1920)
+
+    assert "PlayResX: 1080\nPlayResY: 1920\n" in ass
+    # フォントは呼び出した時点の環境変数から読み込む
+    assert "Style: Default,Test Sans,77," in ass
+    assert ass.endswith("Dialogue: 0,0:00:00.00,0:00:01.00,Default,,0,0,0,,｛＼b1｝太字＼N\n")
+
+
+def test_write_subtitles_picks_format_from_suffix(tmp_path):
+    srt = write_subtitles(CUES, tmp_path / "a.srt")
+    ass = write_subtitles(CUES, tmp_path / "a.ass", 1080, 1920)
+    assert Path(srt).read_text(encoding="utf-8") == format_srt(CUES)
+    assert Path(ass).read_text(encoding="utf-8") == format_ass(CUES, 1080, 1920)
+
+
+def test_subtitles_filter_escapes_path():
+    assert subtitles_filter("/tmp/a'b:c [1],x;y.ass") == (
+        r"subtitles=filename=/tmp/a\\\'b\\:c \[1\]\,x\;y.ass")
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_subtitles_filter_is_accepted_by_ffmpeg(tmp_path):
+    directory = tmp_path / "we'ird:dir [1],x;y"
+    directory.mkdir()
+    path = write_subtitles(CUES[:1], directory / "sub.ass", 64, 64)
+    result = subprocess.run(
+        ["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "color=s=64x64:d=0.1",
+         "-filter_complex", f"[0:v]{subtitles_filter(path)}[v]", "-map", "[v]",
+         "-f", "null", "-"],
+        stdin=subprocess.DEVNULL, capture_output=True, text=True,
+    )
+    if "No such filter" in result.stderr:
+        pytest.skip("ffmpeg is built without libass")
+    assert result.returncode == 0, result.stderr
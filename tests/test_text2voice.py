@@ -0,0 +1,57 @@
+import pytest
+
+requests = pytest.importorskip("requests")
+pytest.importorskip("pydub")
+pytest.importorskip("termcolor")
+
+import src.ratelimit as ratelimit  # noqa: E402
+from src.text2voice import TTSClient  # noqa: E402
+
+
+class FakeResponse(requests.Response):
+    def __init__(self, status_code, content=b""):
+        super().__init__()
+        self.status_code = status_code
+        self._content = content
+        self.headers["Content-Type"] = "audio/wav" if status_code == 200 else "text/plain"
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def get(self, url, params=None, timeout=None):
+        self.calls += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT", "0")
+    monkeypatch.setattr(ratelimit.time, "sleep", lambda seconds: None)
+
+
+def test_adapter_does_not_retry_on_its_own():
+    client = TTSClient(url="http://tts.test")
+    assert client.session.get_adapter("http://tts.test").max_retries.total == 0
+
+
+def test_overload_is_retried_through_rate_limiter():
+    client = TTSClient(url="http://tts.test", retries=2)
+    client.session = FakeSession([
+        FakeResponse(503), requests.ConnectionError("reset"), FakeResponse(200, b"RIFF")])
+
+    assert client.synthesize("こんにちは") == b"RIFF"
+    assert client.session.calls == 3
+
+
+def test_gives_up_after_retries():
+    client = TTSClient(url="http://tts.test", retries=1)
+    client.session = FakeSession([FakeResponse(429), FakeResponse(429)])
+
+    assert client.synthesize("こんにちは") is None
+    assert client.session.calls == 2
@@ -0,0 +1,135 @@
+import json
+import re
+
+import pytest
+
+pytest.importorskip("termcolor")
+pytest.importorskip("openai")
+
+import src.batch as batch  # noqa: E402
+import src.pipeline as pipeline  # noqa: E402
+import src.topic2text as topic2text  # noqa: E402
+from src.topic2text import generate_scripts  # noqa: E402
+
+
+def make_script(subject):
+    return {
+        "title": subject, "description": "説明", "topic": subject,
+        "clips": [{"num": 0, "text": f"{subject}の話。", "video_prompt": subject}],
+    }
+
+
+class FakeLLM:
+    """
+    プロンプトの主題の一覧に答えるcreate_json_completionの代わり。
+
+    reply(subjects)が返した内容を、実際の応答と同じように検証に通してから返す。
+    """
+
+    def __init__(self, reply=None):
+        self.reply = reply or (lambda subjects: {"scripts": [
+            {"index": i, "script": make_script(subject)} for i, subject in enumerate(subjects)]})
+        self.requests = []
+        self.validated = []
+
+    def __call__(self, client, messages, validate, **kwargs):
+        subjects = re.findall(r"^    \d+: (.+)$", messages[-1]["content"], re.MULTILINE)
+        self.requests.append(subjects)
+        data = self.reply(subjects)
+        if isinstance(data, Exception):
+            raise data
+        # 全ての主題が揃っているかどうか（キャッシュに保存するかどうか）を記録する
+        self.validated.append(validate(data))
+        return data
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    def install(reply=None):
+        llm = FakeLLM(reply)
+        monkeypatch.setattr(topic2text, "create_json_completion", llm)
+        monkeypatch.setattr(topic2text, "get_openai_client", lambda: None)
+        return llm
+    return install
+
+
+def test_subjects_are_split_into_batches(fake_llm):
+    llm = fake_llm()
+    subjects = [f"主題{i}" for i in range(7)]
+
+    scripts = generate_scripts(subjects, 1, batch_size=3, max_workers=1)
+
+    assert llm.requests == [subjects[0:3], subjects[3:6], subjects[6:7]]
+    assert [script["title"] for script in scripts] == subjects
+    assert llm.validated == [True, True, True]
+
+
+def test_scripts_are_matched_by_index(fake_llm):
+    # 主題の順番とは違う順番で返ってきてもよい
+    fake_llm(lambda subjects: {"scripts": [
+        {"index": i, "script": make_script(subject)}
+        for i, subject in reversed(list(enumerate(subjects)))]})
+
+    scripts = generate_scripts(["海", "山"], 1, batch_size=2)
+
+    assert [script["title"] for script in scripts] == ["海", "山"]
+
+
+def test_only_invalid_scripts_are_retried(fake_llm):
+    def reply(subjects):
+        scripts = []
+        for i, subject in enumerate(subjects):
+            script = make_script(subject)
+            if subject == "山" and len(subjects) > 1:
+                del script["clips"]  # 検証に不合格
+            scripts.append({"index": i, "script": script})
+        return {"scripts": scripts}
+
+    llm = fake_llm(reply)
+
+    scripts = generate_scripts(["海", "山", "川"], 1, batch_size=3)
+
+    assert llm.requests == [["海", "山", "川"], ["山"]]
+    # 一部が不正な応答はキャッシュしない
+    assert llm.validated == [False, True]
+    assert [script["title"] for script in scripts] == ["海", "山", "川"]
+
+
+@pytest.mark.parametrize("reply", [
+    json.JSONDecodeError("truncated", "{", 1),
+    {"scripts": [{"index": 5, "script": make_script("範囲外")}]},
+    {"scripts": "not a list"},
+])
+def test_failed_batch_returns_none_after_retries(fake_llm, reply):
+    llm = fake_llm(lambda subjects: reply)
+
+    scripts = generate_scripts(["海", "山"], 1, batch_size=2, max_retries=1)
+
+    assert scripts == [None, None]
+    assert llm.requests == [["海", "山"], ["海", "山"]]
+
+
+def test_scheduler_falls_back_to_per_subject_generation(fake_llm, tmp_path, monkeypatch):
+    monkeypatch.setenv("WORKSPACE_ROOT", str(tmp_path / "jobs"))
+    monkeypatch.setenv("TRACE_DIR", str(tmp_path / "traces"))
+    # 「山」のスクリプトだけ、まとめた生成で毎回不正になる
+    fake_llm(lambda subjects: {"scripts": [
+        {"index": i, "script": make_script(subject) if subject != "山" else {}}
+        for i, subject in enumerate(subjects)]})
+    generated = []
+
+    def generate_script(video_subject, num_clips, **kwargs):
+        generated.append(video_subject)
+        return make_script(video_subject)
+
+    monkeypatch.setattr(pipeline, "generate_script", generate_script)
+    monkeypatch.setattr(batch, "prepare_assets", lambda *args: None)
+    monkeypatch.setattr(batch, "render_video", lambda clips, path, *args: path)
+    monkeypatch.setattr(batch, "record_produced", lambda *args: None)
+
+    scheduler = batch.BatchScheduler(network_workers=2, script_batch_size=3)
+    jobs = scheduler.run(["海", "山", "川"], 1, output_dir=str(tmp_path / "output"))
+
+    assert [job.status for job in jobs] == ["done"] * 3
+    assert generated == ["山"]
+    assert [job.clips["title"] for job in jobs] == ["海", "山", "川"]
@@ -0,0 +1,130 @@
+import json
+
+import pytest
+
+requests = pytest.importorskip("requests")
+pytest.importorskip("termcolor")
+
+import src.uploader as uploader  # noqa: E402
+from src.tracing import trace_job  # noqa: E402
+from src.uploader import ResumableUploader, UploadError  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None, body=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = json.dumps(body or {})
+        self._body = body or {}
+
+    def json(self):
+        return self._body
+
+
+class FakeSession:
+    """
+    送信された内容を記録し、用意した応答を順番に返すセッション。
+    """
+
+    def __init__(self, puts):
+        self.puts = list(puts)
+        self.requests = []
+        self.sessions_started = 0
+
+    def post(self, url, **kwargs):
+        self.sessions_started += 1
+        return FakeResponse(200, {"Location": f"{url}/session{self.sessions_started}"})
+
+    def put(self, url, data=None, headers=None, timeout=None):
+        self.requests.append((url, headers["Content-Range"]))
+        response = self.puts.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(uploader, "_backoff", lambda attempt: 0)
+    monkeypatch.setattr(uploader.time, "sleep", lambda seconds: None)
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(b"x" * (2 * uploader.CHUNK_ALIGNMENT))
+    return str(path)
+
+
+def make_uploader(session, tmp_path, **kwargs):
+    return ResumableUploader(
+        session, upload_url="http://upload.test", chunk_size=uploader.CHUNK_ALIGNMENT,
+        state_dir=str(tmp_path / "state"), **kwargs)
+
+
+def test_resume_retries_status_query_instead_of_restarting(tmp_path, video):
+    session = FakeSession([
+        requests.ConnectionError("reset"),
+        FakeResponse(503),
+        FakeResponse(308, {"Range": f"bytes=0-{uploader.CHUNK_ALIGNMENT - 1}"}),
+        FakeResponse(200, body={"id": "video"}),
+    ])
+    client = make_uploader(session, tmp_path)
+    state_path = client._state_path(video, {})
+    state_path.write_text(json.dumps({"session_uri": "http://upload.test/saved"}))
+
+    assert client.upload(video, {}) == {"id": "video"}
+    assert session.sessions_started == 0
+    # 受け取り済みの最初のチャンクは送信し直さない
+    assert session.requests[-1] == (
+        "http://upload.test/saved",
+        f"bytes {uploader.CHUNK_ALIGNMENT}-{2 * uploader.CHUNK_ALIGNMENT - 1}/"
+        f"{2 * uploader.CHUNK_ALIGNMENT}",
+    )
+
+
+def test_status_query_gives_up_after_max_retries(tmp_path, video):
+    session = FakeSession([FakeResponse(503)] * 3)
+    client = make_uploader(session, tmp_path, max_retries=2)
+    client._state_path(video, {}).write_text(
+        json.dumps({"session_uri": "http://upload.test/saved"}))
+
+    with pytest.raises(UploadError):
+        client.upload(video, {})
+    assert session.sessions_started == 0
+
+
+def test_non_advancing_308_is_capped(tmp_path, video):
+    stalled = FakeResponse(308)  # Rangeなし: サーバーは何も受け取っていない
+    session = FakeSession([stalled] * 20)
+    client = make_uploader(session, tmp_path, max_retries=3)
+
+    with pytest.raises(UploadError, match="no progress"):
+        client.upload(video, {})
+    # チャンクの送信と状態の問い合わせを、再試行の上限の分だけ繰り返して止まる
+    assert len(session.requests) == 2 * 3 + 1
+
+
+def test_bytes_count_only_acknowledged_progress(tmp_path, video):
+    half = uploader.CHUNK_ALIGNMENT // 2
+    size = 2 * uploader.CHUNK_ALIGNMENT
+    session = FakeSession([
+        FakeResponse(308),  # 何も受け取っていない
+        FakeResponse(308, {"Range": f"bytes=0-{half - 1}"}),  # 問い合わせると半分だけ受け取っていた
+        FakeResponse(308, {"Range": f"bytes=0-{half + uploader.CHUNK_ALIGNMENT - 1}"}),
+        FakeResponse(200, body={"id": "video"}),
+    ])
+    client = make_uploader(session, tmp_path)
+
+    with trace_job("job", str(tmp_path / "traces")):
+        assert client.upload(video, {}) == {"id": "video"}
+
+    record = json.loads((tmp_path / "traces" / "job.jsonl").read_text(encoding="utf-8"))
+    assert record["name"] == "upload"
+    assert record["bytes"] == size
+    assert [content_range for _, content_range in session.requests] == [
+        f"bytes 0-{uploader.CHUNK_ALIGNMENT - 1}/{size}",
+        f"bytes */{size}",
+        f"bytes {half}-{half + uploader.CHUNK_ALIGNMENT - 1}/{size}",
+        f"bytes {half + uploader.CHUNK_ALIGNMENT}-{size - 1}/{size}",
+    ]
@@ -0,0 +1,190 @@
+import base64
+import os
+import re
+import shutil
+import subprocess
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("pydub")
+pytest.importorskip("termcolor")
+
+import src.voice2video as voice2video  # noqa: E402
+from src.audio import SAMPLE_RATE, to_segment  # noqa: E402
+from src.cache import DiskCache  # noqa: E402
+from src.pipeline import render_video  # noqa: E402
+from src.workspace import Workspace  # noqa: E402
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 600
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    monkeypatch.setattr(voice2video, "_image_cache", DiskCache(str(tmp_path / "cache"), max_bytes=1024 ** 2))
+    return Workspace(tmp_path / "job")
+
+
+def fake_chunks(*chunks, error=None):
+    def fetch_image_chunks(prompt):
+        yield from chunks
+        if error is not None:
+            raise error
+    return fetch_image_chunks
+
+
+def test_image_is_streamed_to_file_and_cached(workspace, monkeypatch):
+    # 先頭の判定に使う12バイトが複数のチャンクに分かれていてもよい
+    monkeypatch.setattr(voice2video, "fetch_image_chunks", fake_chunks(PNG[:5], PNG[5:]))
+
+    path = voice2video.download_and_save_image("猫", workspace=workspace)
+
+    assert path.endswith(".png")
+    assert open(path, "rb").read() == PNG
+    assert [p.suffix for p in workspace.path.iterdir()] == [".png"]
+    assert voice2video.get_image_cache().get_path(voice2video.image_cache_key("猫")) is not None
+
+
+def test_failed_download_leaves_no_partial_file(workspace, monkeypatch):
+    monkeypatch.setattr(
+        voice2video, "fetch_image_chunks",
+        fake_chunks(PNG[:1000], error=ConnectionError("reset")))
+
+    with pytest.raises(ConnectionError):
+        voice2video.download_and_save_image("猫", workspace=workspace)
+    assert list(workspace.path.iterdir()) == []
+    assert voice2video.get_image_cache().get_path(voice2video.image_cache_key("猫")) is None
+
+
+def test_empty_image_raises_clear_error(workspace, monkeypatch):
+    monkeypatch.setattr(voice2video, "fetch_image_chunks", fake_chunks())
+
+    with pytest.raises(ValueError, match="画像データが空です"):
+        voice2video.download_and_save_image("猫", workspace=workspace)
+    assert list(workspace.path.iterdir()) == []
+
+
+def test_batch_dedupes_prompts_and_reloads_evicted_images(tmp_path, monkeypatch):
+    # 画像2枚分だけ入るキャッシュ
+    monkeypatch.setattr(
+        voice2video, "_image_cache", DiskCache(str(tmp_path / "cache"), max_bytes=2 * len(PNG)))
+    fetched = []
+
+    def fetch_image_chunks(prompt):
+        fetched.append(prompt)
+        yield PNG
+
+    monkeypatch.setattr(voice2video, "fetch_image_chunks", fetch_image_chunks)
+
+    def generate(*prompts):
+        clips = {"clips": [{"video_prompt": prompt} for prompt in prompts]}
+        voice2video.generate_images_for_clips(
+            clips, max_workers=1, workspace=Workspace(tmp_path / "job"))
+        return clips["clips"]
+
+    clips = generate("猫", " 猫 ", "犬")
+    assert sorted(fetched) == ["犬", "猫"]
+    assert clips[0]["image_path"] == clips[1]["image_path"]
+
+    # 3枚目で最も前に使った画像が削除され、残った画像はキャッシュから読み込む
+    cache = voice2video.get_image_cache()
+    for mtime, prompt in enumerate(["猫", "犬"], start=1000):
+        path = cache.path_for(voice2video.image_cache_key(prompt))
+        os.utime(path, (mtime, mtime))
+    generate("鳥")
+    fetched.clear()
+    generate("犬", "鳥", "猫")
+    assert fetched == ["猫"]
+
+
+def test_b64_json_is_decoded_in_chunks(monkeypatch):
+    monkeypatch.setenv("IMAGE_RESPONSE_FORMAT", "b64_json")
+    payload = base64.b64encode(PNG * 2).decode("ascii")
+    monkeypatch.setattr(
+        voice2video, "download_image", lambda prompt, response_format: payload)
+
+    chunks = list(voice2video.fetch_image_chunks("猫"))
+    assert b"".join(chunks) == PNG * 2
+    assert len(chunks) > 1
+    assert max(len(chunk) for chunk in chunks) <= voice2video.IMAGE_CHUNK_SIZE
+
+
+@pytest.mark.parametrize("render_engine", ["per_clip", "single_pass"])
+def test_clip_without_audio_fails_before_encoding(tmp_path, monkeypatch, render_engine):
+    # 音声合成に失敗したクリップ（"audio"がNoneで"audio_path"もない）
+    encoded = []
+    monkeypatch.setattr(
+        voice2video, "create_video_with_audio", lambda *args, **kwargs: encoded.append(args))
+    monkeypatch.setattr(voice2video, "run_command", lambda *args, **kwargs: encoded.append(args))
+    audio = to_segment(np.zeros((SAMPLE_RATE, 2), dtype=np.int16))
+    clips = {"clips": [
+        {"num": i, "text": f"文{i}", "video_prompt": f"絵{i}",
+         "image_path": str(tmp_path / "image.png"), "audio": audio if i != 1 else None}
+        for i in range(3)
+    ]}
+
+    with pytest.raises(ValueError, match="音声がないクリップがあります.*: 1$"):
+        render_video(clips, str(tmp_path / "out.mp4"), Workspace(tmp_path / "job"),
+                     render_engine, subtitles="off")
+    assert encoded == []
+    assert not (tmp_path / "out.mp4").exists()
+
+
+def test_load_clip_audio_names_the_clip(tmp_path):
+    with pytest.raises(ValueError, match="クリップの音声がありません: 文"):
+        voice2video.load_clip_audio({"text": "文", "audio": None})
+
+
+requires_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+
+
+def ffmpeg(*args):
+    return subprocess.run(
+        ["ffmpeg", "-hide_banner", *args], stdin=subprocess.DEVNULL, capture_output=True,
+        text=True)
+
+
+@requires_ffmpeg
+def test_soft_subtitles_follow_rendered_clip_lengths(tmp_path):
+    workspace = Workspace(tmp_path / "job")
+    image_path = tmp_path / "image.png"
+    ffmpeg("-f", "lavfi", "-i", "color=c=blue:s=64x64", "-frames:v", "1", str(image_path))
+    clips = []
+    # フレームやAACの単位で丸められる、半端な長さの音声
+    for i, seconds in enumerate([0.4567, 0.3333, 0.5011]):
+        t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+        wave = (0.2 * np.sin(2 * np.pi * 440 * t) * 32767).astype(np.int16)
+        clips.append({"text": f"字幕{i}", "image_path": str(image_path),
+                      "audio": to_segment(np.repeat(wave[:, None], 2, axis=1))})
+    profile = voice2video.get_render_profile("fast")
+    voice2video.process_json_data(
+        {"clips": clips}, workspace=workspace, profile=profile, subtitles="soft")
+
+    output_path = tmp_path / "out.mp4"
+    voice2video.create_combined_video_from_clips(
+        {"clips": clips}, str(output_path), workspace=workspace, subtitles="soft")
+
+    durations = [voice2video.read_mp4_duration(clip["video_path"]) for clip in clips]
+    for clip, duration in zip(clips, durations):
+        probed = re.search(r"Duration: (\d+):(\d+):([\d.]+)", ffmpeg("-i", clip["video_path"]).stderr)
+        hours, minutes, seconds = probed.groups()
+        assert duration == pytest.approx(int(hours) * 3600 + int(minutes) * 60 + float(seconds),
+                                         abs=0.01)
+    # 音声の長さから計算した値とは異なる
+    assert durations != voice2video.compute_clip_durations({"clips": clips})
+
+    srt_path = tmp_path / "out.srt"
+    ffmpeg("-i", str(output_path), "-map", "0:s", str(srt_path))
+    starts = [
+        int(h) * 3600 + int(m) * 60 + int(s) + int(ms) / 1000
+        for h, m, s, ms in re.findall(
+            r"(\d+):(\d+):(\d+),(\d+) -->", srt_path.read_text(encoding="utf-8"))
+    ]
+    assert starts == pytest.approx([0.0, durations[0], durations[0] + durations[1]], abs=0.0005)
+
+
+def test_read_mp4_duration_rejects_non_mp4(tmp_path):
+    path = tmp_path / "not.mp4"
+    path.write_bytes(b"\x00\x00\x00\x10ftypisom\x00\x00\x00\x00")
+    with pytest.raises(ValueError):
+        voice2video.read_mp4_duration(str(path))
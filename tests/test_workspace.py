@@ -0,0 +1,51 @@
+import pytest
+
+from src.workspace import Workspace, WorkspaceInUseError
+
+
+def test_lock_rejects_second_job_on_same_workspace(tmp_path):
+    first = Workspace.create(job_id="same", root=str(tmp_path))
+    second = Workspace.create(job_id="same", root=str(tmp_path))
+
+    with first.lock():
+        with pytest.raises(WorkspaceInUseError):
+            with second.lock():
+                pass
+        # 失敗したジョブは先のジョブの中間ファイルを削除しない
+        assert first.path.exists()
+
+    with second.lock():
+        pass
+
+
+def test_lock_survives_cleanup_inside_block(tmp_path):
+    workspace = Workspace.create(job_id="job", root=str(tmp_path))
+    with workspace.lock():
+        workspace.cleanup()
+    assert not workspace.path.exists()
+
+
+def test_default_cleanup_keeps_job_workspaces(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("WORKSPACE_ROOT", raising=False)
+    job = Workspace.create(job_id="running")
+    (job.path / "manifest.json").write_text("{}")
+    shared = Workspace.default()
+    leftover = shared.new_path(".mp4")
+    leftover.write_bytes(b"legacy")
+
+    assert job.path.parent.resolve() == (tmp_path / "temp" / "jobs").resolve()
+    shared.cleanup()
+
+    # 共有の一時フォルダの中身は削除しても、実行中のジョブのワークスペースは残す
+    assert not leftover.exists()
+    assert (job.path / "manifest.json").exists()
+
+
+def test_default_cleanup_keeps_custom_root_inside_temp(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("WORKSPACE_ROOT", "./temp/custom/jobs")
+    job = Workspace.create(job_id="running")
+
+    Workspace.default().cleanup()
+    assert job.path.exists()
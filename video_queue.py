@@ -0,0 +1,168 @@
+import argparse
+import threading
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+from termcolor import colored
+
+from src.dedup import get_idea_index
+from src.jobqueue import Job, JobQueue, run_worker
+
+# Load environment variables from .env file
+load_dotenv()
+
+_uploader = None
+_uploader_lock = threading.Lock()
+
+
+def get_uploader():
+    # アップロードするジョブが来た時点で認証し、ワーカー内で共有する
+    global _uploader
+    with _uploader_lock:
+        if _uploader is None:
+            from generate_and_upload_video import get_uploader as create_uploader
+
+            _uploader = create_uploader()
+        return _uploader
+
+
+def handle_job(queue: JobQueue, job: Job) -> str:
+    """
+    キューから取得したジョブを実行します。
+
+    topicのジョブはアイデアを生成してideaのジョブとして追加し、ideaのジョブは
+    topic2videoで動画を生成して、指定があればアップロードします。
+    topic2videoはマニフェストから再開するため、他のワーカーが途中まで実行したジョブも続きから進みます。
+
+    Args:
+        queue (JobQueue): ジョブキュー。
+        job (Job): 実行するジョブ。
+
+    Returns:
+        str: 完成した動画のパス（topicのジョブの場合はNone）。
+    """
+    # enqueueやstatusだけを使う場合にOpenAIなどの依存関係を読み込まないよう、ここで読み込む
+    from generate_video import topic2video
+    from src.generate_ideas import generate_unique_ideas
+
+    params = dict(job.params)
+    if job.kind == "topic":
+        started = time.perf_counter()
+        ideas = generate_unique_ideas(job.subject, params.pop("num_ideas", 3))
+        job.timings["ideas"] = time.perf_counter() - started
+        ids = queue.enqueue_children(job, ideas["ideas"], **params)
+        print(colored(f"[+] Job {job.id} enqueued {len(ids)} ideas: {ids}", "green"))
+        return None
+
+    output_dir = Path(params.get("output_dir", "./output"))
+    started = time.perf_counter()
+    video_path, clips = topic2video(
+        job.subject,
+        params.get("num_clips", 5),
+        str(output_dir / f"{job.subject}.mp4"),
+        params.get("render_engine"),
+        params.get("render_profile"),
+    )
+    job.timings["video"] = time.perf_counter() - started
+
+    if params.get("upload"):
+        from generate_and_upload_video import build_clips_body
+
+        started = time.perf_counter()
+        # 再開可能アップロードのため、異常終了後に再実行しても続きから送信する
+        get_uploader().upload(video_path, build_clips_body(clips, params.get("privacy_status")))
+        job.timings["upload"] = time.perf_counter() - started
+    return video_path
+
+
+def print_jobs(queue: JobQueue, status: str = None):
+    """
+    ジョブの一覧と状態ごとの数を表示します。
+    """
+    for job in queue.jobs(status):
+        timings = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in job.timings.items())
+        line = f"{job.id:>5} {job.status:<8} {job.kind:<6} {job.attempts}/{job.max_attempts} {job.subject}"
+        if timings:
+            line += f" ({timings})"
+        if job.output_path:
+            line += f" -> {job.output_path}"
+        if job.error:
+            line += f" - {job.error}"
+        print(line)
+    print(", ".join(f"{name}: {count}" for name, count in sorted(queue.counts().items())))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="動画の生成ジョブをSQLiteのキューに追加し、ワーカーで実行します。")
+    parser.add_argument("--db", default=None,
+                        help="キューのデータベースファイル（既定値は環境変数JOB_QUEUE_PATH）")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    enqueue = commands.add_parser("enqueue", help="ジョブを追加する")
+    enqueue.add_argument("subjects", nargs="+", help="ビデオの主題（--topicの場合は大まかなトピック）")
+    enqueue.add_argument("--topic", action="store_true",
+                         help="主題ではなく大まかなトピックとして追加し、アイデアの生成から行う")
+    enqueue.add_argument("--num-ideas", type=int, default=3, help="--topicの場合に生成するアイデアの数")
+    enqueue.add_argument("--num-clips", type=int, default=5)
+    enqueue.add_argument("--render-engine", choices=("per_clip", "single_pass"), default=None)
+    enqueue.add_argument("--render-profile", choices=("quality", "balanced", "fast", "square"),
+                         default=None)
+    enqueue.add_argument("--output-dir", default="./output")
+    enqueue.add_argument("--upload", action="store_true", help="完成した動画をYouTubeにアップロードする")
+    enqueue.add_argument("--privacy-status", default=None,
+                         help="アップロードする動画の公開設定（既定値は環境変数PRIVACY_STATUS）")
+    enqueue.add_argument("--max-attempts", type=int, default=3)
+    enqueue.add_argument("--allow-duplicates", action="store_true",
+                         help="制作済みの動画と似た主題も追加する")
+
+    worker = commands.add_parser("worker", help="ジョブを取得して実行する")
+    worker.add_argument("--name", default=None, help="ワーカーの名前（既定値はホスト名とプロセスID）")
+    worker.add_argument("--concurrency", type=int, default=1, help="このプロセスで同時に実行するジョブの数")
+    worker.add_argument("--lease-seconds", type=float, default=None,
+                        help="リースの期間（既定値は環境変数JOB_LEASE_SECONDS）")
+    worker.add_argument("--poll-interval", type=float, default=5.0)
+    worker.add_argument("--exit-when-empty", action="store_true",
+                        help="実行できるジョブがなくなったら終了する")
+
+    status = commands.add_parser("status", help="ジョブの一覧を表示する")
+    status.add_argument("--status", choices=("queued", "running", "done", "failed"), default=None)
+
+    args = parser.parse_args()
+    queue = JobQueue(args.db)
+
+    if args.command == "enqueue":
+        params = {
+            "num_clips": args.num_clips,
+            "render_engine": args.render_engine,
+            "render_profile": args.render_profile,
+            "output_dir": args.output_dir,
+            "upload": args.upload,
+            "privacy_status": args.privacy_status,
+        }
+        if args.topic:
+            params["num_ideas"] = args.num_ideas
+        index = None if args.topic or args.allow_duplicates else get_idea_index()
+        for subject in args.subjects:
+            match = index.find(subject) if index is not None else None
+            if match is not None:
+                print(colored(
+                    f"[-] Skipped {subject}: similar to {match[0]} ({match[1]:.2f})", "yellow"))
+                continue
+            job_id = queue.enqueue(
+                subject, kind="topic" if args.topic else "idea",
+                max_attempts=args.max_attempts, **params)
+            print(colored(f"[+] Enqueued job {job_id}: {subject}", "green"))
+    elif args.command == "worker":
+        run_worker(
+            queue,
+            lambda job: handle_job(queue, job),
+            worker=args.name,
+            concurrency=args.concurrency,
+            lease_seconds=args.lease_seconds,
+            poll_interval=args.poll_interval,
+            exit_when_empty=args.exit_when_empty,
+        )
+    else:
+        print_jobs(queue, args.status)